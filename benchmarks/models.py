@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.db import models
+
+from simple_history.models import HistoricalRecords
+
+
+def define_models(count, tracked):
+    """Define `count` models, tracked by simple_history or not."""
+    module = globals()
+    for index in range(count):
+        attrs = {
+            '__module__': __name__,
+            'name': models.CharField(max_length=100),
+            'value': models.IntegerField(default=0),
+            'parent': models.ForeignKey('self', null=True,
+                                        on_delete=models.CASCADE),
+        }
+        if tracked:
+            attrs['history'] = HistoricalRecords()
+        name = str('StartupModel%d' % index)
+        module[name] = type(name, (models.Model,), attrs)
+
+
+define_models(getattr(settings, 'BENCHMARK_STARTUP_MODELS', 0),
+              getattr(settings, 'BENCHMARK_STARTUP_TRACKED', False))
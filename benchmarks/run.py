@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+"""
+Benchmark history capture, reads and admin views on SQLite.
+
+Usage: python benchmarks/run.py [--scale 1] [--repeat 3] [--only as_of ...]
+                                [--output results.json]
+                                [--compare baseline.json]
+
+Each benchmark runs with the test models of simple_history, in an
+in-memory SQLite database and a transaction rolled back afterwards.  The
+results are written as one JSON object: the environment (commit, Python
+and Django versions) and, for each benchmark, its measures, e.g. the best
+``seconds`` per call out of `--repeat` rounds and the ``queries`` of a
+call.  With `--compare`, the change of every measure against an earlier
+output is written to stderr, so regressions can be tracked across commits.
+"""
+import argparse
+import copy
+import json
+import platform
+import subprocess
+import sys
+from collections import OrderedDict
+from datetime import timedelta
+from os.path import abspath, dirname
+from timeit import default_timer
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# History depths of the read and admin benchmarks, times --scale
+DEPTHS = (10, 100, 1000)
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(function):
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+def setup():
+    import django
+    from django.conf import settings
+
+    settings.configure(
+        AUTH_USER_MODEL='custom_user.CustomUser',
+        ROOT_URLCONF='simple_history.tests.urls',
+        ALLOWED_HOSTS=['testserver'],
+        INSTALLED_APPS=[
+            'simple_history.tests',
+            'simple_history.tests.custom_user',
+            'simple_history.tests.external',
+            'simple_history',
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+            'django.contrib.sessions',
+            'django.contrib.admin',
+        ],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3'}},
+        MIDDLEWARE_CLASSES=[
+            'django.contrib.sessions.middleware.SessionMiddleware',
+            'django.contrib.auth.middleware.AuthenticationMiddleware',
+            'django.contrib.messages.middleware.MessageMiddleware',
+        ],
+        TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'APP_DIRS': True,
+        }],
+        PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    )
+    if hasattr(django, 'setup'):
+        django.setup()
+    from django.db import connection
+    connection.creation.create_test_db(verbosity=0)
+
+
+def get_environment():
+    import django
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+    }
+
+
+def timed(function, number, repeat):
+    """Return the best seconds per call of `function`, and its queries.
+
+    The queries of one more call are counted first, untimed.
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as context:
+        function()
+    queries = len(context.captured_queries)
+    best = None
+    for _ in range(repeat):
+        started = default_timer()
+        for _ in range(number):
+            function()
+        seconds = (default_timer() - started) / number
+        if best is None or seconds < best:
+            best = seconds
+    return {'seconds': best, 'queries': queries}
+
+
+def create_history(obj, depth, start):
+    """Record `depth` changes of `obj`, a minute apart from `start`."""
+    changes = []
+    for index in range(depth):
+        change = copy.copy(obj)
+        change._history_date = start + timedelta(minutes=index)
+        changes.append(change)
+    type(obj).history.bulk_history_create(changes)
+
+
+def get_depths(scale):
+    return [max(int(depth * scale), 2) for depth in DEPTHS]
+
+
+@benchmark
+def post_save(scale, repeat):
+    from simple_history.tests.models import Poll
+    from django.utils.timezone import now
+
+    number = max(int(200 * scale), 1)
+    poll = Poll.objects.create(question="Question", pub_date=now())
+    result = {
+        'create': timed(lambda: Poll.objects.create(
+            question="Question", pub_date=now()), number, repeat),
+        'save': timed(poll.save, number, repeat),
+        'save_without_history': timed(
+            poll.save_without_historical_record, number, repeat),
+    }
+    result['history_seconds_per_save'] = (
+        result['save']['seconds'] -
+        result['save_without_history']['seconds'])
+    return result
+
+
+@benchmark
+def m2m(scale, repeat):
+    from simple_history.tests.models import Article, Tag
+
+    result = OrderedDict()
+    for size in (1, max(int(20 * scale), 2)):
+        article = Article.objects.create(title="Article")
+        tags = [Tag.objects.create(name="Tag %s" % index)
+                for index in range(size)]
+
+        def set_clear():
+            if hasattr(article.tags, 'set'):
+                article.tags.set(tags)
+            else:  # Django < 1.9
+                article.tags = tags
+            article.tags.clear()
+
+        def add_remove():
+            article.tags.add(*tags)
+            article.tags.remove(*tags)
+
+        result['tags_%s' % size] = {
+            'set_clear': timed(set_clear, 10, repeat),
+            'add_remove': timed(add_remove, 10, repeat),
+        }
+    return result
+
+
+@benchmark
+def as_of(scale, repeat):
+    from simple_history.tests.models import Poll
+    from django.utils.timezone import now
+
+    objects = max(int(50 * scale), 1)
+    result = OrderedDict()
+    for depth in get_depths(scale):
+        start = now()
+        Poll.objects.all().delete()
+        Poll.history.all().delete()
+        polls = [Poll.objects.create(question="Question %s" % index,
+                                     pub_date=start)
+                 for index in range(objects)]
+        for poll in polls:
+            create_history(poll, depth, start)
+        date = start + timedelta(minutes=depth // 2)
+        result['depth_%s' % depth] = {
+            'single': timed(lambda: polls[0].history.as_of(date), 20,
+                            repeat),
+            'set': dict(timed(lambda: list(Poll.history.as_of(date)), 1,
+                              repeat), objects=objects),
+            'most_recent': timed(polls[0].history.most_recent, 20, repeat),
+        }
+    return result
+
+
+@benchmark
+def populate_history(scale, repeat):
+    from django.core.management import call_command
+    from django.utils.six import StringIO
+    from django.utils.timezone import now
+    from simple_history.tests.models import Poll
+
+    rows = max(int(2000 * scale), 1)
+    Poll.objects.bulk_create(Poll(question="Question %s" % index,
+                                  pub_date=now()) for index in range(rows))
+    result = OrderedDict()
+    for name, options in (('default', {}), ('fast', {'fast': True})):
+        best = None
+        for _ in range(repeat):
+            Poll.history.all().delete()
+            started = default_timer()
+            call_command('populate_history', 'tests.poll', batchsize=500,
+                         stdout=StringIO(), stderr=StringIO(), **options)
+            seconds = default_timer() - started
+            if best is None or seconds < best:
+                best = seconds
+        result[name] = {'seconds': best, 'rows': rows,
+                        'rows_per_second': rows / best}
+    return result
+
+
+@benchmark
+def admin(scale, repeat):
+    from django.contrib.auth import get_user_model
+    from django.core.urlresolvers import reverse
+    from django.test import Client
+    from django.utils.timezone import now
+    from simple_history.tests.models import Poll
+
+    get_user_model().objects.create_superuser(
+        'benchmark', 'benchmark@example.com', 'benchmark')
+    client = Client()
+    client.login(username='benchmark', password='benchmark')
+    result = OrderedDict()
+    for depth in get_depths(scale):
+        poll = Poll.objects.create(question="Question", pub_date=now())
+        create_history(poll, depth, now())
+        records = poll.history.order_by('history_id')
+        first, last = records.first(), records.last()
+        history_url = reverse('admin:tests_poll_history', args=[poll.pk])
+        compare_url = '%s?from=%s&to=%s' % (
+            reverse('admin:tests_poll_simple_compare', args=[poll.pk]),
+            first.history_id, last.history_id)
+
+        def get(url):
+            response = client.get(url)
+            assert response.status_code == 200, response.status_code
+
+        result['depth_%s' % depth] = {
+            'history_view': timed(lambda: get(history_url), 5, repeat),
+            'compare_view': timed(lambda: get(compare_url), 5, repeat),
+        }
+    return result
+
+
+@benchmark
+def startup(scale, repeat):
+    from benchmarks import startup
+
+    best = None
+    for _ in range(repeat):
+        result = startup.run(max(int(100 * scale), 1))
+        if best is None or result['tracked_seconds'] < best[
+                'tracked_seconds']:
+            best = result
+    return best
+
+
+def run(names, scale, repeat):
+    from django.db import transaction
+
+    results = OrderedDict()
+    for name in names:
+        with transaction.atomic():
+            results[name] = BENCHMARKS[name](scale, repeat)
+            transaction.set_rollback(True)
+        sys.stderr.write('%s done\n' % name)
+    return results
+
+
+def flatten(results, prefix=''):
+    """Map the dotted path of every number in `results` to it."""
+    measures = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            measures.update(flatten(value, '%s%s.' % (prefix, key)))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            measures[prefix + key] = value
+    return measures
+
+
+def compare(baseline, results):
+    old = flatten(baseline.get('benchmarks', {}))
+    for path, value in sorted(flatten(results['benchmarks']).items()):
+        if path not in old:
+            continue
+        if old[path]:
+            change = '%+.1f%%' % ((float(value) / old[path] - 1) * 100)
+        else:
+            change = 'was 0'
+        sys.stderr.write('%-60s %12.6g -> %12.6g (%s)\n' % (
+            path, old[path], value, change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--scale', type=float, default=1,
+                        help='Multiplies the size of every benchmark.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS),
+                        default=list(BENCHMARKS))
+    parser.add_argument('--output', help='File to write, defaults to stdout.')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='Earlier output to compare the results with.')
+    options = parser.parse_args(argv)
+    setup()
+    results = {
+        'environment': get_environment(),
+        'scale': options.scale,
+        'benchmarks': run(options.only, options.scale, options.repeat),
+    }
+    output = json.dumps(results, indent=2, sort_keys=True) + '\n'
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        sys.stdout.write(output)
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            compare(json.load(baseline_file), results)
+
+
+if __name__ == '__main__':
+    main()
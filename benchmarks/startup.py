@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Time Django's startup with many history tracked models.
+
+Usage: python benchmarks/startup.py [--models 500]
+
+Each measure runs `django.setup()` in a new process: with untracked models
+as a baseline, with models tracked by simple_history, and with lazily
+created historical models (``SIMPLE_HISTORY_LAZY``).  Writes one JSON
+object with the seconds spent and the number of `class_prepared`
+receivers left connected.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+MODES = ('untracked', 'tracked', 'lazy')
+
+
+def measure(count, mode):
+    """Return the seconds spent by `django.setup()` in this process."""
+    import django
+    from django.conf import settings
+
+    settings.configure(
+        INSTALLED_APPS=['django.contrib.contenttypes', 'django.contrib.auth',
+                        'simple_history', 'benchmarks'],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3'}},
+        BENCHMARK_STARTUP_MODELS=count,
+        BENCHMARK_STARTUP_TRACKED=mode != 'untracked',
+        SIMPLE_HISTORY_LAZY=mode == 'lazy',
+    )
+    started = time.time()
+    django.setup()
+    seconds = time.time() - started
+    from django.db.models.signals import class_prepared
+    return {'seconds': seconds,
+            'class_prepared_receivers': len(class_prepared.receivers)}
+
+
+def run(count):
+    results = {}
+    for mode in MODES:
+        output = subprocess.check_output([
+            sys.executable, abspath(__file__), '--models', str(count),
+            '--measure', mode])
+        results[mode] = json.loads(output.decode('utf-8'))
+    baseline = results['untracked']['seconds']
+    result = {
+        'benchmark': 'startup',
+        'models': count,
+        'untracked_seconds': round(baseline, 4),
+        'class_prepared_receivers':
+            results['tracked']['class_prepared_receivers'],
+    }
+    for mode in ('tracked', 'lazy'):
+        seconds = results[mode]['seconds']
+        result['%s_seconds' % mode] = round(seconds, 4)
+        result['%s_history_seconds_per_model' % mode] = round(
+            (seconds - baseline) / max(count, 1), 6)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--models', type=int, default=500)
+    parser.add_argument('--measure', choices=MODES,
+                        help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+    if options.measure:
+        result = measure(options.models, options.measure)
+    else:
+        result = run(options.models)
+    sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
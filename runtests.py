@@ -2,6 +2,7 @@
 import logging
 from os.path import abspath, dirname, join
 from shutil import rmtree
+import subprocess
 import sys
 
 import django
@@ -50,9 +51,11 @@ DEFAULT_SETTINGS = dict(
 
 
 def main():
-
+    # The registry tests run again in a separate process with lazily
+    # created historical models, see SIMPLE_HISTORY_LAZY
+    lazy = '--lazy' in sys.argv
     if not settings.configured:
-        settings.configure(**DEFAULT_SETTINGS)
+        settings.configure(SIMPLE_HISTORY_LAZY=lazy, **DEFAULT_SETTINGS)
     if hasattr(django, 'setup'):
         django.setup()
     try:
@@ -62,9 +65,15 @@ def main():
         failures = DjangoTestSuiteRunner(failfast=False).run_tests(['tests'])
         failures |= DjangoTestSuiteRunner(failfast=False).run_tests(['registry_tests'])
     else:
-        failures = DiscoverRunner(failfast=False).run_tests(['simple_history.tests'])
+        if not lazy:
+            failures = DiscoverRunner(failfast=False).run_tests(['simple_history.tests'])
+        else:
+            failures = 0
         failures |= DiscoverRunner(failfast=False).run_tests(['simple_history.registry_tests'])
-    sys.exit(failures)
+        if not lazy:
+            failures |= subprocess.call(
+                [sys.executable, abspath(__file__), '--lazy'])
+    sys.exit(bool(failures))
 
 
 if __name__ == "__main__":
@@ -1,25 +1,40 @@
 from __future__ import unicode_literals
 
-import re
-import difflib
+import hashlib
+import json
+from datetime import timedelta
+from itertools import islice
+
 from django import http
 from django.core.exceptions import PermissionDenied
 from django.conf.urls import url
 from django.contrib import admin
 from django.contrib.admin import helpers
+from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
-from django.core.urlresolvers import reverse
+from django.core.cache import cache
+from django.core.urlresolvers import NoReverseMatch, reverse
+from django.db.models import Q
 from django.shortcuts import get_object_or_404, render
+from django.utils.dateparse import parse_datetime
+from django.utils.http import urlencode
 from django.utils.text import capfirst
+from django.utils.timezone import (
+    get_current_timezone, is_naive, make_aware, now)
 from django.utils.html import mark_safe
-from django.utils.translation import ugettext as _
-from django.utils.encoding import force_text
+from django.utils.translation import ugettext as _, ugettext_lazy
+from django.utils.encoding import force_bytes, force_text
 from django.conf import settings
 
+from .diff import generate_diff
+from .feed import (
+    format_cursor, get_history_label, parse_cursor, recent_changes)
+from .models import registered_models
+
 try:
-    from django.contrib.admin.utils import unquote
+    from django.contrib.admin.utils import quote, unquote
 except ImportError:  # Django < 1.7
-    from django.contrib.admin.util import unquote
+    from django.contrib.admin.util import quote, unquote
 try:
     from django.utils.version import get_complete_version
 except ImportError:
@@ -36,6 +51,13 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
     object_history_template = "simple_history/object_history.html"
     object_history_form_template = "simple_history/object_history_form.html"
     object_compare_template = "simple_history/history_compare.html"
+    history_stats_template = "simple_history/history_stats.html"
+    history_stats_days = 7
+    history_stats_top = 50
+    history_list_per_page = 100
+    compare_cache_timeout = 60 * 60
+    compare_cache_max_length = 64 * 1024
+    revert_to_date_template = "simple_history/revert_to_date.html"
 
     def get_urls(self):
         """Returns the additional urls used by the Reversion admin."""
@@ -44,12 +66,18 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
         opts = self.model._meta
         info = opts.app_label, opts.model_name
         history_urls = [
+            url("^history/stats/$",
+                admin_site.admin_view(self.history_stats_view),
+                name='%s_%s_simple_history_stats' % info),
             url("^([^/]+)/history/([^/]+)/$",
                 admin_site.admin_view(self.history_form_view),
                 name='%s_%s_simple_history' % info),
             url("^([^/]+)/compare/$",
                 admin_site.admin_view(self.compare_view),
                 name='%s_%s_simple_compare' % info),
+            url("^([^/]+)/compare/field/$",
+                admin_site.admin_view(self.compare_field_view),
+                name='%s_%s_simple_compare_field' % info),
         ]
         return history_urls + urls
 
@@ -62,7 +90,8 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
         pk_name = opts.pk.attname
         history = getattr(model, model._meta.simple_history_manager_attribute)
         object_id = unquote(object_id)
-        action_list = history.filter(**{pk_name: object_id})
+        action_list = history.filter(
+            **{pk_name: object_id}).select_related('history_user')
         # If no history was found, see whether this object even exists.
         try:
             obj = model.objects.get(**{pk_name: object_id})
@@ -77,7 +106,6 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
                                                   content_type.model)
         context = {
             'title': _('Change history: %s') % force_text(obj),
-            'action_list': action_list,
             'module_name': capfirst(force_text(opts.verbose_name_plural)),
             'object': obj,
             'root_path': getattr(self.admin_site, 'root_path', None),
@@ -85,12 +113,191 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
             'opts': opts,
             'admin_user_view': admin_user_view
         }
+        context.update(self.get_history_page(request, action_list))
+        self.prepare_history_rows(context['action_list'], object_id,
+                                  admin_user_view)
         context.update(extra_context or {})
         extra_kwargs = {}
         if get_complete_version() < (1, 8):
             extra_kwargs['current_app'] = request.current_app
         return render(request, self.object_history_template, context, **extra_kwargs)
 
+    def get_history_page(self, request, action_list):
+        """Return one page of `action_list`, newest records first.
+
+        Pages are selected by a cursor on `(history_date, history_id)`
+        passed as the `after` (older records) or `before` (newer records)
+        query parameter, so no page needs to count or skip records.  The
+        pages are browsed by submitting the compare form, which carries the
+        `from` and `to` records chosen on other pages along.
+        """
+        per_page = self.history_list_per_page
+        after = self._parse_history_cursor(request.GET.get('after'))
+        before = self._parse_history_cursor(request.GET.get('before'))
+        if before is not None:
+            date, history_id = before
+            page = action_list.filter(
+                Q(history_date__gt=date) |
+                Q(history_date=date, history_id__gt=history_id)
+            ).order_by('history_date', 'history_id')
+        else:
+            page = action_list.order_by('-history_date', '-history_id')
+            if after is not None:
+                date, history_id = after
+                page = page.filter(
+                    Q(history_date__lt=date) |
+                    Q(history_date=date, history_id__lt=history_id))
+        actions = list(page[:per_page + 1])
+        has_more = len(actions) > per_page
+        actions = actions[:per_page]
+        if before is not None:
+            actions.reverse()
+            has_newer, has_older = has_more, True
+        else:
+            has_newer, has_older = after is not None, has_more
+        context = {
+            'action_list': actions,
+            'is_first_page': not has_newer,
+            'is_last_page': not has_older,
+            'newer_page_cursor': None,
+            'older_page_cursor': None,
+            'newer_page_url': None,
+            'older_page_url': None,
+        }
+        context.update(self._get_history_selection(request, actions))
+        selection = [(name, context['compare_%s' % name])
+                     for name in ('from', 'to')
+                     if context['compare_%s' % name] is not None]
+        if actions and has_newer:
+            context['newer_page_cursor'] = self._history_cursor(actions[0])
+            context['newer_page_url'] = '?%s' % urlencode(
+                [('before', context['newer_page_cursor'])] + selection)
+        if actions and has_older:
+            context['older_page_cursor'] = self._history_cursor(actions[-1])
+            context['older_page_url'] = '?%s' % urlencode(
+                [('after', context['older_page_cursor'])] + selection)
+        return context
+
+    def _get_history_selection(self, request, actions):
+        """Return the `from` and `to` records to compare, checked by default.
+
+        Records chosen on another page are kept in `compare_elsewhere` so
+        the page can submit them along.  Without a choice, the two newest
+        records of the page are compared.
+        """
+        selection = {}
+        defaults = {'to': actions[0].pk if actions else None,
+                    'from': actions[1].pk if len(actions) > 1 else None}
+        for name in ('from', 'to'):
+            try:
+                selection[name] = int(request.GET[name])
+            except (KeyError, ValueError):
+                selection[name] = defaults[name]
+        page_ids = set(action.pk for action in actions)
+        return {
+            'compare_from': selection['from'],
+            'compare_to': selection['to'],
+            'compare_elsewhere': [
+                (name, selection[name]) for name in ('from', 'to')
+                if selection[name] is not None and
+                selection[name] not in page_ids],
+        }
+
+    def prepare_history_rows(self, actions, object_id, admin_user_view):
+        """Compute the links and labels of the history list in one pass.
+
+        Sets `admin_revert_url`, `admin_object_display` and
+        `admin_user_url` on each record, reversing each URL once per page
+        instead of once per row.
+        """
+        opts = self.model._meta
+        revert_url_prefix = reverse(
+            '%s:%s_%s_history' % (self.admin_site.name, opts.app_label,
+                                  opts.model_name),
+            args=(object_id,))
+        user_urls = {}
+        for action in actions:
+            action.admin_revert_url = '%s%s/' % (revert_url_prefix,
+                                                 action.history_id)
+            action.admin_object_display = force_text(action.history_object)
+            user_id = action.history_user_id
+            if user_id is not None and user_id not in user_urls:
+                try:
+                    user_urls[user_id] = reverse(admin_user_view,
+                                                 args=(quote(user_id),))
+                except NoReverseMatch:
+                    user_urls[user_id] = None
+            action.admin_user_url = user_urls.get(user_id)
+        return actions
+
+    def _history_cursor(self, action):
+        return '%s_%s' % (action.history_id, action.history_date.isoformat())
+
+    def _parse_history_cursor(self, cursor):
+        try:
+            history_id, date = cursor.split('_', 1)
+            date, history_id = parse_datetime(date), int(history_id)
+        except (AttributeError, TypeError, ValueError):
+            return None
+        if date is None:
+            return None
+        return date, history_id
+
+    def history_stats_view(self, request, extra_context=None):
+        """Change frequencies of this model over the last days."""
+        request.current_app = self.admin_site.name
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        model = self.model
+        opts = model._meta
+        history = getattr(model, opts.simple_history_manager_attribute)
+        try:
+            days = int(request.GET.get('days', self.history_stats_days))
+        except ValueError:
+            days = self.history_stats_days
+        start = now() - timedelta(days=days)
+
+        top_objects = list(history.count_by_object(start=start)[
+            :self.history_stats_top])
+        objects = model._default_manager.in_bulk(
+            [row[opts.pk.attname] for row in top_objects])
+        for row in top_objects:
+            row['object'] = objects.get(row[opts.pk.attname])
+            row['pk'] = row[opts.pk.attname]
+
+        by_user = list(history.count_by_user(start=start)[
+            :self.history_stats_top])
+        users = get_user_model()._default_manager.in_bulk(
+            [row['history_user'] for row in by_user if row['history_user']])
+        for row in by_user:
+            row['user'] = users.get(row['history_user'])
+
+        type_names = dict(
+            history.model._meta.get_field('history_type').choices)
+        by_type = list(history.count_by_type(start=start))
+        for row in by_type:
+            row['name'] = type_names.get(row['history_type'],
+                                         row['history_type'])
+
+        context = {
+            'title': _('Change statistics: %s') % force_text(
+                opts.verbose_name_plural),
+            'module_name': capfirst(force_text(opts.verbose_name_plural)),
+            'app_label': opts.app_label,
+            'opts': opts,
+            'days': days,
+            'top_objects': top_objects,
+            'by_user': by_user,
+            'by_type': by_type,
+            'by_date': history.count_by_date('day', start=start),
+        }
+        context.update(extra_context or {})
+        extra_kwargs = {}
+        if get_complete_version() < (1, 8):
+            extra_kwargs['current_app'] = request.current_app
+        return render(request, self.history_stats_template, context,
+                      **extra_kwargs)
+
     def response_change(self, request, obj):
         if '_change_history' in request.POST and SIMPLE_HISTORY_EDIT:
             verbose_name = obj._meta.verbose_name
@@ -108,6 +315,43 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
             return super(SimpleHistoryAdmin, self).response_change(
                 request, obj)
 
+    def revert_to_date(self, request, queryset):
+        """Admin action restoring the selected objects as of a date."""
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        opts = self.model._meta
+        date = parse_datetime(request.POST.get('revert_date', ''))
+        if date is not None:
+            if settings.USE_TZ and is_naive(date):
+                date = make_aware(date, get_current_timezone())
+            history = getattr(self.model,
+                              opts.simple_history_manager_attribute)
+            reverted = history.revert_to(date, queryset,
+                                         history_user=request.user)
+            self.message_user(request, _(
+                'Reverted %(count)d %(name)s as of %(date)s.') % {
+                'count': len(reverted),
+                'name': force_text(opts.verbose_name_plural),
+                'date': date,
+            })
+            return None
+        context = {
+            'title': _('Revert to a date'),
+            'queryset': queryset,
+            'opts': opts,
+            'app_label': opts.app_label,
+            'module_name': capfirst(force_text(opts.verbose_name_plural)),
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+            'invalid_date': 'revert_date' in request.POST,
+        }
+        extra_kwargs = {}
+        if get_complete_version() < (1, 8):
+            extra_kwargs['current_app'] = self.admin_site.name
+        return render(request, self.revert_to_date_template, context,
+                      **extra_kwargs)
+    revert_to_date.short_description = ugettext_lazy(
+        'Revert selected %(verbose_name_plural)s to a date')
+
     def history_form_view(self, request, object_id, version_id):
         request.current_app = self.admin_site.name
         original_opts = self.model._meta
@@ -197,47 +441,17 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
         return render(request, self.object_history_form_template, context, **extra_kwargs)
 
     def compare_view(self, request, object_id, extra_context=None):
+        request.current_app = self.admin_site.name
         object_id = unquote(object_id)
         obj = get_object_or_404(self.model, pk=object_id)
+        if not self.has_change_permission(request, obj):
+            raise PermissionDenied
         history = getattr(obj,
                           self.model._meta.simple_history_manager_attribute)
-        prev, curr = history.get(pk=request.GET['from']), history.get(pk=request.GET['to'])
-
-        def generate_diff(prev, curr):
-            markup = ""
-            try:
-                prev = re.split("(\W)", prev)
-                curr = re.split("(\W)", curr)
-            except TypeError:
-                if prev != curr:
-                    return '<span class="compare-removed">{removed_content}</span><br><span class="compare-added">{added_content}</span>'.format(
-                        removed_content=prev, added_content=curr)
-                return curr
-            p_a, p_b, p_l = (0, 0, 0)
-            try:
-                for block in difflib.SequenceMatcher(a=prev, b=curr).get_matching_blocks():
-                    a, b, l = block
-                    removed = prev[p_a + p_l:a]
-                    added = curr[p_b + p_l:b]
-                    same = curr[b:b + l]
-                    if removed:
-                        markup += '<span class="compare-removed">{content}</span>'.format(content="".join(removed))
-                    if added:
-                        markup += '<span class="compare-added">{content}</span>'.format(content="".join(added))
-                    if same:
-                        markup += '<span class="compare-unchanged">{content}</span>'.format(content="".join(same))
-                    p_a, p_b, p_l = block
-
-            except TypeError:
-                return curr
-            return markup
-
-        fields = [{
-            'name': field.attname,
-            'contents': generate_diff(getattr(prev, field.attname), getattr(curr, field.attname)),
-        } for field in self.model._meta.fields]
+        prev, curr = self.get_compared_records(request, history)
+        fields = self.get_compare_fields(request, object_id, prev, curr)
         opts = self.model._meta
-        d = {
+        context = {
             'title': _('Compare %s') % force_text(obj),
             'app_label': opts.app_label,
             'module_name': capfirst(force_text(opts.verbose_name_plural)),
@@ -256,10 +470,180 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
             'has_change_permission': self.has_change_permission(request, obj),
             'has_delete_permission': self.has_delete_permission(request, obj),
         }
-        return render(request, template_name=self.object_compare_template,
-                      current_app=self.admin_site.name, dictionary=d)
+        context.update(extra_context or {})
+        extra_kwargs = {}
+        if get_complete_version() < (1, 8):
+            extra_kwargs['current_app'] = request.current_app
+        return render(request, self.object_compare_template, context,
+                      **extra_kwargs)
+
+    def get_compared_ids(self, request):
+        try:
+            return int(request.GET['from']), int(request.GET['to'])
+        except (KeyError, ValueError):
+            raise http.Http404
+
+    def get_compared_records(self, request, history):
+        """Load the `from` and `to` records of the compare view at once."""
+        from_id, to_id = self.get_compared_ids(request)
+        records = history.in_bulk([from_id, to_id])
+        if from_id not in records or to_id not in records:
+            raise http.Http404
+        return records[from_id], records[to_id]
+
+    def compare_field_view(self, request, object_id):
+        """Return the diff of a single field of two records as JSON.
+
+        Diffs up to `compare_cache_max_length` characters are cached.
+        """
+        object_id = unquote(object_id)
+        attnames = [field.attname for field in self.model._meta.fields]
+        name = request.GET.get('field')
+        if name not in attnames:
+            raise http.Http404
+        obj = get_object_or_404(self.model, pk=object_id)
+        if not self.has_change_permission(request, obj):
+            raise PermissionDenied
+        cache_key = self.get_compare_cache_key(request, object_id, name)
+        contents = None
+        if self.compare_cache_timeout:
+            contents = cache.get(cache_key)
+        if contents is None:
+            history = getattr(
+                obj, self.model._meta.simple_history_manager_attribute)
+            prev, curr = self.get_compared_records(request, history)
+            contents = generate_diff(getattr(prev, name),
+                                     getattr(curr, name))
+            if (self.compare_cache_timeout and
+                    len(contents) <= self.compare_cache_max_length):
+                cache.set(cache_key, contents, self.compare_cache_timeout)
+        return http.HttpResponse(
+            json.dumps({'name': name, 'contents': contents}),
+            content_type='application/json')
+
+    def get_compare_cache_key(self, request, object_id, name):
+        from_id, to_id = self.get_compared_ids(request)
+        digest = hashlib.md5(force_bytes('%s:%s:%s:%s' % (
+            object_id, from_id, to_id, name))).hexdigest()
+        return 'simple_history:compare:%s:%s' % (self.model._meta.db_table,
+                                                 digest)
+
+    def get_compare_fields(self, request, object_id, prev, curr):
+        """List the fields of the compare view.
+
+        Unchanged fields are rendered right away, the diffs of changed
+        fields are fetched by the page from `compare_field_view`.
+        """
+        field_url = reverse(
+            '%s:%s_%s_simple_compare_field' % (
+                self.admin_site.name, self.model._meta.app_label,
+                self.model._meta.model_name),
+            args=[quote(object_id)])
+        fields = []
+        for field in self.model._meta.fields:
+            prev_value = getattr(prev, field.attname)
+            curr_value = getattr(curr, field.attname)
+            if prev_value == curr_value:
+                fields.append({
+                    'name': field.attname,
+                    'contents': generate_diff(prev_value, curr_value),
+                })
+            else:
+                fields.append({
+                    'name': field.attname,
+                    'diff_url': '%s?%s' % (field_url, urlencode({
+                        'from': prev.pk, 'to': curr.pk,
+                        'field': field.attname})),
+                })
+        return fields
 
     def save_model(self, request, obj, form, change):
         """Set special model attribute to user for reference after save"""
         obj._history_user = request.user
         super(SimpleHistoryAdmin, self).save_model(request, obj, form, change)
+
+
+def recent_changes_view(request, admin_site=None, extra_context=None,
+                        per_page=100):
+    """Recent changes of all the history tracked models of an admin site.
+
+    Only the models registered with `admin_site` which `request.user` may
+    change are listed.  Hook it up next to the admin urls, e.g.::
+
+        url(r'^admin/recent-changes/$',
+            admin.site.admin_view(recent_changes_view),
+            name='simple_history_recent_changes'),
+    """
+    admin_site = admin_site or admin.site
+    request.current_app = admin_site.name
+    user_id, history_type = _get_recent_changes_filters(request)
+    changes = recent_changes(
+        _get_recent_changes_models(request, admin_site),
+        after=parse_cursor(request.GET.get('after')), user_id=user_id,
+        history_type=history_type, chunk_size=per_page + 1)
+    page = list(islice(changes, per_page + 1))
+    action_list = [_get_recent_change_row(record, admin_site)
+                   for key, record in page[:per_page]]
+    older_page_url = None
+    if len(page) > per_page:
+        query = request.GET.copy()
+        query['after'] = format_cursor(page[per_page - 1][0])
+        older_page_url = '?%s' % query.urlencode()
+    context = {
+        'title': _('Recent changes'),
+        'action_list': action_list,
+        'older_page_url': older_page_url,
+        'user_id': user_id,
+        'history_type': history_type,
+    }
+    if hasattr(admin_site, 'each_context'):
+        try:
+            context.update(admin_site.each_context(request))
+        except TypeError:  # Django < 1.8
+            context.update(admin_site.each_context())
+    context.update(extra_context or {})
+    extra_kwargs = {}
+    if get_complete_version() < (1, 8):
+        extra_kwargs['current_app'] = request.current_app
+    return render(request, 'simple_history/recent_changes.html', context,
+                  **extra_kwargs)
+
+
+def _get_recent_changes_models(request, admin_site):
+    """The historical models `request.user` may see the changes of."""
+    history_models = {}
+    for model in registered_models.values():
+        model_admin = admin_site._registry.get(model)
+        if model_admin is None or not model_admin.has_change_permission(
+                request):
+            continue
+        history_model = getattr(
+            model, model._meta.simple_history_manager_attribute).model
+        history_models[history_model._meta.db_table] = history_model
+    return sorted(history_models.values(), key=get_history_label)
+
+
+def _get_recent_changes_filters(request):
+    """Read the ``user`` and ``type`` filters of the recent changes."""
+    try:
+        user_id = int(request.GET['user'])
+    except (KeyError, ValueError):
+        user_id = None
+    history_type = request.GET.get('type')
+    if history_type not in ('+', '~', '-'):
+        history_type = None
+    return user_id, history_type
+
+
+def _get_recent_change_row(record, admin_site):
+    """Set the history page url and model name shown for `record`."""
+    opts = record.instance_type._meta
+    try:
+        record.admin_history_url = reverse(
+            '%s:%s_%s_history' % (admin_site.name, opts.app_label,
+                                  opts.model_name),
+            args=(quote(getattr(record, opts.pk.attname)),))
+    except NoReverseMatch:
+        record.admin_history_url = None
+    record.admin_model_name = capfirst(force_text(opts.verbose_name))
+    return record
@@ -0,0 +1,132 @@
+"""
+Buffering of the historical records created while handling a request.
+
+Records are written at the end of the request, see
+`simple_history.middleware.HistoryBufferMiddleware`, with one ``bulk_create``
+per historical model, or one ``save`` per record when the historical model
+overrides it.
+Records created in a transaction are only buffered once it commits, so the
+records of rolled back changes are dropped.
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from timeit import default_timer
+
+from django.db import models, transaction
+
+from .cache import get_history_cache
+from .signals import post_create_historical_record
+from .stats import record_flush, timed_operation
+
+try:
+    on_commit = transaction.on_commit
+except AttributeError:  # Django < 1.9
+    on_commit = None
+
+
+class PendingRecord(object):
+    """Buffers a record once the transaction it was created in commits."""
+
+    def __init__(self, buffer, record, instance, using):
+        self.buffer = buffer
+        self.record = record
+        self.instance = instance
+        self.using = using
+        self.waiting = True
+
+    def __call__(self):
+        if self.waiting:
+            self.waiting = False
+            self.buffer.append(self.record, self.instance, self.using)
+
+
+class HistoryBuffer(object):
+
+    def __init__(self):
+        self.records = OrderedDict()
+        self.pending = []
+        self.flushed = False
+
+    def add(self, record, instance, using):
+        """Buffer the `record` of `instance` to be saved to `using`.
+
+        Returns False when the record must be saved right away.
+        """
+        if self.flushed:
+            return False
+        if transaction.get_connection(using).in_atomic_block:
+            if on_commit is None:
+                return False
+            pending = PendingRecord(self, record, instance, using)
+            self.pending.append(pending)
+            on_commit(pending, using=using)
+        else:
+            self.append(record, instance, using)
+        return True
+
+    def append(self, record, instance, using):
+        if self.flushed:  # committed after the end of the request
+            write_records(type(record), using, [(record, instance)])
+        else:
+            self.records.setdefault((type(record), using), []).append(
+                (record, instance))
+
+    def flush(self):
+        """Write the buffered records, one ``bulk_create`` per model.
+
+        The records of each database are written in one transaction.
+        Records of a transaction which is still open are written in it,
+        those of rolled back transactions are dropped.
+        """
+        open_callbacks = {}
+        for pending in self.pending:
+            if pending.waiting:
+                if pending.using not in open_callbacks:
+                    connection = transaction.get_connection(pending.using)
+                    open_callbacks[pending.using] = set(
+                        id(func) for sids, func in connection.run_on_commit)
+                if id(pending) in open_callbacks[pending.using]:
+                    pending()
+        self.pending = []
+        self.flushed = True
+        records, self.records = self.records, OrderedDict()
+        usings = OrderedDict()
+        for (history_model, using), model_records in records.items():
+            usings.setdefault(using, []).append((history_model, model_records))
+        for using, models_records in usings.items():
+            with transaction.atomic(using=using, savepoint=False):
+                for history_model, model_records in models_records:
+                    write_records(history_model, using, model_records)
+
+
+def write_records(history_model, using, items):
+    """Save the `(record, instance)` pairs of `history_model` at once.
+
+    Records of historical models overriding ``save``, e.g. in their
+    `bases`, are saved one by one instead, so the override is called.
+    """
+    records = [record for record, instance in items]
+    started = default_timer()
+    with timed_operation(history_model.instance_type, 'write_records'):
+        if overrides_save(history_model):
+            for record in records:
+                record.save(force_insert=True, using=using)
+        else:
+            history_model._default_manager.using(using).bulk_create(records)
+    record_flush(history_model, records, started)
+    for record, instance in items:
+        post_create_historical_record.send(
+            sender=type(instance), instance=instance,
+            history_instance=record, using=using)
+    history_cache = get_history_cache()
+    if history_cache is not None:
+        for record, instance in items:
+            history_cache.invalidate(history_model, instance.pk)
+
+
+def overrides_save(model):
+    """Whether `model` or one of its bases overrides ``Model.save``."""
+    save = getattr(model.save, '__func__', model.save)
+    return save is not getattr(models.Model.save, '__func__',
+                               models.Model.save)
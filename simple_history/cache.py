@@ -0,0 +1,215 @@
+"""
+Optional caching of ``most_recent`` and ``as_of`` results.
+
+Enabled with the ``SIMPLE_HISTORY_CACHE`` setting, e.g.::
+
+    SIMPLE_HISTORY_CACHE = {
+        'MAX_SIZE': 1000,   # entries kept by the process-local cache
+        'TIMEOUT': 60,      # seconds before an entry expires
+        'DATE_BUCKET': 60,  # round `as_of` dates down to the minute
+        'BACKEND': None,    # or a CACHES alias to share entries
+    }
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils.encoding import force_bytes
+from django.utils.timezone import utc
+
+try:
+    from django.core.cache import caches
+except ImportError:  # Django < 1.7
+    from django.core.cache import get_cache
+else:
+    get_cache = caches.__getitem__
+try:
+    from django.core.signals import setting_changed
+except ImportError:  # Django < 1.8
+    from django.test.signals import setting_changed
+
+
+class LocalHistoryCache(object):
+    """A process-local LRU cache with a time to live."""
+
+    def __init__(self, max_size=1000, timeout=60):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._keys_by_object = {}
+        self._lock = threading.Lock()
+
+    def make_key(self, history_model, pk, bucket):
+        return (history_model._meta.db_table, pk, bucket)
+
+    def get(self, key):
+        """Return the cached value, raise `KeyError` when missing."""
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            if self.timeout is not None and expires < time.time():
+                self._forget(key)
+                self.misses += 1
+                raise KeyError(key)
+            self._entries[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.timeout is not None:
+            expires = time.time() + self.timeout
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            self._keys_by_object.setdefault(key[:2], set()).add(key)
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                del self._entries[oldest]
+                self._forget(oldest)
+
+    def invalidate(self, history_model, pk):
+        with self._lock:
+            object_key = (history_model._meta.db_table, pk)
+            for key in self._keys_by_object.pop(object_key, ()):
+                self._entries.pop(key, None)
+
+    def invalidate_model(self, history_model):
+        table = history_model._meta.db_table
+        with self._lock:
+            for object_key in list(self._keys_by_object):
+                if object_key[0] == table:
+                    for key in self._keys_by_object.pop(object_key):
+                        self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_object.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'max_size': self.max_size,
+        }
+
+    def _forget(self, key):
+        self._entries.pop(key, None)
+        keys = self._keys_by_object.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_object[key[:2]]
+
+
+class DjangoHistoryCache(object):
+    """Stores entries in a Django cache shared by all workers.
+
+    Entries can't be deleted by object, so each object and each model has
+    a generation counter which is part of the entry keys and is bumped to
+    invalidate.
+    """
+
+    prefix = 'simple_history'
+
+    def __init__(self, alias='default', timeout=60):
+        self.cache = get_cache(alias)
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+    def _hash(self, *parts):
+        return hashlib.md5(force_bytes(repr(parts))).hexdigest()
+
+    def _generation_key(self, *parts):
+        return '%s:generation:%s' % (self.prefix, self._hash(*parts))
+
+    def make_key(self, history_model, pk, bucket):
+        table = history_model._meta.db_table
+        keys = [self._generation_key(table), self._generation_key(table, pk)]
+        generations = self.cache.get_many(keys)
+        return '%s:entry:%s' % (self.prefix, self._hash(
+            table, pk, [generations.get(key, 0) for key in keys], bucket))
+
+    def get(self, key):
+        value = self.cache.get(key)
+        if value is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.timeout)
+
+    def invalidate(self, history_model, pk):
+        self._bump(self._generation_key(history_model._meta.db_table, pk))
+
+    def invalidate_model(self, history_model):
+        self._bump(self._generation_key(history_model._meta.db_table))
+
+    def _bump(self, key):
+        if not self.cache.add(key, 1, None):
+            try:
+                self.cache.incr(key)
+            except ValueError:  # expired in between
+                self.cache.set(key, 1, None)
+
+    def clear(self):
+        self.hits = self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+_history_cache = None
+
+
+def get_history_cache():
+    """Return the configured history cache, or None when disabled."""
+    global _history_cache
+    if _history_cache is None:
+        config = getattr(settings, 'SIMPLE_HISTORY_CACHE', None)
+        if not config:
+            return None
+        if config.get('BACKEND'):
+            _history_cache = DjangoHistoryCache(
+                alias=config['BACKEND'], timeout=config.get('TIMEOUT', 60))
+        else:
+            _history_cache = LocalHistoryCache(
+                max_size=config.get('MAX_SIZE', 1000),
+                timeout=config.get('TIMEOUT', 60))
+    return _history_cache
+
+
+def get_date_bucket(date):
+    """Round `date` down to the configured ``DATE_BUCKET`` seconds."""
+    config = getattr(settings, 'SIMPLE_HISTORY_CACHE', None) or {}
+    bucket = config.get('DATE_BUCKET')
+    if not bucket:
+        return date
+    epoch = datetime(1970, 1, 1, tzinfo=date.tzinfo and utc)
+    offset = (date - epoch).total_seconds() % bucket
+    return date - timedelta(seconds=offset)
+
+
+def reset_history_cache(**kwargs):
+    global _history_cache
+    if kwargs.get('setting', 'SIMPLE_HISTORY_CACHE') == 'SIMPLE_HISTORY_CACHE':
+        _history_cache = None
+
+
+setting_changed.connect(reset_history_cache)
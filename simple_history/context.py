@@ -0,0 +1,51 @@
+"""
+State local to the request being handled, like the request itself.
+
+With context variables (Python 3.7+, or the ``contextvars`` backport),
+values set while handling a request stay with it when an async server or
+greenlets switch between requests on one thread, and copies of the context
+don't see later changes.  Without them, a `threading.local` is used.
+"""
+from __future__ import unicode_literals
+
+import threading
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # Python < 3.7
+    ContextVar = None
+
+
+class ContextLocal(object):
+    """An object whose attributes are local to the current context."""
+
+    def __init__(self, name):
+        # Set values are never mutated, copies of the context could share
+        # them, so every change stores a new dict.
+        object.__setattr__(self, '_values', ContextVar(name, default={}))
+
+    def __getattr__(self, name):
+        try:
+            return self._values.get()[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        values = dict(self._values.get())
+        values[name] = value
+        self._values.set(values)
+
+    def __delattr__(self, name):
+        values = dict(self._values.get())
+        try:
+            del values[name]
+        except KeyError:
+            raise AttributeError(name)
+        self._values.set(values)
+
+
+def context_local(name):
+    """Return a `ContextLocal`, or a `threading.local` without contextvars."""
+    if ContextVar is None:
+        return threading.local()
+    return ContextLocal(name)
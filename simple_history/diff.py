@@ -0,0 +1,82 @@
+"""
+Word level diffs of field values, rendered as HTML for the compare view.
+"""
+from __future__ import unicode_literals
+
+import difflib
+import re
+
+from django.conf import settings
+from django.utils import six
+from django.utils.html import escape
+
+# Above this many differing tokens, SequenceMatcher (roughly quadratic) is
+# skipped and the differing middle is shown as one removal and one addition.
+DIFF_MAX_TOKENS = getattr(settings, 'SIMPLE_HISTORY_DIFF_MAX_TOKENS', 5000)
+
+TOKEN_RE = re.compile(r'(\W)', re.UNICODE)
+
+REMOVED = '<span class="compare-removed">{0}</span>'
+ADDED = '<span class="compare-added">{0}</span>'
+UNCHANGED = '<span class="compare-unchanged">{0}</span>'
+
+
+def generate_diff(prev, curr, max_tokens=None):
+    """Return HTML markup of the changes between `prev` and `curr`."""
+    if max_tokens is None:
+        max_tokens = DIFF_MAX_TOKENS
+    if not (isinstance(prev, six.string_types) and
+            isinstance(curr, six.string_types)):
+        if prev != curr:
+            return '{0}<br>{1}'.format(REMOVED.format(escape(prev)),
+                                       ADDED.format(escape(curr)))
+        return escape(curr)
+    if prev == curr:
+        return UNCHANGED.format(escape(curr)) if curr else ''
+
+    prev_tokens = TOKEN_RE.split(prev)
+    curr_tokens = TOKEN_RE.split(curr)
+    # Trimming the common ends is linear and usually leaves little to match.
+    start = 0
+    limit = min(len(prev_tokens), len(curr_tokens))
+    while start < limit and prev_tokens[start] == curr_tokens[start]:
+        start += 1
+    end = 0
+    limit -= start
+    while (end < limit and
+           prev_tokens[-1 - end] == curr_tokens[-1 - end]):
+        end += 1
+    prev_middle = prev_tokens[start:len(prev_tokens) - end]
+    curr_middle = curr_tokens[start:len(curr_tokens) - end]
+
+    parts = []
+    _unchanged(parts, prev_tokens[:start])
+    if len(prev_middle) + len(curr_middle) > max_tokens:
+        _removed(parts, prev_middle)
+        _added(parts, curr_middle)
+    else:
+        matcher = difflib.SequenceMatcher(None, prev_middle, curr_middle,
+                                          autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                _unchanged(parts, curr_middle[j1:j2])
+            else:
+                _removed(parts, prev_middle[i1:i2])
+                _added(parts, curr_middle[j1:j2])
+    _unchanged(parts, curr_tokens[len(curr_tokens) - end:])
+    return ''.join(parts)
+
+
+def _removed(parts, tokens):
+    if tokens:
+        parts.append(REMOVED.format(escape(''.join(tokens))))
+
+
+def _added(parts, tokens):
+    if tokens:
+        parts.append(ADDED.format(escape(''.join(tokens))))
+
+
+def _unchanged(parts, tokens):
+    if tokens:
+        parts.append(UNCHANGED.format(escape(''.join(tokens))))
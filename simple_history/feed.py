@@ -0,0 +1,105 @@
+"""
+Recent changes across several historical models, newest first.
+
+Every history table is read in small keyset pages which are merged lazily
+with a heap, so a page of the feed costs one short query per table instead
+of a union of the whole tables.
+"""
+from __future__ import unicode_literals
+
+import heapq
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+class _Newest(object):
+    """Inverts the ordering of a merge key, `heapq` only keeps min-heaps."""
+
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+
+def get_history_label(history_model):
+    opts = history_model._meta
+    return '%s.%s' % (opts.app_label, opts.model_name)
+
+
+def recent_changes(history_models, after=None, user_id=None,
+                   history_type=None, chunk_size=100):
+    """Yield `(key, record)` for the records of all `history_models`.
+
+    Records are ordered by descending `(history_date, label, history_id)`
+    keys, where `label` is the `app_label.model_name` of the historical
+    model.  Passing the key of the last record seen as `after` resumes the
+    feed right after it.  The `user_id` and `history_type` filters are
+    applied by each table's query.
+    """
+    filters = {}
+    if user_id is not None:
+        filters['history_user_id'] = user_id
+    if history_type is not None:
+        filters['history_type'] = history_type
+    heap = []
+    for index, history_model in enumerate(history_models):
+        stream = _table_changes(history_model, after, filters, chunk_size)
+        _push(heap, index, stream)
+    while heap:
+        key, index, record, stream = heapq.heappop(heap)
+        yield key.key, record
+        _push(heap, index, stream)
+
+
+def _push(heap, index, stream):
+    for key, record in stream:
+        heapq.heappush(heap, (_Newest(key), index, record, stream))
+        return
+
+
+def _table_changes(history_model, after, filters, chunk_size):
+    label = get_history_label(history_model)
+    queryset = history_model._default_manager.filter(**filters).order_by(
+        '-history_date', '-history_id').select_related('history_user')
+    while True:
+        page = queryset
+        if after is not None:
+            page = page.filter(_after_q(label, after))
+        records = list(page[:chunk_size])
+        for record in records:
+            yield (record.history_date, label, record.history_id), record
+        if len(records) < chunk_size:
+            return
+        after = (records[-1].history_date, label, records[-1].history_id)
+
+
+def _after_q(label, after):
+    """Match the records of the `label` table that come after `after`."""
+    date, after_label, history_id = after
+    if label < after_label:
+        return Q(history_date__lte=date)
+    if label > after_label:
+        return Q(history_date__lt=date)
+    return Q(history_date__lt=date) | Q(history_date=date,
+                                        history_id__lt=history_id)
+
+
+def format_cursor(key):
+    date, label, history_id = key
+    return '%s|%s|%s' % (date.isoformat(), label, history_id)
+
+
+def parse_cursor(cursor):
+    """Return the key encoded by `format_cursor`, or None when invalid."""
+    try:
+        date, label, history_id = cursor.split('|')
+        date, history_id = parse_datetime(date), int(history_id)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if date is None:
+        return None
+    return date, label, history_id
@@ -0,0 +1,122 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ... import models
+from . import _populate_utils as utils
+
+
+class HistoryModelCommand(BaseCommand):
+    """Base of the commands processing the history of some models.
+
+    The models are given as ``app.model`` labels, or found with the
+    ``--auto`` option, and returned by `_get_models` along with their
+    historical model.  Subclasses declare the options they honour.
+    """
+    args = "<app.model app.model ...>"
+
+    COMMAND_HINT = "Please specify a model or use the --auto option"
+    MODEL_NOT_FOUND = "Unable to find model"
+    MODEL_NOT_HISTORICAL = "No history model found"
+    NO_REGISTERED_MODELS = "No registered models were found\n"
+    INVALID_MODEL_ARG = "An invalid model was specified"
+    INVALID_DATE = "Unable to parse date"
+
+    if hasattr(BaseCommand, 'option_list'):  # Django < 1.8
+        option_list = BaseCommand.option_list + (
+            make_option('--auto', action='store_true', dest='auto',
+                        default=False),
+            make_option('--batchsize', action='store', dest='batchsize',
+                        default=200, type=int),
+        )
+
+    def add_arguments(self, parser):
+        super(HistoryModelCommand, self).add_arguments(parser)
+        parser.add_argument('models', nargs='*', type=str)
+        parser.add_argument(
+            '--auto',
+            action='store_true',
+            dest='auto',
+            default=False,
+            help='Automatically search for models with the '
+                 'HistoricalRecords field type',
+        )
+        parser.add_argument(
+            '--batchsize',
+            action='store',
+            dest='batchsize',
+            default=200,
+            type=int,
+            help='Set a custom batch size when processing records.',
+        )
+
+    def _get_models(self, *args, **options):
+        to_process = set()
+        model_strings = options.get('models', []) or args
+
+        if model_strings:
+            for model_pair in self._handle_model_list(*model_strings):
+                to_process.add(model_pair)
+
+        elif options['auto']:
+            for model in models.registered_models.values():
+                try:    # avoid issues with mutli-table inheritance
+                    history_model = utils.get_history_model_for_model(model)
+                except utils.NotHistorical:
+                    continue
+                to_process.add((model, history_model))
+            if not to_process:
+                self.stdout.write(self.NO_REGISTERED_MODELS)
+
+        else:
+            self.stdout.write(self.COMMAND_HINT)
+
+        return to_process
+
+    def _handle_model_list(self, *args):
+        failing = False
+        for natural_key in args:
+            try:
+                model, history = self._model_from_natural_key(natural_key)
+            except ValueError as e:
+                failing = True
+                self.stderr.write("{error}\n".format(error=e))
+            else:
+                if not failing:
+                    yield (model, history)
+        if failing:
+            raise CommandError(self.INVALID_MODEL_ARG)
+
+    def _model_from_natural_key(self, natural_key):
+        try:
+            app_label, model = natural_key.split(".", 1)
+        except ValueError:
+            model = None
+        else:
+            try:
+                model = utils.get_model(app_label, model)
+            except LookupError:  # Django >= 1.7
+                model = None
+        if not model:
+            raise ValueError(self.MODEL_NOT_FOUND +
+                             " < {model} >\n".format(model=natural_key))
+        try:
+            history_model = utils.get_history_model_for_model(model)
+        except utils.NotHistorical:
+            raise ValueError(self.MODEL_NOT_HISTORICAL +
+                             " < {model} >\n".format(model=natural_key))
+        return model, history_model
+
+    def _parse_date(self, value):
+        if not value:
+            return None
+        date = parse_datetime(value)
+        if date is None:
+            raise CommandError("{msg} < {date} >".format(
+                msg=self.INVALID_DATE, date=value))
+        if settings.USE_TZ and timezone.is_naive(date):
+            date = timezone.make_aware(date, timezone.get_current_timezone())
+        return date
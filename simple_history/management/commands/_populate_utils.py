@@ -1,5 +1,31 @@
+import binascii
+import json
+import multiprocessing
+import time
+from timeit import default_timer
+
+import django
+from django.db import DatabaseError, connections, router, transaction
+from django.db.models import Max, Min
+from django.utils import six
+from django.utils.encoding import force_text
 from django.utils.timezone import now
 
+from ...cache import get_history_cache
+from ...stats import FIELD_WIDTHS, record_flush, timed_operation
+
+try:
+    from django.apps import apps
+except ImportError:  # Django < 1.7
+    from django.db.models.loading import get_model
+else:
+    get_model = apps.get_model
+
+if six.PY3:
+    BINARY_TYPES = (bytes, bytearray, memoryview)
+else:  # str is text, binary values are read as buffers
+    BINARY_TYPES = (bytearray, memoryview, six.moves.builtins.buffer)
+
 
 class NotHistorical(TypeError):
     """No related history model found."""
@@ -15,15 +41,395 @@ def get_history_model_for_model(model):
     return getattr(model, manager_name).model
 
 
-def bulk_history_create(model, history_model, batch_size):
-    """Save a copy of all instances to the historical model."""
-    historical_instances = [
-        history_model(
-            history_date=getattr(instance, '_history_date', now()),
-            history_user=getattr(instance, '_history_user', None),
-            **{
-                field.attname: getattr(instance, field.attname)
-                for field in instance._meta.fields
-            }
-        ) for instance in model.objects.all()]
-    history_model.objects.bulk_create(historical_instances, batch_size=batch_size)
+def bulk_history_create(model, history_model, batch_size, start_pk=None,
+                        end_pk=None, after_pk=None, missing_only=False,
+                        on_batch=None):
+    """Save a copy of all instances to the historical model.
+
+    Instances are read in primary key order, one page of `batch_size`
+    instances at a time, and each page is saved with one `bulk_create`, so
+    memory use doesn't grow with the size of the table.  `start_pk` and
+    `end_pk` restrict the copy to the ``[start_pk, end_pk)`` range and
+    `after_pk` resumes it after a primary key.  With `missing_only`, only
+    the instances without any historical record are copied.  `on_batch` is
+    called with the last primary key and the running count after each
+    page.  Returns the number of historical records created.
+    """
+    queryset = _source_queryset(model, history_model, start_pk, end_pk,
+                                missing_only)
+    attnames = [field.attname for field in model._meta.fields]
+    count = 0
+    last_pk = after_pk
+    while True:
+        page = queryset
+        if last_pk is not None:
+            page = page.filter(pk__gt=last_pk)
+        historical_instances = [
+            history_model(
+                history_date=getattr(instance, '_history_date', now()),
+                history_user=getattr(instance, '_history_user', None),
+                **{attname: getattr(instance, attname) for attname in attnames}
+            ) for instance in page[:batch_size].iterator()]
+        if not historical_instances:
+            return count
+        with timed_operation(model, 'bulk_history_create'):
+            started = default_timer()
+            history_model.objects.bulk_create(historical_instances,
+                                              batch_size=batch_size)
+            record_flush(history_model, historical_instances, started)
+        invalidate_history_cache(history_model)
+        count += len(historical_instances)
+        last_pk = getattr(historical_instances[-1],
+                          model._meta.pk.attname)
+        if on_batch is not None:
+            on_batch(last_pk, count)
+
+
+def _source_queryset(model, history_model, start_pk, end_pk, missing_only):
+    queryset = model._default_manager.order_by('pk')
+    if start_pk is not None:
+        queryset = queryset.filter(pk__gte=start_pk)
+    if end_pk is not None:
+        queryset = queryset.filter(pk__lt=end_pk)
+    if missing_only:
+        queryset = without_history(queryset, history_model)
+    return queryset
+
+
+def get_fast_strategy(model, history_model):
+    """Return the fastest way to copy the rows of `model` to its history.
+
+    ``insert_select`` copies the rows with ``INSERT ... SELECT``
+    statements when both tables live in the same database, otherwise
+    PostgreSQL uses ``copy`` and the other backends ``executemany``.
+    """
+    alias = router.db_for_write(history_model)
+    vendor = connections[alias].vendor
+    if (alias == router.db_for_read(model) and
+            vendor in ('sqlite', 'postgresql', 'mysql')):
+        return 'insert_select'
+    if vendor == 'postgresql':
+        return 'copy'
+    return 'executemany'
+
+
+def fast_history_create(model, history_model, batch_size, start_pk=None,
+                        end_pk=None, after_pk=None, missing_only=False,
+                        on_batch=None, strategy=None):
+    """Like `bulk_history_create`, without building model instances.
+
+    Rows are copied as the database returns them with the given
+    `strategy`, see `get_fast_strategy`, one range of `batch_size`
+    primary keys at a time.  The fields only found on the historical
+    model get their default, and ``history_date`` the current time.
+    Returns the number of historical records created.
+    """
+    if strategy is None:
+        strategy = get_fast_strategy(model, history_model)
+    queryset = _source_queryset(model, history_model, start_pk, end_pk,
+                                missing_only)
+    attnames = [field.attname for field in model._meta.fields]
+    connection = connections[router.db_for_write(history_model)]
+    target = _HistoryTable(model, history_model, attnames, connection)
+    copy_batch = (_insert_select_batch if strategy == 'insert_select'
+                  else _insert_rows_batch)
+    count = 0
+    last_pk = after_pk
+    while True:
+        page = queryset
+        if last_pk is not None:
+            page = page.filter(pk__gt=last_pk)
+        with timed_operation(model, 'fast_history_create'):
+            created, last_pk = copy_batch(page, target, batch_size,
+                                          strategy)
+        if created:
+            count += created
+            invalidate_history_cache(history_model)
+            if on_batch is not None:
+                on_batch(last_pk, count)
+        if created < batch_size:
+            return count
+
+
+class _HistoryTable(object):
+    """The columns `fast_history_create` writes to a history table."""
+
+    def __init__(self, model, history_model, attnames, connection):
+        self.attnames = attnames
+        self.pk_index = attnames.index(model._meta.pk.attname)
+        self.connection = connection
+        qn = connection.ops.quote_name
+        history_fields = dict((field.attname, field)
+                              for field in history_model._meta.fields)
+        columns = [history_fields[attname].column for attname in attnames]
+        self.extra_values = []
+        date = now()
+        for field in history_model._meta.fields:
+            if field.attname in attnames or field.primary_key:
+                continue
+            if field.attname == 'history_date':
+                value = date
+            else:
+                value = field.get_default()
+            columns.append(field.column)
+            self.extra_values.append(field.get_db_prep_save(value,
+                                                            connection))
+        self.table = qn(history_model._meta.db_table)
+        self.columns = ', '.join(qn(column) for column in columns)
+
+
+def _insert_select_batch(page, target, batch_size, strategy):
+    """Copy the next `batch_size` rows of `page` with ``INSERT ... SELECT``.
+
+    The primary key closing the batch is looked up first, so that each
+    statement copies a range of primary keys.  Returns the number of rows
+    copied and the last primary key.
+    """
+    try:
+        last_pk = page.values_list('pk', flat=True)[batch_size - 1]
+    except IndexError:
+        last_pk = page.aggregate(last_pk=Max('pk'))['last_pk']
+        if last_pk is None:
+            return 0, None
+    select_sql, params = _as_sql(page.filter(pk__lte=last_pk).order_by()
+                                 .values_list(*target.attnames))
+    sql = 'INSERT INTO {table} ({columns}) SELECT T.*{extra} FROM ' \
+          '({select}) T'.format(
+              table=target.table, columns=target.columns, select=select_sql,
+              extra=''.join(', %s' for value in target.extra_values))
+    cursor = target.connection.cursor()
+    try:
+        cursor.execute(sql, list(target.extra_values) + list(params))
+        return cursor.rowcount, last_pk
+    finally:
+        cursor.close()
+
+
+def _insert_rows_batch(page, target, batch_size, strategy):
+    """Read the next `batch_size` rows of `page` and write them.
+
+    Rows are written with ``COPY FROM STDIN`` with the ``copy`` strategy,
+    and with ``executemany`` otherwise.  Returns the number of rows
+    written and the last primary key.
+    """
+    cursor = connections[page.db].cursor()
+    try:
+        cursor.execute(*_as_sql(
+            page.values_list(*target.attnames)[:batch_size]))
+        rows = [tuple(row) + tuple(target.extra_values)
+                for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+    if not rows:
+        return 0, None
+    cursor = target.connection.cursor()
+    try:
+        if strategy == 'copy':
+            cursor.copy_expert(
+                'COPY {table} ({columns}) FROM STDIN'.format(
+                    table=target.table, columns=target.columns),
+                six.StringIO(''.join(
+                    '\t'.join(_copy_value(value) for value in row) + '\n'
+                    for row in rows)))
+        else:
+            cursor.executemany(
+                'INSERT INTO {table} ({columns}) VALUES ({values})'.format(
+                    table=target.table, columns=target.columns,
+                    values=', '.join(['%s'] * len(rows[0]))),
+                rows)
+    finally:
+        cursor.close()
+    return len(rows), rows[-1][target.pk_index]
+
+
+def invalidate_history_cache(history_model):
+    """Drop the cached history of every instance of `history_model`."""
+    history_cache = get_history_cache()
+    if history_cache is not None:
+        history_cache.invalidate_model(history_model)
+
+
+def _as_sql(queryset):
+    return queryset.query.get_compiler(using=queryset.db).as_sql()
+
+
+def _copy_value(value):
+    """Format a value for the text format of PostgreSQL's COPY."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, BINARY_TYPES):
+        return '\\\\x' + force_text(binascii.hexlify(value))
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return force_text(value).replace('\\', '\\\\').replace(
+        '\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def without_history(queryset, history_model):
+    """Exclude the instances having a historical record, with an anti-join."""
+    model = queryset.model
+    qn = connections[queryset.db].ops.quote_name
+    pk_column = model._meta.pk.column
+    history_pk_column = history_model._meta.get_field(
+        model._meta.pk.attname).column
+    return queryset.extra(where=[
+        'NOT EXISTS (SELECT 1 FROM {history} WHERE {history}.{history_pk} '
+        '= {table}.{pk})'.format(
+            history=qn(history_model._meta.db_table),
+            history_pk=qn(history_pk_column),
+            table=qn(model._meta.db_table), pk=qn(pk_column))])
+
+
+def get_pk_ranges(model, parts):
+    """Split the primary keys of `model` in up to `parts` ranges.
+
+    Returns ``(start_pk, end_pk)`` pairs for `bulk_history_create`.  Tables
+    without integer primary keys aren't split.
+    """
+    bounds = model._default_manager.aggregate(low=Min('pk'), high=Max('pk'))
+    low, high = bounds['low'], bounds['high']
+    if not (isinstance(low, six.integer_types) and
+            isinstance(high, six.integer_types)) or parts < 2:
+        return [(None, None)]
+    step = max((high - low) // parts + 1, 1)
+    return [(start, start + step) for start in range(low, high + 1, step)]
+
+
+def estimate_row_count(model):
+    """Estimate the rows of `model`'s table without scanning it.
+
+    Uses the planner statistics of PostgreSQL, MySQL or SQLite (after
+    ``ANALYZE``), and otherwise the span of integer primary keys, read
+    from the index.  Returns None when no estimate is available.
+    """
+    alias = router.db_for_read(model)
+    stats = _catalog_stats(connections[alias], model._meta.db_table)
+    if stats is not None:
+        return stats[0]
+    bounds = model._default_manager.using(alias).aggregate(low=Min('pk'),
+                                                           high=Max('pk'))
+    low, high = bounds['low'], bounds['high']
+    if low is None:
+        return 0
+    if isinstance(low, six.integer_types):
+        return high - low + 1
+    return None
+
+
+def estimate_row_width(model, history_model):
+    """Estimate the size in bytes of a historical record of `model`.
+
+    The average width of `model`'s rows comes from the catalog when the
+    database keeps it, and is otherwise guessed from the field types.
+    """
+    alias = router.db_for_read(model)
+    stats = _catalog_stats(connections[alias], model._meta.db_table)
+    attnames = set(field.attname for field in model._meta.fields)
+    if stats is not None and stats[1]:
+        width = stats[1]
+    else:
+        width = sum(_field_width(field) for field in model._meta.fields)
+    return width + sum(_field_width(field)
+                       for field in history_model._meta.fields
+                       if field.attname not in attnames)
+
+
+def _field_width(field):
+    internal_type = field.get_internal_type()
+    if internal_type in FIELD_WIDTHS:
+        return FIELD_WIDTHS[internal_type]
+    # Variable length values rarely fill their column
+    return max((getattr(field, 'max_length', None) or 32) // 2, 1)
+
+
+def _catalog_stats(connection, table):
+    """Return the ``(rows, average row width)`` the catalog knows of."""
+    vendor = connection.vendor
+    if vendor == 'postgresql':
+        sql = ("SELECT reltuples, CASE WHEN reltuples > 0 THEN "
+               "pg_relation_size(oid) / reltuples END "
+               "FROM pg_class WHERE oid = %s::regclass")
+        params = [connection.ops.quote_name(table)]
+    elif vendor == 'mysql':
+        sql = ("SELECT table_rows, avg_row_length "
+               "FROM information_schema.tables "
+               "WHERE table_schema = DATABASE() AND table_name = %s")
+        params = [table]
+    elif vendor == 'sqlite':
+        sql = "SELECT stat, NULL FROM sqlite_stat1 WHERE tbl = %s LIMIT 1"
+        params = [table]
+    else:
+        return None
+    try:
+        with transaction.atomic(using=connection.alias):
+            cursor = connection.cursor()
+            try:
+                cursor.execute(sql, params)
+                row = cursor.fetchone()
+            finally:
+                cursor.close()
+    except DatabaseError:  # no statistics gathered yet
+        return None
+    if row is None or row[0] is None:
+        return None
+    rows = row[0]
+    if vendor == 'sqlite':  # "<rows> <rows per key>..."
+        rows = rows.split()[0]
+    rows = int(float(rows))
+    if rows < 0:  # never analyzed
+        return None
+    return rows, row[1] and int(row[1])
+
+
+def supports_parallel_writes(alias='default'):
+    # SQLite has a single writer and in-memory databases aren't shared
+    return connections[alias].vendor != 'sqlite'
+
+
+def populate_range(task):
+    """Populate one primary key range of a model, in its own transaction.
+
+    `task` is a ``(model label, batch size, start pk, end pk, missing
+    only, fast)`` tuple, so it can be sent to a worker process.  Returns
+    the worker's name, the model label, the number of records created and
+    the time spent.
+    """
+    label, batch_size, start_pk, end_pk, missing_only, fast = task
+    model = get_model(*label.split('.', 1))
+    history_model = get_history_model_for_model(model)
+    create = fast_history_create if fast else bulk_history_create
+    started = time.time()
+    with transaction.atomic(using=router.db_for_write(history_model)):
+        count = create(model, history_model, batch_size, start_pk, end_pk,
+                       missing_only=missing_only)
+    return (multiprocessing.current_process().name, label, count,
+            time.time() - started)
+
+
+def populate_in_workers(tasks, workers):
+    """Run `populate_range` on `tasks` with a pool of worker processes.
+
+    Yields the results as the ranges complete.  The connections are closed
+    first so that each worker opens its own.
+    """
+    if workers < 2 or not supports_parallel_writes():
+        for task in tasks:
+            yield populate_range(task)
+        return
+    for connection in connections.all():
+        connection.close()
+    pool = multiprocessing.Pool(workers, initializer=_setup_worker)
+    try:
+        for result in pool.imap_unordered(populate_range, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _setup_worker():
+    # Processes which aren't forked start without a configured Django
+    if hasattr(django, 'setup') and not apps.ready:
+        django.setup()
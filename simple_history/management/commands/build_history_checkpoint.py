@@ -0,0 +1,48 @@
+from optparse import make_option
+
+from django.utils import timezone
+
+from ._base import HistoryModelCommand
+
+
+class Command(HistoryModelCommand):
+    help = ("Stores a snapshot of every object of a model in its history "
+            "checkpoint table, to speed up `as_of` queries")
+
+    NO_CHECKPOINT_TABLE = "No checkpoint table found, skipping model"
+    DONE_BUILDING_FOR_MODEL = (
+        "Stored checkpoint of {count} objects for {model}\n")
+
+    if hasattr(HistoryModelCommand, 'option_list'):  # Django < 1.8
+        option_list = HistoryModelCommand.option_list + (
+            make_option('--date', action='store', dest='date', default=None),
+        )
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--date',
+            action='store',
+            dest='date',
+            default=None,
+            help='Date of the checkpoint, defaults to now.',
+        )
+
+    def handle(self, *args, **options):
+        self.date = self._parse_date(options.get('date')) or timezone.now()
+        self._process(self._get_models(*args, **options),
+                      options['batchsize'])
+
+    def _process(self, to_process, batch_size):
+        for model, history_model in to_process:
+            if getattr(history_model, 'checkpoint_model', None) is None:
+                self.stderr.write("{msg} {model}\n".format(
+                    msg=self.NO_CHECKPOINT_TABLE,
+                    model=model,
+                ))
+                continue
+            manager = getattr(model,
+                              model._meta.simple_history_manager_attribute)
+            count = manager.build_checkpoint(self.date, batch_size=batch_size)
+            self.stdout.write(self.DONE_BUILDING_FOR_MODEL.format(
+                count=count, model=model))
@@ -0,0 +1,180 @@
+import csv
+import gzip
+import io
+import json
+import time
+from optparse import make_option
+
+from django.core.management.base import CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import six
+from django.utils.encoding import force_text
+
+from ._base import HistoryModelCommand
+
+
+class Command(HistoryModelCommand):
+    help = ("Streams the historical records of models as CSV or JSON lines "
+            "to stdout or a file")
+
+    GZIP_NEEDS_OUTPUT = "The --gzip option requires --output"
+    PROGRESS = "Exported {count} records of {model} ({rate:.0f} records/s)\n"
+    PROGRESS_EVERY = 10000
+
+    if hasattr(HistoryModelCommand, 'option_list'):  # Django < 1.8
+        option_list = HistoryModelCommand.option_list + (
+            make_option('--format', action='store', dest='format',
+                        default='jsonl', type='choice',
+                        choices=['csv', 'jsonl']),
+            make_option('--output', action='store', dest='output',
+                        default=None),
+            make_option('--gzip', action='store_true', dest='gzip',
+                        default=False),
+            make_option('--start', action='store', dest='start',
+                        default=None),
+            make_option('--end', action='store', dest='end', default=None),
+            make_option('--pk', action='append', dest='pks', default=None),
+        )
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--format',
+            action='store',
+            dest='format',
+            default='jsonl',
+            choices=['csv', 'jsonl'],
+            help='Output format, defaults to JSON lines.',
+        )
+        parser.add_argument(
+            '--output',
+            action='store',
+            dest='output',
+            default=None,
+            help='File to write to, defaults to stdout.',
+        )
+        parser.add_argument(
+            '--gzip',
+            action='store_true',
+            dest='gzip',
+            default=False,
+            help='Compress the output file with gzip.',
+        )
+        parser.add_argument(
+            '--start',
+            action='store',
+            dest='start',
+            default=None,
+            help='Only export records with a history_date from this date.',
+        )
+        parser.add_argument(
+            '--end',
+            action='store',
+            dest='end',
+            default=None,
+            help='Only export records with a history_date before this date.',
+        )
+        parser.add_argument(
+            '--pk',
+            action='append',
+            dest='pks',
+            default=None,
+            help='Only export records of the object with this primary key. '
+                 'Can be repeated.',
+        )
+
+    def handle(self, *args, **options):
+        self.format = options.get('format') or 'jsonl'
+        self.start = self._parse_date(options.get('start'))
+        self.end = self._parse_date(options.get('end'))
+        self.pks = options.get('pks')
+        output = options.get('output')
+        if options.get('gzip') and not output:
+            raise CommandError(self.GZIP_NEEDS_OUTPUT)
+        to_process = self._get_models(*args, **options)
+        if output is None:
+            self.output = None
+            self._process(to_process, options['batchsize'])
+            return
+        if options.get('gzip'):
+            self.output = io.TextIOWrapper(gzip.open(output, 'wb'),
+                                           encoding='utf-8', newline='')
+        else:
+            self.output = io.open(output, 'w', encoding='utf-8', newline='')
+        try:
+            self._process(to_process, options['batchsize'])
+        finally:
+            self.output.close()
+
+    def _write(self, text):
+        if self.output is None:
+            self.stdout.write(text, ending='')
+        else:
+            self.output.write(six.text_type(text))
+
+    def _process(self, to_process, batch_size):
+        for model, history_model in to_process:
+            started = time.time()
+            count = 0
+            for count in self._export(model, history_model, batch_size):
+                if count % self.PROGRESS_EVERY == 0:
+                    self._progress(history_model, count, started)
+            self._progress(history_model, count, started)
+
+    def _progress(self, history_model, count, started):
+        elapsed = max(time.time() - started, 1e-6)
+        self.stderr.write(self.PROGRESS.format(
+            count=count, model=history_model._meta.object_name,
+            rate=count / elapsed))
+
+    def _export(self, model, history_model, batch_size):
+        """Write the records of `history_model`, yielding the running count.
+
+        Records are read in `history_id` order, one page of `batch_size`
+        records at a time, so memory use doesn't grow with the table.
+        """
+        label = '%s.%s' % (history_model._meta.app_label,
+                           history_model._meta.model_name)
+        attnames = [field.attname for field in history_model._meta.fields]
+        queryset = history_model._default_manager.order_by('history_id')
+        if self.start is not None:
+            queryset = queryset.filter(history_date__gte=self.start)
+        if self.end is not None:
+            queryset = queryset.filter(history_date__lt=self.end)
+        if self.pks:
+            queryset = queryset.filter(**{
+                '%s__in' % model._meta.pk.attname: self.pks})
+        if self.format == 'csv':
+            self._write_csv_rows([['model'] + attnames])
+        history_id_index = attnames.index('history_id')
+        count = 0
+        last_history_id = None
+        while True:
+            page = queryset
+            if last_history_id is not None:
+                page = page.filter(history_id__gt=last_history_id)
+            rows = list(page.values_list(*attnames)[:batch_size])
+            if not rows:
+                break
+            if self.format == 'csv':
+                self._write_csv_rows([label] + list(row) for row in rows)
+            else:
+                self._write(''.join(
+                    json.dumps({
+                        'model': label,
+                        'pk': row[history_id_index],
+                        'fields': dict(zip(attnames, row)),
+                    }, cls=DjangoJSONEncoder) + '\n'
+                    for row in rows))
+            for row in rows:
+                count += 1
+                yield count
+            last_history_id = rows[-1][history_id_index]
+
+    def _write_csv_rows(self, rows):
+        buffer = six.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(['' if value is None else force_text(value)
+                             for value in row])
+        self._write(buffer.getvalue())
@@ -1,123 +1,286 @@
+import json
+import os
+import tempfile
+import time
 from optparse import make_option
 
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
+from django.core.serializers.json import DjangoJSONEncoder
 
-try:
-    from django.apps import apps
-except ImportError:  # Django < 1.7
-    from django.db.models.loading import get_model
-else:
-    get_model = apps.get_model
-
-from ... import models
 from . import _populate_utils as utils
+from ._base import HistoryModelCommand
+
+try:
+    replace_file = os.replace
+except AttributeError:  # Python 2, renaming replaces the file on POSIX
+    replace_file = os.rename
 
 
-class Command(BaseCommand):
-    args = "<app.model app.model ...>"
+class Command(HistoryModelCommand):
     help = ("Populates the corresponding HistoricalRecords field with "
             "the current state of all instances in a model")
 
-    COMMAND_HINT = "Please specify a model or use the --auto option"
-    MODEL_NOT_FOUND = "Unable to find model"
-    MODEL_NOT_HISTORICAL = "No history model found"
-    NO_REGISTERED_MODELS = "No registered models were found\n"
     START_SAVING_FOR_MODEL = "Saving historical records for {model}\n"
     DONE_SAVING_FOR_MODEL = "Finished saving historical records for {model}\n"
     EXISTING_HISTORY_FOUND = "Existing history found, skipping model"
-    INVALID_MODEL_ARG = "An invalid model was specified"
+    RESUME_NEEDS_CHECKPOINT_FILE = ("The --resume option requires "
+                                    "--checkpoint-file")
+    RESUME_WITH_WORKERS = "The --resume option can't be used with --workers"
+    CHECKPOINT_FILE_WITH_WORKERS = ("The --checkpoint-file option can't be "
+                                    "used with --workers")
+    ALREADY_POPULATED = "Already populated, skipping model"
+    FAST_THROUGHPUT = ("Saved {count} historical records of {model} with "
+                       "{strategy} ({rate:.0f} rows/s)\n")
+    PROGRESS = ("Saved {count} of about {total} historical records of {model} "
+                "({rate:.0f} rows/s, {eta} left)\n")
+    ESTIMATE = ("{model}: about {rows} historical records, "
+                "{size:.1f} MB\n")
+    NO_ESTIMATE = "{model}: unable to estimate the number of rows\n"
+    PROGRESS_INTERVAL = 10  # seconds
+    NO_PARALLEL_WRITES = ("The database doesn't support parallel writes, "
+                          "using a single worker\n")
+    WORKER_THROUGHPUT = ("Worker {worker} saved {count} historical records "
+                         "in {seconds:.1f}s ({rate:.0f} records/s)\n")
 
-    if hasattr(BaseCommand, 'option_list'):  # Django < 1.8
-        option_list = BaseCommand.option_list + (
-            make_option('--auto', action='store_true', dest='auto', default=False),
-            make_option('--batchsize', action='store', dest='batchsize', default=200, type=int),
+    if hasattr(HistoryModelCommand, 'option_list'):  # Django < 1.8
+        option_list = HistoryModelCommand.option_list + (
+            make_option('--workers', action='store', dest='workers',
+                        default=1, type=int),
+            make_option('--checkpoint-file', action='store',
+                        dest='checkpoint_file', default=None),
+            make_option('--resume', action='store_true', dest='resume',
+                        default=False),
+            make_option('--missing-only', action='store_true',
+                        dest='missing_only', default=False),
+            make_option('--fast', action='store_true', dest='fast',
+                        default=False),
+            make_option('--dry-run', action='store_true', dest='dry_run',
+                        default=False),
         )
 
     def add_arguments(self, parser):
         super(Command, self).add_arguments(parser)
-        parser.add_argument('models', nargs='*', type=str)
         parser.add_argument(
-            '--auto',
+            '--workers',
+            action='store',
+            dest='workers',
+            default=1,
+            type=int,
+            help='Number of processes populating models and ranges of '
+                 'primary keys in parallel.',
+        )
+        parser.add_argument(
+            '--checkpoint-file',
+            action='store',
+            dest='checkpoint_file',
+            default=None,
+            help='Record the progress of each model in this file.',
+        )
+        parser.add_argument(
+            '--resume',
             action='store_true',
-            dest='auto',
+            dest='resume',
             default=False,
-            help='Automatically search for models with the '
-                 'HistoricalRecords field type',
+            help='Continue from the progress recorded in --checkpoint-file.',
         )
         parser.add_argument(
-            '--batchsize',
-            action='store',
-            dest='batchsize',
-            default=200,
-            type=int,
-            help='Set a custom batch size when bulk inserting historical records.',
+            '--missing-only',
+            action='store_true',
+            dest='missing_only',
+            default=False,
+            help='Only save historical records for the instances without '
+                 'any, even if the model already has history.',
+        )
+        parser.add_argument(
+            '--fast',
+            action='store_true',
+            dest='fast',
+            default=False,
+            help='Copy the rows with SQL instead of building model '
+                 'instances.',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='Only estimate the number of historical records and the '
+                 'size of the history tables, from the database '
+                 'statistics.',
         )
 
     def handle(self, *args, **options):
-        to_process = set()
-        model_strings = options.get('models', []) or args
-
-        if model_strings:
-            for model_pair in self._handle_model_list(*model_strings):
-                to_process.add(model_pair)
-
-        elif options['auto']:
-            for model in models.registered_models.values():
-                try:    # avoid issues with mutli-table inheritance
-                    history_model = utils.get_history_model_for_model(model)
-                except utils.NotHistorical:
-                    continue
-                to_process.add((model, history_model))
-            if not to_process:
-                self.stdout.write(self.NO_REGISTERED_MODELS)
-
-        else:
-            self.stdout.write(self.COMMAND_HINT)
-
-        self._process(to_process, batch_size=options['batchsize'])
-
-    def _handle_model_list(self, *args):
-        failing = False
-        for natural_key in args:
-            try:
-                model, history = self._model_from_natural_key(natural_key)
-            except ValueError as e:
-                failing = True
-                self.stderr.write("{error}\n".format(error=e))
+        self.workers = options.get('workers') or 1
+        self.checkpoint_file = options.get('checkpoint_file')
+        self.resume = options.get('resume', False)
+        self.missing_only = options.get('missing_only', False)
+        self.fast = options.get('fast', False)
+        self.dry_run = options.get('dry_run', False)
+        if self.resume and not self.checkpoint_file:
+            raise CommandError(self.RESUME_NEEDS_CHECKPOINT_FILE)
+        if self.resume and self.workers > 1:
+            raise CommandError(self.RESUME_WITH_WORKERS)
+        if self.checkpoint_file and self.workers > 1:
+            raise CommandError(self.CHECKPOINT_FILE_WITH_WORKERS)
+        self._process(self._get_models(*args, **options),
+                      options['batchsize'])
+
+    def _process(self, to_process, batch_size):
+        if self.dry_run:
+            self._estimate(to_process)
+            return
+        if self.workers > 1:
+            self._process_in_workers(to_process, batch_size)
+            return
+        self.checkpoints = {}
+        if self.resume and os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file) as checkpoint_file:
+                self.checkpoints = json.load(checkpoint_file)
+        for model, history_model in to_process:
+            label = '%s.%s' % (model._meta.app_label, model._meta.model_name)
+            checkpoint = self.checkpoints.get(label)
+            if checkpoint is not None and checkpoint['done']:
+                self.stderr.write("{msg} {model}\n".format(
+                    msg=self.ALREADY_POPULATED,
+                    model=model,
+                ))
+                continue
+            if (checkpoint is None and not self.missing_only and
+                    history_model.objects.exists()):
+                self.stderr.write("{msg} {model}\n".format(
+                    msg=self.EXISTING_HISTORY_FOUND,
+                    model=model,
+                ))
+                continue
+            self.stdout.write(self.START_SAVING_FOR_MODEL.format(model=model))
+            progress = self._progress(model)
+
+            def on_batch(last_pk, count):
+                self._save_checkpoint(label, last_pk)
+                progress(count)
+
+            # A batch may have been saved after the last checkpoint, so
+            # resuming skips the objects which already have a record
+            kwargs = {
+                'after_pk': checkpoint and checkpoint['last_pk'],
+                'missing_only': self.missing_only or checkpoint is not None,
+                'on_batch': on_batch,
+            }
+            if self.fast:
+                strategy = utils.get_fast_strategy(model, history_model)
+                started = time.time()
+                count = utils.fast_history_create(
+                    model, history_model, batch_size, strategy=strategy,
+                    **kwargs)
+                self.stdout.write(self.FAST_THROUGHPUT.format(
+                    count=count, model=model, strategy=strategy,
+                    rate=count / max(time.time() - started, 1e-6)))
+            else:
+                utils.bulk_history_create(model, history_model, batch_size,
+                                          **kwargs)
+            self._save_checkpoint(label, done=True)
+            self.stdout.write(self.DONE_SAVING_FOR_MODEL.format(model=model))
+
+    def _progress(self, model):
+        """Return a callback writing the progress of `model` now and then.
+
+        The total is only estimated once the first report is due, so short
+        runs don't pay for it.
+        """
+        started = time.time()
+        reported = {'at': started}
+
+        def report(count):
+            current = time.time()
+            if current - reported['at'] < self.PROGRESS_INTERVAL:
+                return
+            reported['at'] = current
+            if 'total' not in reported:
+                reported['total'] = utils.estimate_row_count(model)
+            total = reported['total']
+            rate = count / max(current - started, 1e-6)
+            if total is None or total < count:
+                eta = 'unknown'
             else:
-                if not failing:
-                    yield (model, history)
-        if failing:
-            raise CommandError(self.INVALID_MODEL_ARG)
+                eta = '%ds' % ((total - count) / max(rate, 1e-6))
+            self.stdout.write(self.PROGRESS.format(
+                count=count, total='?' if total is None else total,
+                model=model, rate=rate, eta=eta))
 
-    def _model_from_natural_key(self, natural_key):
-        try:
-            app_label, model = natural_key.split(".", 1)
-        except ValueError:
-            model = None
-        else:
-            try:
-                model = get_model(app_label, model)
-            except LookupError:  # Django >= 1.7
-                model = None
-        if not model:
-            raise ValueError(self.MODEL_NOT_FOUND +
-                             " < {model} >\n".format(model=natural_key))
+        return report
+
+    def _estimate(self, to_process):
+        """Write the estimated size of the history of each model."""
+        for model, history_model in to_process:
+            rows = utils.estimate_row_count(model)
+            if rows is None:
+                self.stdout.write(self.NO_ESTIMATE.format(model=model))
+                continue
+            width = utils.estimate_row_width(model, history_model)
+            self.stdout.write(self.ESTIMATE.format(
+                model=model, rows=rows, size=rows * width / 1024.0 / 1024))
+
+    def _save_checkpoint(self, label, last_pk=None, done=False):
+        """Record the last primary key saved for a model.
+
+        The file is written next to the checkpoint file and renamed over
+        it, so an interrupted write leaves the previous checkpoint.
+        """
+        if not self.checkpoint_file:
+            return
+        checkpoint = self.checkpoints.setdefault(
+            label, {'last_pk': None, 'done': False})
+        if last_pk is not None:
+            checkpoint['last_pk'] = last_pk
+        checkpoint['done'] = done
+        directory = os.path.dirname(os.path.abspath(self.checkpoint_file))
+        handle, path = tempfile.mkstemp(dir=directory, suffix='.tmp')
         try:
-            history_model = utils.get_history_model_for_model(model)
-        except utils.NotHistorical:
-            raise ValueError(self.MODEL_NOT_HISTORICAL +
-                             " < {model} >\n".format(model=natural_key))
-        return model, history_model
+            with os.fdopen(handle, 'w') as checkpoint_file:
+                json.dump(self.checkpoints, checkpoint_file,
+                          cls=DjangoJSONEncoder)
+            replace_file(path, self.checkpoint_file)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
 
-    def _process(self, to_process, batch_size):
+    def _process_in_workers(self, to_process, batch_size):
+        """Populate the models in ranges of primary keys, in parallel.
+
+        Each range is saved in its own transaction by one of the workers.
+        """
+        if not utils.supports_parallel_writes():
+            self.stderr.write(self.NO_PARALLEL_WRITES)
+        tasks = []
+        remaining = {}
+        models_by_label = {}
         for model, history_model in to_process:
-            if history_model.objects.count():
+            if not self.missing_only and history_model.objects.exists():
                 self.stderr.write("{msg} {model}\n".format(
                     msg=self.EXISTING_HISTORY_FOUND,
                     model=model,
                 ))
                 continue
             self.stdout.write(self.START_SAVING_FOR_MODEL.format(model=model))
-            utils.bulk_history_create(model, history_model, batch_size)
-            self.stdout.write(self.DONE_SAVING_FOR_MODEL.format(model=model))
+            label = '%s.%s' % (model._meta.app_label, model._meta.model_name)
+            ranges = utils.get_pk_ranges(model, self.workers)
+            tasks.extend((label, batch_size, start_pk, end_pk,
+                          self.missing_only, self.fast)
+                         for start_pk, end_pk in ranges)
+            remaining[label] = len(ranges)
+            models_by_label[label] = model
+        totals = {}
+        for worker, label, count, seconds in utils.populate_in_workers(
+                tasks, self.workers):
+            total = totals.setdefault(worker, [0, 0])
+            total[0] += count
+            total[1] += seconds
+            remaining[label] -= 1
+            if not remaining[label]:
+                self.stdout.write(self.DONE_SAVING_FOR_MODEL.format(
+                    model=models_by_label[label]))
+        for worker in sorted(totals):
+            count, seconds = totals[worker]
+            self.stdout.write(self.WORKER_THROUGHPUT.format(
+                worker=worker, count=count, seconds=seconds,
+                rate=count / max(seconds, 1e-6)))
@@ -0,0 +1,62 @@
+from optparse import make_option
+
+from ._base import HistoryModelCommand
+
+
+class Command(HistoryModelCommand):
+    help = ("Recreates deleted objects from their history, along with "
+            "their many-to-many relations when those have history")
+
+    DONE_RESTORING_FOR_MODEL = "Restored {count} objects of {model}\n"
+
+    if hasattr(HistoryModelCommand, 'option_list'):  # Django < 1.8
+        option_list = HistoryModelCommand.option_list + (
+            make_option('--start', action='store', dest='start',
+                        default=None),
+            make_option('--end', action='store', dest='end', default=None),
+            make_option('--pk', action='append', dest='pks', default=None),
+        )
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--start',
+            action='store',
+            dest='start',
+            default=None,
+            help='Only restore objects deleted from this date.',
+        )
+        parser.add_argument(
+            '--end',
+            action='store',
+            dest='end',
+            default=None,
+            help='Only restore objects deleted before this date.',
+        )
+        parser.add_argument(
+            '--pk',
+            action='append',
+            dest='pks',
+            default=None,
+            help='Only restore the object with this primary key. '
+                 'Can be repeated.',
+        )
+
+    def handle(self, *args, **options):
+        self.start = self._parse_date(options.get('start'))
+        self.end = self._parse_date(options.get('end'))
+        self.pks = options.get('pks')
+        self._process(self._get_models(*args, **options),
+                      options['batchsize'])
+
+    def _process(self, to_process, batch_size):
+        for model, history_model in to_process:
+            manager = getattr(model,
+                              model._meta.simple_history_manager_attribute)
+            filters = {}
+            if self.pks:
+                filters['%s__in' % model._meta.pk.attname] = self.pks
+            restored = manager.undelete(self.start, self.end,
+                                        batch_size=batch_size, **filters)
+            self.stdout.write(self.DONE_RESTORING_FOR_MODEL.format(
+                count=len(restored), model=model))
@@ -1,6 +1,42 @@
 from __future__ import unicode_literals
 
-from django.db import models
+import heapq
+import itertools
+import threading
+from timeit import default_timer
+
+from django.conf import settings
+from django.db import connections, models
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.timezone import now
+
+from .cache import get_date_bucket, get_history_cache
+from .stats import record_flush, timed_operation
+
+try:
+    from django.db.models import Case, Value, When
+except ImportError:  # Django < 1.8
+    Case = None
+try:
+    from django.db.models.functions import Trunc
+except ImportError:  # Django < 1.10
+    Trunc = None
+
+# Keeps `IN (...)` lookups below SQLite's 999 bound parameters limit.
+CHUNK_SIZE = 500
+
+
+def _chunked(iterable):
+    """Yield the items of `iterable` in lists of `CHUNK_SIZE` items."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 class HistoryDescriptor(object):
@@ -13,6 +49,24 @@ class HistoryDescriptor(object):
         return HistoryManager(self.model, instance)
 
 
+class LazyHistoryDescriptor(HistoryDescriptor):
+    """Creates the historical model with `create_model` on first use."""
+
+    lock = threading.RLock()
+
+    def __init__(self, create_model):
+        self.create_model = create_model
+        self.created_model = None
+
+    @property
+    def model(self):
+        if self.created_model is None:
+            with self.lock:
+                if self.created_model is None:
+                    self.created_model = self.create_model()
+        return self.created_model
+
+
 class HistoryManager(models.Manager):
     def __init__(self, model, instance=None):
         super(HistoryManager, self).__init__()
@@ -42,19 +96,16 @@ class HistoryManager(models.Manager):
         if not self.instance:
             raise TypeError("Can't use most_recent() without a %s instance." %
                             self.model._meta.object_name)
-        tmp = []
-        for field in self.instance._meta.fields:
-            if isinstance(field, models.ForeignKey):
-                tmp.append(field.name + "_id")
-            else:
-                tmp.append(field.name)
-        fields = tuple(tmp)
+        return self._cached_instance('latest', self._most_recent_values)
+
+    def _most_recent_values(self):
+        attnames = [field.attname for field in self.instance._meta.fields]
         try:
-            values = self.get_queryset().values_list(*fields)[0]
+            values = self.get_queryset().values_list(*attnames)[0]
         except IndexError:
-            raise self.instance.DoesNotExist("%s has no historical record." %
-                                             self.instance._meta.object_name)
-        return self.instance.__class__(*values)
+            return None, ("%s has no historical record." %
+                          self.instance._meta.object_name)
+        return dict(zip(attnames, values)), None
 
     def as_of(self, date):
         """Get a snapshot as of a specific date.
@@ -65,28 +116,480 @@ class HistoryManager(models.Manager):
         """
         if not self.instance:
             return self._as_of_set(date)
+        date = get_date_bucket(date)
+        return self._cached_instance(
+            date.isoformat(), lambda: self._as_of_values(date),
+            model=self.model.instance_type)
+
+    def _as_of_values(self, date):
         queryset = self.get_queryset().filter(history_date__lte=date)
         try:
             history_obj = queryset[0]
         except IndexError:
-            raise self.instance.DoesNotExist(
-                "%s had not yet been created." %
-                self.instance._meta.object_name)
+            return None, ("%s had not yet been created." %
+                          self.instance._meta.object_name)
         if history_obj.history_type == '-':
-            raise self.instance.DoesNotExist(
-                "%s had already been deleted." %
-                self.instance._meta.object_name)
-        return history_obj.instance
+            return None, ("%s had already been deleted." %
+                          self.instance._meta.object_name)
+        instance = history_obj.instance
+        return {field.attname: getattr(instance, field.attname)
+                for field in instance._meta.fields}, None
+
+    def _cached_instance(self, bucket, fetch, model=None):
+        """Build the instance from `fetch`, going through the history cache.
+
+        `fetch` returns the field values of the instance and an error
+        message, which is raised as `DoesNotExist` when set.
+        """
+        cache = get_history_cache()
+        if cache is None:
+            values, error = fetch()
+        else:
+            key = cache.make_key(self.model, self.instance.pk, bucket)
+            try:
+                values, error = cache.get(key)
+            except KeyError:
+                values, error = fetch()
+                cache.set(key, (values, error))
+        if error:
+            raise self.instance.DoesNotExist(error)
+        return (model or self.instance.__class__)(**values)
 
     def _as_of_set(self, date):
-        model = type(self.model().instance)  # a bit of a hack to get the model
-        pk_attr = model._meta.pk.name
-        queryset = self.get_queryset().filter(history_date__lte=date)
-        for original_pk in set(
-                queryset.order_by().values_list(pk_attr, flat=True)):
-            changes = queryset.filter(**{pk_attr: original_pk})
-            last_change = changes.latest('history_date')
-            if changes.filter(history_date=last_change.history_date,
-                              history_type='-').exists():
+        checkpoint_date = self._nearest_checkpoint_date(date)
+        if checkpoint_date is not None:
+            for instance in self._as_of_set_from_checkpoint(
+                    checkpoint_date, date):
+                yield instance
+            return
+        pk_attr = self.model.instance_type._meta.pk.attname
+        records = self.latest_as_of(date).exclude(history_type='-')
+        for record in records.order_by(pk_attr).iterator():
+            yield record.instance
+
+    def latest_as_of(self, date):
+        """Return the last record of each object as of `date`.
+
+        The records superseded by a later one before `date` are excluded
+        with a single ``NOT EXISTS`` clause, so the latest records of many
+        objects are loaded in one query.  Ties on `history_date` are broken
+        by `history_id`.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        table = qn(opts.db_table)
+        pk_column = qn(opts.get_field(
+            self.model.instance_type._meta.pk.attname).column)
+        date_column = qn(opts.get_field('history_date').column)
+        id_column = qn(opts.get_field('history_id').column)
+        alias = qn('simple_history_later')
+        later = (
+            'NOT EXISTS (SELECT 1 FROM {table} {alias} '
+            'WHERE {alias}.{pk} = {table}.{pk} AND {alias}.{date} <= %s AND '
+            '({alias}.{date} > {table}.{date} OR '
+            '({alias}.{date} = {table}.{date} AND '
+            '{alias}.{id} > {table}.{id})))'
+        ).format(alias=alias, table=table, pk=pk_column, date=date_column,
+                 id=id_column)
+        date_param = opts.get_field('history_date').get_db_prep_value(
+            date, connection)
+        return self.get_queryset().filter(history_date__lte=date).extra(
+            where=[later], params=[date_param])
+
+    def bulk_history_create(self, objs, batch_size=None, history_type='~',
+                            history_date=None, history_user=None):
+        """Record the current state of `objs` with a single ``bulk_create``.
+
+        Unlike saving each object, no signals are sent.  An object's
+        `_history_date` and `_history_user` attributes take precedence over
+        `history_date` and `history_user`.
+        """
+        if history_date is None:
+            history_date = now()
+        history_model = self.model
+        records = [
+            history_model(
+                history_date=getattr(obj, '_history_date', history_date),
+                history_user=getattr(obj, '_history_user', history_user),
+                history_type=history_type,
+                **{field.attname: getattr(obj, field.attname)
+                   for field in obj._meta.fields}
+            ) for obj in objs]
+        with timed_operation(history_model.instance_type,
+                             'bulk_history_create'):
+            started = default_timer()
+            history_model._default_manager.bulk_create(
+                records, batch_size=batch_size)
+            record_flush(history_model, records, started)
+        history_cache = get_history_cache()
+        if history_cache is not None:
+            for obj in objs:
+                history_cache.invalidate(history_model, obj.pk)
+        return records
+
+    def revert_to(self, date, queryset=None, batch_size=CHUNK_SIZE,
+                  history_user=None):
+        """Restore the objects of `queryset` to their state as of `date`.
+
+        The states are loaded with `latest_as_of` and written back with
+        one ``UPDATE`` per `batch_size` objects, and the revert is recorded
+        with `bulk_history_create`.  Objects which didn't exist at `date`
+        are left alone.  Returns the reverted objects.
+        """
+        if self.instance:
+            raise TypeError("Can't use revert_to() with a %s instance." %
+                            self.model._meta.object_name)
+        model = self.model.instance_type
+        if queryset is None:
+            queryset = model._default_manager.all()
+        pk_attr = model._meta.pk.attname
+        pks = list(queryset.values_list('pk', flat=True))
+        reverted = []
+        history_date = now()
+        for start in range(0, len(pks), batch_size):
+            records = self.latest_as_of(date).filter(**{
+                '%s__in' % pk_attr: pks[start:start + batch_size],
+            }).exclude(history_type='-')
+            objs = [record.instance for record in records]
+            if not objs:
                 continue
-            yield last_change.instance
+            self._bulk_update(model, objs)
+            self.bulk_history_create(objs, batch_size=batch_size,
+                                     history_date=history_date,
+                                     history_user=history_user)
+            reverted.extend(objs)
+        return reverted
+
+    def undelete(self, start=None, end=None, batch_size=CHUNK_SIZE,
+                 history_user=None, **filters):
+        """Recreate the objects deleted between `start` and `end`.
+
+        `filters` are applied to the deletion records, e.g.
+        ``history_user_id=user.pk``.  Each object is restored from its
+        deletion record, which holds its state when it was deleted, with
+        chunked ``bulk_create`` calls, followed by
+        the rows of its many-to-many relations with history that were
+        deleted along with it, and the restore is recorded as creations.
+        Objects which exist again are skipped, and multi-table inheritance
+        isn't supported as `bulk_create` can't save it.  Returns the
+        restored objects.
+        """
+        if self.instance:
+            raise TypeError("Can't use undelete() with a %s instance." %
+                            self.model._meta.object_name)
+        deletions = self.with_neighbours().filter(history_type='-', **filters)
+        if start is not None:
+            deletions = deletions.filter(history_date__gte=start)
+        if end is not None:
+            deletions = deletions.filter(history_date__lt=end)
+        history_date = now()
+        restored = []
+        chunk = []
+        for record in deletions.order_by('history_id').iterator():
+            # Only the objects whose deletion is their latest record
+            if record.next_history_id is None:
+                chunk.append(record)
+            if len(chunk) == batch_size:
+                restored.extend(self._undelete(chunk, batch_size,
+                                               history_date, history_user))
+                chunk = []
+        if chunk:
+            restored.extend(self._undelete(chunk, batch_size, history_date,
+                                           history_user))
+        return restored
+
+    def _undelete(self, deletions, batch_size, history_date, history_user):
+        model = self.model.instance_type
+        pk_attr = model._meta.pk.attname
+        existing = set(model._default_manager.filter(pk__in=[
+            getattr(record, pk_attr) for record in deletions
+        ]).values_list('pk', flat=True))
+        objs = []
+        deletion_dates = {}
+        for record in deletions:
+            pk = getattr(record, pk_attr)
+            if pk in existing:
+                continue
+            objs.append(record.instance)
+            deletion_dates[pk] = record.history_date
+        if not objs:
+            return objs
+        model._default_manager.bulk_create(objs, batch_size=batch_size)
+        self.bulk_history_create(objs, batch_size=batch_size,
+                                 history_type='+', history_date=history_date,
+                                 history_user=history_user)
+        for m2m_field in model._meta.many_to_many:
+            self._restore_m2m(m2m_field, deletion_dates, batch_size,
+                              history_date, history_user)
+        return objs
+
+    def _restore_m2m(self, m2m_field, deletion_dates, batch_size,
+                     history_date, history_user):
+        """Recreate the through rows deleted along with the objects.
+
+        Through rows deleted with an object are recorded with the date of
+        the object's deletion record, see `HistoricalRecords.pre_delete`.
+        """
+        through_model = m2m_field.rel.through
+        manager_name = getattr(through_model._meta,
+                               'simple_history_manager_attribute', None)
+        if manager_name is None:
+            return
+        column = m2m_field.m2m_column_name()
+        target_column = m2m_field.m2m_reverse_name()
+        through_history = getattr(through_model, manager_name)
+        rows = []
+        for record in through_history.filter(**{
+            'history_type': '-',
+            '%s__in' % column: list(deletion_dates),
+        }).order_by('history_id'):
+            if record.history_date == deletion_dates[getattr(record, column)]:
+                rows.append(record.instance)
+        target_pks = list(set(getattr(row, target_column) for row in rows))
+        targets = set()
+        for start in range(0, len(target_pks), CHUNK_SIZE):
+            targets.update(m2m_field.rel.to._default_manager.filter(
+                pk__in=target_pks[start:start + CHUNK_SIZE],
+            ).values_list('pk', flat=True))
+        rows = [row for row in rows if getattr(row, target_column) in targets]
+        through_model._default_manager.bulk_create(rows,
+                                                   batch_size=batch_size)
+        through_history.bulk_history_create(
+            rows, batch_size=batch_size, history_type='+',
+            history_date=history_date, history_user=history_user)
+
+    def _bulk_update(self, model, objs):
+        fields = [field for field in model._meta.concrete_fields
+                  if not field.primary_key]
+        manager = model._default_manager
+        if Case is None:
+            for obj in objs:
+                manager.filter(pk=obj.pk).update(**{
+                    field.name: getattr(obj, field.attname)
+                    for field in fields})
+            return
+        # Each object adds its primary key and a value per field
+        connection = connections[manager.db]
+        size = max(connection.ops.bulk_batch_size(
+            [None] * (2 * len(fields) + 1), objs), 1)
+        for start in range(0, len(objs), size):
+            chunk = objs[start:start + size]
+            manager.filter(pk__in=[obj.pk for obj in chunk]).update(**{
+                field.name: Case(*[
+                    When(pk=obj.pk, then=Value(getattr(obj, field.attname),
+                                               output_field=field))
+                    for obj in chunk
+                ], output_field=field)
+                for field in fields})
+
+    def with_neighbours(self):
+        """Annotate records with the ids of the next and previous records.
+
+        Adds `next_history_id` and `prev_history_id` to each record, which
+        `next_record` and `prev_record` then use instead of querying.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        table = qn(opts.db_table)
+        pk_column = qn(opts.get_field(
+            self.model.instance_type._meta.pk.attname).column)
+        date_column = qn(opts.get_field('history_date').column)
+        id_column = qn(opts.get_field('history_id').column)
+        alias = qn('simple_history_neighbour')
+        neighbour = (
+            'SELECT {alias}.{id} FROM {table} {alias} '
+            'WHERE {alias}.{pk} = {table}.{pk} AND '
+            '({alias}.{date} {op} {table}.{date} OR '
+            '({alias}.{date} = {table}.{date} AND '
+            '{alias}.{id} {op} {table}.{id})) '
+            'ORDER BY {alias}.{date} {order}, {alias}.{id} {order} LIMIT 1'
+        )
+        columns = dict(alias=alias, table=table, pk=pk_column,
+                       date=date_column, id=id_column)
+        return self.get_queryset().extra(select={
+            'next_history_id': neighbour.format(op='>', order='ASC',
+                                                **columns),
+            'prev_history_id': neighbour.format(op='<', order='DESC',
+                                                **columns),
+        })
+
+    def prefetch_neighbours(self, records):
+        """Load the neighbours of records from `with_neighbours` at once."""
+        records = list(records)
+        history_ids = set()
+        for record in records:
+            history_ids.update([record.next_history_id,
+                                record.prev_history_id])
+        history_ids.discard(None)
+        history_ids = list(history_ids)
+        neighbours = {}
+        for start in range(0, len(history_ids), CHUNK_SIZE):
+            neighbours.update(self.model._default_manager.in_bulk(
+                history_ids[start:start + CHUNK_SIZE]))
+        for record in records:
+            record._next_record = neighbours.get(record.next_history_id)
+            record._prev_record = neighbours.get(record.prev_history_id)
+        return records
+
+    def _history_range(self, start=None, end=None):
+        queryset = self.get_queryset().order_by()
+        if start is not None:
+            queryset = queryset.filter(history_date__gte=start)
+        if end is not None:
+            queryset = queryset.filter(history_date__lt=end)
+        return queryset
+
+    def count_by_object(self, start=None, end=None):
+        """Number of historical records per original object.
+
+        Returns a ``values`` queryset of dictionaries holding the original
+        primary key and a ``count``, most edited objects first.
+        """
+        pk_attr = self.model.instance_type._meta.pk.attname
+        return self._history_range(start, end).values(pk_attr).annotate(
+            count=Count('history_id')).order_by('-count', pk_attr)
+
+    def count_by_user(self, start=None, end=None):
+        """Number of historical records per ``history_user``."""
+        return self._history_range(start, end).values(
+            'history_user').annotate(
+            count=Count('history_id')).order_by('-count', 'history_user')
+
+    def count_by_type(self, start=None, end=None):
+        """Number of historical records per ``history_type``."""
+        return self._history_range(start, end).values(
+            'history_type').annotate(
+            count=Count('history_id')).order_by('-count', 'history_type')
+
+    def count_by_date(self, period='day', start=None, end=None, fields=()):
+        """Number of historical records per truncated ``history_date``.
+
+        `period` is one of 'year', 'month', 'day', 'hour' or 'minute'.
+        Extra `fields`, e.g. ``('history_user',)``, are added to the
+        grouping.  Results are ordered by ``period``.
+        """
+        if period not in ('year', 'month', 'day', 'hour', 'minute'):
+            raise ValueError("Invalid period: %r" % period)
+        queryset = self._truncate_history_date(
+            self._history_range(start, end), period)
+        return queryset.values('period', *fields).annotate(
+            count=Count('history_id')).order_by('period', *fields)
+
+    def _truncate_history_date(self, queryset, period):
+        if Trunc is not None:
+            return queryset.annotate(period=Trunc('history_date', period))
+        connection = connections[queryset.db]
+        qn = connection.ops.quote_name
+        date_field = self.model._meta.get_field('history_date')
+        column = '%s.%s' % (qn(self.model._meta.db_table),
+                            qn(date_field.column))
+        tzname = None
+        if settings.USE_TZ:
+            tzname = timezone.get_current_timezone_name()
+        sql, params = connection.ops.datetime_trunc_sql(period, column, tzname)
+        return queryset.extra(select={'period': sql}, select_params=params)
+
+    def _as_of_set_from_checkpoint(self, checkpoint_date, date):
+        streams = [self._checkpoint_records(chunks) for chunks in (
+            self._checkpoint_kept_rows(checkpoint_date, date),
+            self._checkpoint_new_rows(checkpoint_date, date))]
+        # Both streams are in primary key order and hold distinct objects
+        for pk, record in heapq.merge(*streams):
+            yield record.instance
+
+    def _checkpoint_records(self, chunks):
+        pk_attr = self.model.instance_type._meta.pk.attname
+        for chunk in chunks:
+            records = self.get_super_queryset().filter(
+                history_id__in=[history_id for pk, history_id in chunk])
+            for record in records.order_by(pk_attr):
+                yield getattr(record, pk_attr), record
+
+    def _nearest_checkpoint_date(self, date, inclusive=True):
+        checkpoint_model = getattr(self.model, 'checkpoint_model', None)
+        if checkpoint_model is None:
+            return None
+        lookup = 'checkpoint_date__lte' if inclusive else 'checkpoint_date__lt'
+        return checkpoint_model.objects.filter(**{lookup: date}).aggregate(
+            Max('checkpoint_date'))['checkpoint_date__max']
+
+    def _checkpoint_kept_rows(self, checkpoint_date, date):
+        """Yield the rows of a checkpoint still current as of `date`.
+
+        The ``(pk, history_id)`` rows are read in chunks of `CHUNK_SIZE`,
+        in primary key order, and updated with the last record of each
+        object in the ``(checkpoint_date, date]`` range.
+        """
+        if checkpoint_date is None:
+            return
+        pk_attr = self.model.instance_type._meta.pk.attname
+        rows = self.model.checkpoint_model.objects.filter(
+            checkpoint_date=checkpoint_date).order_by(pk_attr).values_list(
+            pk_attr, 'history_id')
+        for chunk in _chunked(rows.iterator()):
+            changes = self.latest_as_of(date).filter(**{
+                'history_date__gt': checkpoint_date,
+                pk_attr + '__in': [pk for pk, history_id in chunk],
+            }).values_list(pk_attr, 'history_id', 'history_type')
+            changes = dict((pk, (history_id, history_type))
+                           for pk, history_id, history_type in changes)
+            kept = []
+            for pk, history_id in chunk:
+                if pk in changes:
+                    history_id, history_type = changes[pk]
+                    if history_type == '-':
+                        continue
+                kept.append((pk, history_id))
+            if kept:
+                yield kept
+
+    def _checkpoint_new_rows(self, checkpoint_date, date):
+        """Yield the objects a checkpoint doesn't hold which exist at `date`.
+
+        Like `_checkpoint_kept_rows`, in chunks of ``(pk, history_id)``.
+        """
+        pk_attr = self.model.instance_type._meta.pk.attname
+        records = self.latest_as_of(date).exclude(history_type='-')
+        if checkpoint_date is not None:
+            checkpoint_pks = self.model.checkpoint_model.objects.filter(
+                checkpoint_date=checkpoint_date).values(pk_attr)
+            records = records.filter(
+                history_date__gt=checkpoint_date).exclude(
+                **{pk_attr + '__in': checkpoint_pks})
+        rows = records.order_by(pk_attr).values_list(pk_attr, 'history_id')
+        return _chunked(rows.iterator())
+
+    def build_checkpoint(self, date=None, batch_size=None):
+        """Store a snapshot of the whole table as of `date`.
+
+        The snapshot is built from the previous checkpoint plus the
+        history recorded after it, so only new rows are read, and is
+        written in chunks of `CHUNK_SIZE` objects without being loaded
+        whole.  Returns the number of objects in the checkpoint.
+        """
+        if self.instance:
+            raise TypeError("Can't use build_checkpoint() with a %s instance."
+                            % self.model._meta.object_name)
+        checkpoint_model = getattr(self.model, 'checkpoint_model', None)
+        if checkpoint_model is None:
+            raise TypeError("%s has no checkpoint table, use "
+                            "HistoricalRecords(checkpoints=True)." %
+                            self.model._meta.object_name)
+        if date is None:
+            date = now()
+        pk_attr = self.model.instance_type._meta.pk.attname
+        previous = self._nearest_checkpoint_date(date, inclusive=False)
+        checkpoint_model.objects.filter(checkpoint_date=date).delete()
+        count = 0
+        for chunk in itertools.chain(
+                self._checkpoint_kept_rows(previous, date),
+                self._checkpoint_new_rows(previous, date)):
+            checkpoint_model.objects.bulk_create([
+                checkpoint_model(checkpoint_date=date, history_id=history_id,
+                                 **{pk_attr: pk})
+                for pk, history_id in chunk
+            ], batch_size=batch_size)
+            count += len(chunk)
+        return count
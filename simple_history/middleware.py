@@ -1,17 +1,23 @@
+import logging
+
+from .buffer import HistoryBuffer
 from . models import HistoricalRecords
+from .stats import HistoryReport
 
 try:
     from django.utils.deprecation import MiddlewareMixin as MiddlewareBase
 except ImportError:  # Django < 1.10
     MiddlewareBase = object
 
+logger = logging.getLogger('simple_history')
+
 
 class HistoryRequestMiddleware(MiddlewareBase):
     """Expose request to HistoricalRecords.
 
-    This middleware sets request as a local thread variable, making it
-    available to the model-level utilities to allow tracking of the
-    authenticated user making a change.
+    This middleware sets request as a context (or thread) local variable,
+    making it available to the model-level utilities to allow tracking of
+    the authenticated user making a change.
     """
 
     def process_request(self, request):
@@ -21,3 +27,71 @@ class HistoryRequestMiddleware(MiddlewareBase):
         if hasattr(HistoricalRecords.thread, 'request'):
             del HistoricalRecords.thread.request
         return response
+
+
+class HistoryBufferMiddleware(HistoryRequestMiddleware):
+    """Write the historical records of a request when it ends.
+
+    Every historical record created while handling the request is kept
+    in a `HistoryBuffer` and written with one ``bulk_create`` per
+    historical model, when the response is processed or an exception is
+    raised.
+    """
+
+    def process_request(self, request):
+        super(HistoryBufferMiddleware, self).process_request(request)
+        HistoricalRecords.thread.history_buffer = HistoryBuffer()
+
+    def process_exception(self, request, exception):
+        self.flush()
+
+    def process_response(self, request, response):
+        try:
+            self.flush()
+        finally:
+            response = super(HistoryBufferMiddleware, self).process_response(
+                request, response)
+        return response
+
+    def flush(self):
+        history_buffer = getattr(HistoricalRecords.thread, 'history_buffer',
+                                 None)
+        if history_buffer is not None:
+            try:
+                history_buffer.flush()
+            finally:
+                del HistoricalRecords.thread.history_buffer
+
+
+class HistoryDebugMiddleware(HistoryRequestMiddleware):
+    """Report the time and queries spent recording history in a request.
+
+    The totals are set in the ``X-History-Time`` (milliseconds) and
+    ``X-History-Queries`` headers of the response and logged, with the
+    share of every tracked model, to the ``simple_history`` logger.
+    Meant for development: queries are counted in the query logs of the
+    database connections, which are kept during the request.
+    """
+
+    def process_request(self, request):
+        super(HistoryDebugMiddleware, self).process_request(request)
+        request.history_report = HistoryReport()
+        request.history_report.start()
+
+    def process_response(self, request, response):
+        report = getattr(request, 'history_report', None)
+        if report is not None:
+            report.stop()
+            del request.history_report
+            response['X-History-Time'] = '%.3f' % (report.time * 1000)
+            response['X-History-Queries'] = str(report.queries)
+            logger.info(
+                "%s %s: %.3f ms and %d queries recording history%s",
+                request.method, request.path, report.time * 1000,
+                report.queries, ''.join(
+                    '; %s: %d calls, %.3f ms, %d queries' % (
+                        label, entry['calls'], entry['time'] * 1000,
+                        entry['queries'])
+                    for label, entry in report.models.items()))
+        return super(HistoryDebugMiddleware, self).process_response(
+            request, response)
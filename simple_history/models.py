@@ -2,13 +2,17 @@ from __future__ import unicode_literals
 
 import copy
 import importlib
-import threading
+from collections import OrderedDict
+from timeit import default_timer
 
 from django.db import models, router
 from django.db.models import Q
 from django.db.models.fields.proxy import OrderWrt
 from django.conf import settings
 from django.contrib import admin
+from django.contrib.auth import (
+    BACKEND_SESSION_KEY, SESSION_KEY, get_user_model)
+from django.utils.functional import empty
 from django.utils import six
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.encoding import smart_text
@@ -19,6 +23,11 @@ try:
     from django.apps import apps
 except ImportError:  # Django < 1.7
     from django.db.models import get_app
+try:
+    from django.core import checks
+    from django.db.models.signals import pre_migrate
+except ImportError:  # Django < 1.7
+    pre_migrate = None
 try:
     from django.db.models.fields.related import ForwardManyToOneDescriptor as ManyToOneDescriptor
 except ImportError:  # Django < 1.9
@@ -33,12 +42,25 @@ else:  # south configuration for CustomForeignKeyField
 
 from . import exceptions
 from simple_history import register
-from .manager import HistoryDescriptor
+from .buffer import write_records
+from .cache import get_history_cache
+from .context import context_local
+from .manager import HistoryDescriptor, LazyHistoryDescriptor
+from .signals import (
+    post_create_historical_record, pre_create_historical_record)
+from .stats import record_flush, timed
 
 ALL_M2M_FIELDS = object()
 
 registered_models = {}
 
+# HistoricalRecords waiting for their model to be prepared, by model class,
+# and those inherited by subclasses, by (abstract) base class.
+_pending_records = {}
+_inherited_records = {}
+# Descriptors of the historical models which aren't created yet
+_lazy_descriptors = []
+
 
 def not_registered(model):
     if model._meta.proxy:
@@ -47,15 +69,19 @@ def not_registered(model):
 
 
 class HistoricalRecords(object):
-    thread = threading.local()
+    thread = context_local('simple_history_request')
 
     def __init__(self, verbose_name=None, bases=(models.Model,),
-                 user_related_name='+', table_name=None, inherit=False, m2m_fields=None):
+                 user_related_name='+', table_name=None, inherit=False, m2m_fields=None,
+                 checkpoints=False, lazy=None, aggregation_indexes=False):
         self.user_set_verbose_name = verbose_name
         self.user_related_name = user_related_name
         self.table_name = table_name
         self.inherit = inherit
         self.m2m_fields = m2m_fields
+        self.checkpoints = checkpoints
+        self.lazy = lazy
+        self.aggregation_indexes = aggregation_indexes
         try:
             if isinstance(bases, six.string_types):
                 raise TypeError
@@ -67,7 +93,10 @@ class HistoricalRecords(object):
         self.manager_name = name
         self.module = cls.__module__
         self.cls = cls
-        models.signals.class_prepared.connect(self.finalize, weak=False)
+        if self.inherit:
+            _inherited_records.setdefault(cls, []).append(self)
+        else:
+            _pending_records.setdefault(cls, []).append(self)
         self.add_extra_methods(cls)
         self.setup_m2m_history(cls)
 
@@ -113,14 +142,6 @@ class HistoricalRecords(object):
                         register(through_model)
 
     def finalize(self, sender, **kwargs):
-        try:
-            hint_class = self.cls
-        except AttributeError:  # called via `register`
-            pass
-        else:
-            if hint_class is not sender:  # set in concrete
-                if not (self.inherit and issubclass(sender, hint_class)):
-                    return  # set in abstract
         if hasattr(sender._meta, 'simple_history_manager_attribute'):
             raise exceptions.MultipleRegistrationsError(
                 '{}.{} registered multiple times for history tracking.'.format(
@@ -139,14 +160,23 @@ class HistoricalRecords(object):
                     'bases': self.bases,
                     'user_related_name': self.user_related_name,
                     'm2m_fields': self.m2m_fields,
+                    'checkpoints': self.checkpoints,
+                    'lazy': self.lazy,
+                    'aggregation_indexes': self.aggregation_indexes,
                 }
                 register(original_class, **register_kwargs)
             # Proxy models use their parent's history model
-            history_model = getattr(sender, self.manager_name).model
+            descriptor = original_class.__dict__.get(self.manager_name)
+            if not isinstance(descriptor, HistoryDescriptor):
+                descriptor = HistoryDescriptor(
+                    getattr(sender, self.manager_name).model)
+        elif self.is_lazy():
+            registered_models[sender._meta.db_table] = sender
+            descriptor = LazyHistoryDescriptor(
+                lambda: self.setup_history_model(sender))
+            _lazy_descriptors.append(descriptor)
         else:
-            history_model = self.create_history_model(sender)
-            module = importlib.import_module(self.module)
-            setattr(module, history_model.__name__, history_model)
+            descriptor = HistoryDescriptor(self.setup_history_model(sender))
         # The HistoricalRecords object will be discarded,
         # so the signal handlers can't use weak references.
         models.signals.post_save.connect(self.post_save, sender=sender,
@@ -157,10 +187,39 @@ class HistoricalRecords(object):
                                            weak=False)
         models.signals.m2m_changed.connect(self.m2m_changed, sender=sender, weak=False)
 
-        descriptor = HistoryDescriptor(history_model)
         setattr(sender, self.manager_name, descriptor)
         sender._meta.simple_history_manager_attribute = self.manager_name
 
+    def is_lazy(self):
+        """Whether the historical model is only created on first use.
+
+        Models with a `user_related_name` are always created right away,
+        as their reverse accessor on the user model must exist before any
+        history is used.
+        """
+        if pre_migrate is None:  # nothing would create it before migrating
+            return False
+        if self.user_related_name != '+':
+            return False
+        if self.lazy is None:
+            return getattr(settings, 'SIMPLE_HISTORY_LAZY', False)
+        return self.lazy
+
+    def setup_history_model(self, model):
+        """
+        Creates the historical model of `model`, and its checkpoint model,
+        and adds them to the module of the historical records.
+        """
+        history_model = self.create_history_model(model)
+        module = importlib.import_module(self.module)
+        setattr(module, history_model.__name__, history_model)
+        if self.checkpoints:
+            checkpoint_model = self.create_checkpoint_model(
+                model, history_model)
+            history_model.checkpoint_model = checkpoint_model
+            setattr(module, checkpoint_model.__name__, checkpoint_model)
+        return history_model
+
     def create_history_model(self, model):
         """
         Creates a historical model to associate with the model provided.
@@ -193,6 +252,33 @@ class HistoricalRecords(object):
         return python_2_unicode_compatible(
             type(str(name), self.bases, attrs))
 
+    def create_checkpoint_model(self, model, history_model):
+        """
+        Creates a checkpoint model for the historical model provided.
+
+        Each checkpoint is the full set of rows sharing a `checkpoint_date`,
+        mapping every object alive at that date to its latest historical
+        record.
+        """
+        pk_field = self.copy_fields(model)[model._meta.pk.name]
+        attrs = {
+            '__module__': history_model.__module__,
+            'checkpoint_id': models.AutoField(primary_key=True),
+            'checkpoint_date': models.DateTimeField(db_index=True),
+            'history': models.ForeignKey(history_model, related_name='+',
+                                         on_delete=models.CASCADE),
+            pk_field.name: pk_field,
+        }
+        meta_fields = {
+            'ordering': ('-checkpoint_date', '-checkpoint_id'),
+            'get_latest_by': 'checkpoint_date',
+        }
+        if self.table_name is not None:
+            meta_fields['db_table'] = '%s_checkpoint' % self.table_name
+        attrs['Meta'] = type(str('Meta'), (), meta_fields)
+        name = '%sCheckpoint' % history_model.__name__
+        return type(str(name), (models.Model,), attrs)
+
     def copy_fields(self, model):
         """
         Creates copies of the model's original fields, returning
@@ -258,6 +344,12 @@ class HistoricalRecords(object):
                 for field in fields.values()
             })
 
+        def get_next_record(self):
+            return get_neighbour_record(self, later=True)
+
+        def get_prev_record(self):
+            return get_neighbour_record(self, later=False)
+
         return {
             'history_id': models.AutoField(primary_key=True),
             'history_date': models.DateTimeField(),
@@ -272,6 +364,8 @@ class HistoricalRecords(object):
             'history_object': HistoricalObjectDescriptor(model),
             'instance': property(get_instance),
             'instance_type': model,
+            'next_record': property(get_next_record),
+            'prev_record': property(get_prev_record),
             'revert_url': revert_url,
             '__str__': lambda self: '%s as of %s' % (self.history_object,
                                                      self.history_date)
@@ -282,9 +376,16 @@ class HistoricalRecords(object):
         Returns a dictionary of fields that will be added to
         the Meta inner class of the historical record model.
         """
+        # Back the per-object lookups of the history manager, and with
+        # `aggregation_indexes` its counts by user and type.
+        index_together = [(model._meta.pk.name, 'history_date')]
+        if self.aggregation_indexes:
+            index_together += [('history_user', 'history_date'),
+                               ('history_type', 'history_date')]
         meta_fields = {
             'ordering': ('-history_date', '-history_id'),
             'get_latest_by': 'history_date',
+            'index_together': tuple(index_together),
         }
         if self.user_set_verbose_name:
             name = self.user_set_verbose_name
@@ -300,68 +401,134 @@ class HistoricalRecords(object):
         if not kwargs.get('raw', False):
             self.create_historical_record(instance, created and '+' or '~')
 
+    @timed('pre_delete')
     def pre_delete(self, instance, **kwargs):
         """
         Creates deletion records for the through model of m2m fields. Also creates change records for objects on the
         other side of the m2m relationship.
         """
+        # The through rows are recorded with the date of the deletion record,
+        # which is how `HistoryManager.undelete` finds the rows to restore.
+        history_date = getattr(instance, '_history_date', None) or now()
+        instance.__dict__['_history_delete_date'] = history_date
         for m2m_field in instance._meta.many_to_many:
             through_model = m2m_field.rel.through
             if hasattr(through_model._meta, 'simple_history_manager_attribute'):
-                items = through_model.objects.filter(Q(**{m2m_field.m2m_column_name(): instance.pk}))
+                items = list(through_model.objects.filter(Q(**{m2m_field.m2m_column_name(): instance.pk})))
                 for item in items:
-                    self.create_historical_record(item, '-')
-                for related in m2m_field.value_from_object(instance):
-                    self.create_historical_record(related, '~')
+                    item._history_date = history_date
+                self.create_historical_records(items, '-')
+                self.create_historical_records(
+                    m2m_field.value_from_object(instance), '~')
 
     def post_delete(self, instance, **kwargs):
-        self.create_historical_record(instance, '-')
+        history_date = instance.__dict__.pop('_history_delete_date', None)
+        self.create_historical_record(instance, '-', history_date)
 
+    @timed('m2m_changed')
     def m2m_changed(self, action, instance, sender, **kwargs):
+        if action not in ('post_add', 'pre_remove', 'pre_clear'):
+            return
         source_field_name, target_field_name = None, None
         for field_name, field_value in sender.__dict__.items():
             if isinstance(field_value, ManyToOneDescriptor):
                 if field_value.field.rel.model == kwargs['model']:
                     target_field_name = field_name
+                    target_attname = field_value.field.attname
                 elif isinstance(instance, field_value.field.rel.model):
                     source_field_name = field_name
         items = sender.objects.filter(**{source_field_name: instance})
         if kwargs['pk_set']:
             items = items.filter(**{target_field_name + '__id__in': kwargs['pk_set']})
-        for item in items:
-            if action == 'post_add':
-                if hasattr(item, 'skip_history_when_saving'):
-                    continue
-                self.create_historical_record(item, '+')
-            elif action == 'pre_remove':
-                self.create_historical_record(item, '-')
-            elif action == 'pre_clear':
-                self.create_historical_record(item, '-')
+        other_items = getattr(instance, '__pre_clear_items', None)
+        if action == 'pre_clear' or other_items is not None:
+            # The targets of the cleared and added rows are recorded too
+            items = items.select_related(target_field_name)
+        items = list(items)
+        if action == 'post_add':
+            self.create_historical_records([
+                item for item in items
+                if not hasattr(item, 'skip_history_when_saving')], '+')
+        else:
+            self.create_historical_records(items, '-')
         if action == 'pre_clear':
             setattr(instance, '__pre_clear_items', items)
-        elif action == 'post_add' and hasattr(instance, '__pre_clear_items'):
-            other_items = getattr(instance, '__pre_clear_items')
-            for item in other_items:
-                target = getattr(item, target_field_name)
-                if has_m2m_field(target, sender) and not [i for i in items if target == getattr(i, target_field_name)]:
-                    self.create_historical_record(target, '~')
-            for item in items:
-                target = getattr(item, target_field_name)
-                if has_m2m_field(target, sender) and not [
-                    i for i in other_items if target == getattr(i, target_field_name)
-                ]:
-                    self.create_historical_record(target, '~')
+        elif action == 'post_add' and other_items is not None:
             delattr(instance, '__pre_clear_items')
-
-    def create_historical_record(self, instance, history_type):
-        history_date = getattr(instance, '_history_date', now())
-        history_user = self.get_history_user(instance)
+            if not has_m2m_field(kwargs['model'], sender):
+                return
+            target_ids = set(getattr(item, target_attname) for item in items)
+            other_ids = set(getattr(item, target_attname)
+                            for item in other_items)
+            targets = [getattr(item, target_field_name) for item in other_items
+                       if getattr(item, target_attname) not in target_ids]
+            targets.extend(getattr(item, target_field_name) for item in items
+                           if getattr(item, target_attname) not in other_ids)
+            self.create_historical_records(targets, '~')
+
+    def build_historical_record(self, instance, history_type,
+                                history_date=None):
+        """Return the unsaved historical record of `instance` and its alias.
+
+        ``pre_create_historical_record`` is sent for the record.
+        """
+        if history_date is None:
+            history_date = getattr(instance, '_history_date', now())
         manager = getattr(instance, self.manager_name)
         attrs = {}
         for field in instance._meta.fields:
             attrs[field.attname] = getattr(instance, field.attname)
-        manager.create(history_date=history_date, history_type=history_type,
-                       history_user=history_user, **attrs)
+        if getattr(settings, 'SIMPLE_HISTORY_USER_ID_ONLY', False):
+            attrs['history_user_id'] = self.get_history_user_id(instance)
+        else:
+            attrs['history_user'] = self.get_history_user(instance)
+        history_instance = manager.model(
+            history_date=history_date, history_type=history_type, **attrs)
+        using = router.db_for_write(manager.model, instance=history_instance)
+        pre_create_historical_record.send(
+            sender=type(instance), instance=instance,
+            history_instance=history_instance, using=using)
+        return history_instance, using
+
+    @timed('create_historical_record')
+    def create_historical_record(self, instance, history_type,
+                                 history_date=None):
+        history_instance, using = self.build_historical_record(
+            instance, history_type, history_date)
+        history_buffer = getattr(self.thread, 'history_buffer', None)
+        if (history_buffer is not None and
+                history_buffer.add(history_instance, instance, using)):
+            return
+        history_model = type(history_instance)
+        started = default_timer()
+        history_instance.save(force_insert=True, using=using)
+        record_flush(history_model, [history_instance], started)
+        post_create_historical_record.send(
+            sender=type(instance), instance=instance,
+            history_instance=history_instance, using=using)
+        history_cache = get_history_cache()
+        if history_cache is not None:
+            history_cache.invalidate(history_model, instance.pk)
+
+    def create_historical_records(self, instances, history_type):
+        """Record `instances`, of a single model, with one ``bulk_create``.
+
+        Historical models overriding ``save`` are saved record by record
+        instead, see `write_records`.  Otherwise the records sent with
+        ``post_create_historical_record`` only have a primary key on
+        databases returning the keys of bulk inserts.
+        """
+        history_buffer = getattr(self.thread, 'history_buffer', None)
+        items_by_alias = OrderedDict()
+        for instance in instances:
+            history_instance, using = self.build_historical_record(
+                instance, history_type)
+            if (history_buffer is None or
+                    not history_buffer.add(history_instance, instance, using)):
+                items_by_alias.setdefault(using, []).append(
+                    (history_instance, instance))
+        for using, items in items_by_alias.items():
+            write_records(type(items[0][0]), using, items)
 
     def get_history_user(self, instance):
         """Get the modifying user from instance or middleware."""
@@ -375,6 +542,95 @@ class HistoricalRecords(object):
             except AttributeError:
                 return None
 
+    def get_history_user_id(self, instance):
+        """
+        Get the modifying user's primary key from instance or middleware,
+        without loading the user when it isn't loaded yet.
+        """
+        try:
+            user = instance._history_user
+        except AttributeError:
+            request = getattr(self.thread, 'request', None)
+            if request is None:
+                return None
+            return get_request_user_id(request)
+        return user.pk if user is not None else None
+
+
+def get_request_user_id(request):
+    """Return the primary key of the user logged in the request, if any.
+
+    A loaded ``request.user`` is used as is.  Otherwise the key is read
+    from the session without loading the user, so unlike ``request.user``
+    it isn't checked that the user still exists and is active, or that
+    the session wasn't invalidated by a password change.  Sessions of
+    unknown authentication backends are ignored.  The result is cached on
+    the request as long as `request.user` doesn't change.
+    """
+    user = getattr(request, 'user', None)
+    cached = request.__dict__.get('_history_user_id')
+    if cached is not None and cached[0] is user:
+        return cached[1]
+    if user is not None and getattr(user, '_wrapped', None) is not empty:
+        user_id = user.pk if user.is_authenticated() else None
+    else:
+        session = getattr(request, 'session', {})
+        user_id = None
+        if (SESSION_KEY in session and session.get(BACKEND_SESSION_KEY) in
+                settings.AUTHENTICATION_BACKENDS):
+            user_id = get_user_model()._meta.pk.to_python(
+                session[SESSION_KEY])
+    request.__dict__['_history_user_id'] = (user, user_id)
+    return user_id
+
+
+def finalize_history(sender, **kwargs):
+    """Finalize the history of a prepared model class.
+
+    A single receiver looks up the HistoricalRecords of `sender` and of
+    its bases, instead of every HistoricalRecords being called for every
+    model class.
+    """
+    for records in _pending_records.pop(sender, ()):
+        records.finalize(sender)
+    if _inherited_records:
+        for base in sender.__mro__:
+            for records in _inherited_records.get(base, ()):
+                records.finalize(sender)
+
+
+models.signals.class_prepared.connect(
+    finalize_history, dispatch_uid='simple_history.finalize_history')
+
+
+def create_lazy_history_models():
+    """Create the historical models which lazy HistoricalRecords deferred.
+
+    Returns the historical models created.
+    """
+    history_models = []
+    while _lazy_descriptors:
+        descriptor = _lazy_descriptors.pop(0)
+        if descriptor.created_model is None:
+            history_models.append(descriptor.model)
+    return history_models
+
+
+if pre_migrate is not None:
+    # Migrations and system checks must see every historical model
+    def create_lazy_history_models_before_migrate(**kwargs):
+        create_lazy_history_models()
+
+    pre_migrate.connect(create_lazy_history_models_before_migrate,
+                        dispatch_uid='simple_history.create_lazy_models')
+
+    @checks.register(checks.Tags.models)
+    def check_lazy_history_models(app_configs=None, **kwargs):
+        errors = []
+        for history_model in create_lazy_history_models():
+            errors.extend(history_model.check(**kwargs))
+        return errors
+
 
 def transform_field(field):
     """Customize field appropriately for use in historical model"""
@@ -419,6 +675,42 @@ def convert_auto_field(field):
     return models.IntegerField
 
 
+def get_neighbour_record(record, later):
+    """Return the record following (or preceding) `record` for its object.
+
+    The neighbour is cached on `record`.  Records loaded through
+    `HistoryManager.with_neighbours` already know the neighbour's id.
+    """
+    cache_name = '_next_record' if later else '_prev_record'
+    try:
+        return getattr(record, cache_name)
+    except AttributeError:
+        pass
+    model = type(record)
+    manager = model._default_manager
+    annotation = 'next_history_id' if later else 'prev_history_id'
+    if hasattr(record, annotation):
+        history_id = getattr(record, annotation)
+        neighbour = history_id and manager.get(history_id=history_id)
+    else:
+        pk_attr = model.instance_type._meta.pk.attname
+        if later:
+            keyset = (Q(history_date__gt=record.history_date) |
+                      Q(history_date=record.history_date,
+                        history_id__gt=record.history_id))
+            ordering = ('history_date', 'history_id')
+        else:
+            keyset = (Q(history_date__lt=record.history_date) |
+                      Q(history_date=record.history_date,
+                        history_id__lt=record.history_id))
+            ordering = ('-history_date', '-history_id')
+        neighbour = manager.filter(
+            keyset, **{pk_attr: getattr(record, pk_attr)}
+        ).order_by(*ordering).first()
+    setattr(record, cache_name, neighbour or None)
+    return neighbour or None
+
+
 class HistoricalObjectDescriptor(object):
     def __init__(self, model):
         self.model = model
@@ -7,12 +7,15 @@ import unittest
 import django
 from django.contrib.auth import get_user_model
 from django.core import management
+from django.db import models
+from django.db.models.signals import class_prepared
 from django.test import TestCase
 
 from simple_history import exceptions, register
+from simple_history.models import (
+    HistoricalRecords, create_lazy_history_models)
 from ..tests.models import (
-    Poll, Choice, Voter, Restaurant, HistoricalPoll, HistoricalChoice,
-    HistoricalState, HistoricalCustomFKError,
+    Poll, Choice, Voter, Restaurant,
     UserAccessorDefault, UserAccessorOverride,
     TrackedAbstractBaseA, TrackedAbstractBaseB,
     TrackedWithAbstractBase, TrackedWithConcreteBase,
@@ -141,6 +144,57 @@ class TestTrackingInheritance(TestCase):
             register(InheritTracking4)
 
 
+class TestClassPrepared(unittest.TestCase):
+
+    def test_single_receiver(self):
+        receivers = [receiver for key, receiver in class_prepared.receivers
+                     if key[0] == 'simple_history.finalize_history']
+        self.assertEqual(len(receivers), 1)
+        self.assertFalse([
+            receiver for key, receiver in class_prepared.receivers
+            if isinstance(getattr(receiver, '__self__', None),
+                          HistoricalRecords)])
+
+
+@unittest.skipIf(django.VERSION < (1, 7), "Requires 1.7 system checks")
+class TestLazyHistory(unittest.TestCase):
+
+    def test_created_on_first_use(self):
+        class LazyTracked(models.Model):
+            history = HistoricalRecords(lazy=True)
+
+        self.assertNotIn('HistoricalLazyTracked', globals())
+        self.assertRaises(LookupError, get_model,
+                          'simple_history', 'HistoricalLazyTracked')
+        history_model = LazyTracked.history.model
+        self.assertIs(globals()['HistoricalLazyTracked'], history_model)
+        self.assertIs(
+            get_model('simple_history', 'HistoricalLazyTracked'),
+            history_model)
+        self.assertEqual(
+            [f.attname for f in history_model._meta.fields],
+            ['id', 'history_id', 'history_date', 'history_user_id',
+             'history_type'])
+        self.assertNotIn(history_model, create_lazy_history_models())
+
+    def test_user_related_name_created_right_away(self):
+        class LazyUserAccessor(models.Model):
+            history = HistoricalRecords(
+                lazy=True, user_related_name='lazy_accessor_history')
+
+        self.assertIn('HistoricalLazyUserAccessor', globals())
+        self.assertTrue(hasattr(User, 'lazy_accessor_history'))
+
+    def test_created_by_checks(self):
+        class LazyChecked(models.Model):
+            history = HistoricalRecords(lazy=True)
+
+        management.call_command('check', tags=['models'], stdout=StringIO(),
+                                stderr=StringIO())
+        self.assertIs(globals()['HistoricalLazyChecked'],
+                      LazyChecked.history.model)
+
+
 @unittest.skipUnless(django.get_version() >= "1.7", "Requires 1.7 migrations")
 class TestMigrate(TestCase):
 
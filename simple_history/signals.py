@@ -0,0 +1,19 @@
+"""
+Signals sent around the saving of historical records.
+
+Both are sent by the tracked model class, with the `instance` being
+recorded, the unsaved or saved `history_instance` and the database alias
+`using`.  Receivers of ``pre_create_historical_record`` may change the
+`history_instance` before it is saved.  When ``HistoryBufferMiddleware``
+buffers a record, ``post_create_historical_record`` is sent once the
+buffer writes it.  Records saved in bulk, like those of many-to-many
+changes, only have a primary key when the database returns it, unless
+their historical model overrides ``save``.
+``bulk_history_create`` sends neither signal.
+"""
+from django.dispatch import Signal
+
+pre_create_historical_record = Signal(
+    providing_args=['instance', 'history_instance', 'using'])
+post_create_historical_record = Signal(
+    providing_args=['instance', 'history_instance', 'using'])
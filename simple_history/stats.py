@@ -0,0 +1,314 @@
+"""
+In-process statistics of the historical records written.
+
+Enabled with the ``SIMPLE_HISTORY_STATS`` setting.  For each tracked model,
+keyed by ``app_label.model_name``, the registry counts::
+
+    {
+        'records': 120,         # historical records written
+        'flushes': 4,           # inserts (or bulk inserts) writing them
+        'rows_per_flush': 30.0,
+        'max_rows_per_flush': 100,
+        'time': 0.012,          # seconds spent in these inserts
+        'bytes': 5480,          # estimated size of the records' values
+        'operations': {         # calls and seconds of the write path
+            'create_historical_record': {'calls': 20, 'time': 0.009},
+            'm2m_changed': {'calls': 2, 'time': 0.004},
+            'write_records': {'calls': 2, 'time': 0.002},
+        },
+    }
+
+Operations include the time of the operations they call, e.g. the records
+created by ``m2m_changed`` are also counted by ``write_records``.  Bulk
+writes are counted once per insert, as ``write_records``,
+``bulk_history_create`` or ``fast_history_create``.
+
+A `HistoryReport` sums the time and queries of the history recorded while
+it is active, e.g. during a request with ``HistoryDebugMiddleware``.
+"""
+from __future__ import unicode_literals
+
+import functools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.conf import settings
+from django.db import connections
+from django.utils import six
+
+from .context import context_local
+
+_report = context_local('simple_history_report')
+
+# Rough widths in bytes of the values of fixed size column types
+FIELD_WIDTHS = {
+    'AutoField': 4,
+    'BigAutoField': 8,
+    'BigIntegerField': 8,
+    'BooleanField': 1,
+    'DateField': 4,
+    'DateTimeField': 8,
+    'DecimalField': 8,
+    'FloatField': 8,
+    'ForeignKey': 4,
+    'IntegerField': 4,
+    'NullBooleanField': 1,
+    'PositiveIntegerField': 4,
+    'PositiveSmallIntegerField': 2,
+    'SmallIntegerField': 2,
+    'TextField': 64,
+    'TimeField': 8,
+    'UUIDField': 16,
+}
+
+
+def stats_enabled():
+    return getattr(settings, 'SIMPLE_HISTORY_STATS', False)
+
+
+def get_model_label(model):
+    opts = model._meta
+    return '%s.%s' % (opts.app_label, opts.model_name)
+
+
+def get_record_size(record):
+    """Estimate the size in bytes of the values of `record`.
+
+    Text counts one byte per character and other values the width of
+    their column type.
+    """
+    size = 0
+    for field in record._meta.concrete_fields:
+        value = getattr(record, field.attname)
+        if value is None:
+            continue
+        if isinstance(value, (six.text_type, six.binary_type)):
+            size += len(value)
+        else:
+            size += FIELD_WIDTHS.get(field.get_internal_type(), 8)
+    return size
+
+
+class HistoryStats(object):
+    """Counters of the history written by each tracked model."""
+
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, model):
+        label = get_model_label(model)
+        entry = self._models.get(label)
+        if entry is None:
+            entry = self._models[label] = {
+                'records': 0,
+                'flushes': 0,
+                'max_rows_per_flush': 0,
+                'time': 0.0,
+                'bytes': 0,
+                'operations': {},
+            }
+        return entry
+
+    def add_flush(self, history_model, records, seconds):
+        """Count an insert of the historical `records` of `history_model`."""
+        size = sum(get_record_size(record) for record in records)
+        with self._lock:
+            entry = self._entry(history_model.instance_type)
+            entry['records'] += len(records)
+            entry['flushes'] += 1
+            entry['max_rows_per_flush'] = max(entry['max_rows_per_flush'],
+                                              len(records))
+            entry['time'] += seconds
+            entry['bytes'] += size
+
+    def add_operation(self, model, operation, seconds):
+        """Count a call of `operation` for the tracked `model`."""
+        with self._lock:
+            operations = self._entry(model)['operations']
+            counts = operations.setdefault(operation,
+                                           {'calls': 0, 'time': 0.0})
+            counts['calls'] += 1
+            counts['time'] += seconds
+
+    def get(self):
+        """Return a copy of the statistics, by tracked model label."""
+        with self._lock:
+            stats = {}
+            for label, entry in self._models.items():
+                entry = dict(entry, operations={
+                    operation: dict(counts)
+                    for operation, counts in entry['operations'].items()})
+                entry['rows_per_flush'] = (
+                    float(entry['records']) / entry['flushes']
+                    if entry['flushes'] else 0.0)
+                stats[label] = entry
+            return stats
+
+    def reset(self):
+        with self._lock:
+            self._models.clear()
+
+
+history_stats = HistoryStats()
+
+
+def get_history_stats():
+    return history_stats.get()
+
+
+def reset_history_stats():
+    history_stats.reset()
+
+
+def record_flush(history_model, records, started):
+    """Count the insert of `records` which began at `started`.
+
+    `started` is a `timeit.default_timer` value.
+    """
+    if stats_enabled():
+        history_stats.add_flush(history_model, records,
+                                default_timer() - started)
+
+
+def timed(operation):
+    """Count the calls and time of a `HistoricalRecords` method.
+
+    Calls are counted for the model given as the `sender` keyword
+    argument of signal receivers, or else for the class of the first
+    argument, the instance, in the statistics and the active report.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if get_history_report() is None and not stats_enabled():
+                return method(self, *args, **kwargs)
+            if 'sender' in kwargs:
+                model = kwargs['sender']
+            else:
+                model = type(args[0] if args else kwargs['instance'])
+            with timed_operation(model, operation):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def timed_operation(model, operation):
+    """Count the block as a call of `operation` for the tracked `model`.
+
+    Like `timed`, for the write paths which aren't `HistoricalRecords`
+    methods.
+    """
+    report = get_history_report()
+    enabled = stats_enabled()
+    started = default_timer()
+    try:
+        if report is None:
+            yield
+        else:
+            with report.measure(model):
+                yield
+    finally:
+        if enabled:
+            history_stats.add_operation(model, operation,
+                                        default_timer() - started)
+
+
+class HistoryReport(object):
+    """Time and queries spent recording history, by tracked model.
+
+    Queries are counted in the query logs of the database connections,
+    which are kept while the report is active.  Only the outermost
+    operation is counted when they are nested, e.g. the records created
+    by ``m2m_changed``.
+    """
+
+    def __init__(self):
+        self.models = OrderedDict()
+        self._depth = 0
+        self._debug_cursors = {}
+
+    def start(self):
+        for connection in connections.all():
+            self._debug_cursors[connection.alias] = _get_debug_cursor(
+                connection)
+            _set_debug_cursor(connection, True)
+        _report.report = self
+
+    def stop(self):
+        if getattr(_report, 'report', None) is self:
+            del _report.report
+        for connection in connections.all():
+            if connection.alias in self._debug_cursors:
+                _set_debug_cursor(connection,
+                                  self._debug_cursors[connection.alias])
+        self._debug_cursors = {}
+
+    @property
+    def time(self):
+        return sum(entry['time'] for entry in self.models.values())
+
+    @property
+    def queries(self):
+        return sum(entry['queries'] for entry in self.models.values())
+
+    def measure(self, model):
+        return _Measure(self, model)
+
+    def add(self, model, seconds, queries):
+        entry = self.models.setdefault(get_model_label(model), {
+            'calls': 0, 'time': 0.0, 'queries': 0})
+        entry['calls'] += 1
+        entry['time'] += seconds
+        entry['queries'] += queries
+
+
+class _Measure(object):
+
+    def __init__(self, report, model):
+        self.report = report
+        self.model = model
+
+    def __enter__(self):
+        self.report._depth += 1
+        if self.report._depth == 1:
+            self.queries = _count_queries()
+            self.started = default_timer()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.report._depth -= 1
+        if self.report._depth == 0:
+            self.report.add(self.model, default_timer() - self.started,
+                            _count_queries() - self.queries)
+
+
+def get_history_report():
+    """Return the `HistoryReport` active in this context, if any."""
+    return getattr(_report, 'report', None)
+
+
+def _get_debug_cursor(connection):
+    try:
+        return connection.force_debug_cursor
+    except AttributeError:  # Django < 1.8
+        return connection.use_debug_cursor
+
+
+def _set_debug_cursor(connection, value):
+    if hasattr(connection, 'force_debug_cursor'):
+        connection.force_debug_cursor = value
+    else:  # Django < 1.8
+        connection.use_debug_cursor = value
+
+
+def _count_queries():
+    count = 0
+    for connection in connections.all():
+        try:
+            count += len(connection.queries_log)
+        except AttributeError:  # Django < 1.8
+            count += len(connection.queries)
+    return count
@@ -6,12 +6,16 @@ from simple_history.admin import SimpleHistoryAdmin
 from .models import Poll, Choice, Person, Book, Document, Paper, Employee
 
 
+class PollAdmin(SimpleHistoryAdmin):
+    actions = ['revert_to_date']
+
+
 class PersonAdmin(SimpleHistoryAdmin):
     def has_change_permission(self, request, obj=None):
         return False
 
 
-admin.site.register(Poll, SimpleHistoryAdmin)
+admin.site.register(Poll, PollAdmin)
 admin.site.register(Choice, SimpleHistoryAdmin)
 admin.site.register(Person, PersonAdmin)
 admin.site.register(Book, SimpleHistoryAdmin)
@@ -43,6 +43,13 @@ class WaterLevel(models.Model):
         return self.date
 
 
+class Ledger(models.Model):
+    name = models.CharField(max_length=100)
+    balance = models.IntegerField(default=0)
+
+    history = HistoricalRecords(checkpoints=True, aggregation_indexes=True)
+
+
 class Choice(models.Model):
     poll = models.ForeignKey(Poll)
     choice = models.CharField(max_length=200)
@@ -51,6 +58,17 @@ class Choice(models.Model):
 register(Choice)
 
 
+class Tag(models.Model):
+    name = models.CharField(max_length=100)
+    history = HistoricalRecords()
+
+
+class Article(models.Model):
+    title = models.CharField(max_length=200)
+    tags = models.ManyToManyField(Tag)
+    history = HistoricalRecords(m2m_fields=['tags'])
+
+
 class Voter(models.Model):
     user = models.ForeignKey(User)
     choice = models.ForeignKey(Choice, related_name='voters')
@@ -176,6 +194,27 @@ class ConcreteUtil(AbstractBase):
 register(ConcreteUtil, bases=[AbstractBase])
 
 
+class SavedNoteBase(models.Model):
+    history_note = models.CharField(max_length=20, blank=True)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        self.history_note = "saved"
+        return super(SavedNoteBase, self).save(*args, **kwargs)
+
+
+class Label(models.Model):
+    name = models.CharField(max_length=100)
+    history = HistoricalRecords(bases=[SavedNoteBase])
+
+
+class Labelled(models.Model):
+    labels = models.ManyToManyField(Label)
+    history = HistoricalRecords(m2m_fields=['labels'])
+
+
 class MultiOneToOne(models.Model):
     fk = models.ForeignKey(SecondLevelInheritedModel)
 
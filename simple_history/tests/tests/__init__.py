@@ -2,4 +2,10 @@ from .test_models import *
 from .test_admin import *
 from .test_commands import *
 from .test_manager import *
-
+from .test_cache import *
+from .test_diff import *
+from .test_feed import *
+from .test_context import *
+from .test_buffer import *
+from .test_stats import *
+from .test_budget import *
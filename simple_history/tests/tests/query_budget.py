@@ -0,0 +1,32 @@
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryBudgetMixin(object):
+    """Pins the queries of an operation, whatever the size of its data."""
+
+    budget_scales = (1, 10)
+
+    def assertQueryBudget(self, budget, prepare, scales=None,
+                          using=DEFAULT_DB_ALIAS):
+        """Assert the operation prepared at each scale makes `budget` queries.
+
+        `prepare(scale)` creates data of size `scale`, e.g. that many
+        objects or historical records, and returns the operation to count
+        the queries of.  Each scale is rolled back before the next one, so
+        an operation going from O(1) to O(N) queries fails.
+        """
+        for scale in scales or self.budget_scales:
+            savepoint = transaction.savepoint(using=using)
+            try:
+                operation = prepare(scale)
+                with CaptureQueriesContext(connections[using]) as context:
+                    operation()
+            finally:
+                transaction.savepoint_rollback(savepoint, using=using)
+            if len(context) != budget:
+                queries = '\n'.join(query['sql']
+                                    for query in context.captured_queries)
+                self.fail('%d queries executed at scale %d, %d expected\n'
+                          'Captured queries were:\n%s' % (
+                              len(context), scale, budget, queries))
@@ -6,6 +6,9 @@ from django.contrib.admin import AdminSite
 from django.contrib.messages.storage.fallback import FallbackStorage
 from django.test.utils import override_settings
 from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.contrib.auth import get_user_model
@@ -79,6 +82,241 @@ class AdminSiteTest(AdminTest):
         self.assertIn("Created", response.unicode_normal_body)
         self.assertIn(self.user.username, response.unicode_normal_body)
 
+    def test_history_list_pagination(self):
+        self.login()
+        poll = Poll.objects.create(question="why?", pub_date=today)
+        for question in ("how?", "when?", "where?", "who?"):
+            poll.question = question
+            poll.save()
+        history_ids = list(poll.history.values_list('history_id', flat=True))
+
+        def browse(page, button):
+            # The pager buttons submit the compare form to the history page
+            self.assertEqual(page.html.find('button', {'name': button})[
+                'formaction'], './')
+            return self.app.get(get_history_url(poll),
+                                params=page.form.submit_fields(button))
+
+        def page_ids(page):
+            ids = []
+            for radio in page.html.find_all('input', {'type': 'radio'}):
+                if not radio.has_attr('hidden') and (
+                        int(radio['value']) not in ids):
+                    ids.append(int(radio['value']))
+            return ids
+
+        with patch.object(SimpleHistoryAdmin, 'history_list_per_page', 2):
+            pages = [self.app.get(get_history_url(poll))]
+            pages.append(browse(pages[0], 'after'))
+            pages.append(browse(pages[1], 'after'))
+            newer = browse(pages[2], 'before')
+        self.assertEqual(page_ids(pages[0]), history_ids[:2])
+        self.assertEqual(page_ids(pages[1]), history_ids[2:4])
+        self.assertEqual(page_ids(pages[2]), history_ids[4:])
+        self.assertEqual(page_ids(newer), history_ids[2:4])
+        self.assertNotIn("Older", pages[2].unicode_normal_body)
+        self.assertNotIn("Newer", pages[0].unicode_normal_body)
+
+    def test_history_list_compare_across_pages(self):
+        self.login()
+        poll = Poll.objects.create(question="why?", pub_date=today)
+        for question in ("how?", "when?"):
+            poll.question = question
+            poll.save()
+        history_ids = list(poll.history.values_list('history_id', flat=True))
+        with patch.object(SimpleHistoryAdmin, 'history_list_per_page', 2):
+            first = self.app.get(get_history_url(poll))
+            last = self.app.get(get_history_url(poll),
+                                params=first.form.submit_fields('after'))
+        # The one record of the last page can only be compared from, the
+        # newest record chosen on the first page is carried along
+        form = last.form
+        self.assertEqual(form['to'].value, str(history_ids[0]))
+        form['from'] = str(history_ids[2])
+        response = form.submit()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('from=%s&amp;to=%s' % (history_ids[2], history_ids[0]),
+                      response.unicode_normal_body)
+
+    def test_history_list_query_count(self):
+        self.login()
+        other_user = User.objects.create_superuser('other', 'o@example.com',
+                                                   'pass')
+
+        def count_queries(changes):
+            poll = Poll(question="why?", pub_date=today)
+            for index in range(changes):
+                poll._history_user = (self.user, other_user)[index % 2]
+                poll.save()
+            with CaptureQueriesContext(connection) as queries:
+                self.app.get(get_history_url(poll))
+            return len(queries)
+
+        self.assertEqual(count_queries(2), count_queries(20))
+
+    def test_history_list_invalid_cursor(self):
+        self.login()
+        poll = Poll.objects.create(question="why?", pub_date=today)
+        response = self.app.get(get_history_url(poll) + '?after=nonsense')
+        self.assertIn("Created", response.unicode_normal_body)
+
+    def test_history_stats(self):
+        self.login()
+        poll = Poll(question="why?", pub_date=today)
+        poll._history_user = self.user
+        poll.save()
+        poll.question = "how?"
+        poll.save()
+        response = self.app.get(
+            reverse('admin:tests_poll_simple_history_stats'))
+        self.assertIn("Most changed objects", response.unicode_normal_body)
+        self.assertIn(get_history_url(poll), response.unicode_normal_body)
+        self.assertIn(self.user.username, response.unicode_normal_body)
+        self.assertIn("Changed", response.unicode_normal_body)
+
+    def test_history_stats_permission(self):
+        self.login()
+        self.app.get(reverse('admin:tests_person_simple_history_stats'),
+                     status=403)
+
+    def test_compare_view(self):
+        self.login()
+        poll = Poll.objects.create(question="why?", pub_date=today)
+        poll.question = "how?"
+        poll.save()
+        first, second = poll.history.order_by('history_id')
+        url = reverse('admin:tests_poll_simple_compare',
+                      args=[quote(poll.pk)])
+        query = '?from=%s&to=%s' % (first.history_id, second.history_id)
+        response = self.app.get(url + query)
+        pending = response.html.find_all('p', {'class': 'compare-pending'})
+        self.assertEqual(len(pending), 1)
+        self.assertIn("field=question", pending[0]['data-url'])
+        self.assertIn('<p style="white-space:pre-wrap">%s</p>' % poll.pk,
+                      response.unicode_normal_body)
+
+    def test_compare_field_view(self):
+        self.login()
+        poll = Poll.objects.create(question="why?", pub_date=today)
+        poll.question = "how?"
+        poll.save()
+        first, second = poll.history.order_by('history_id')
+        url = reverse('admin:tests_poll_simple_compare_field',
+                      args=[quote(poll.pk)])
+        query = '?from=%s&to=%s&field=question' % (first.history_id,
+                                                   second.history_id)
+        cache.clear()
+        response = self.app.get(url + query)
+        self.assertEqual(response.json, {
+            'name': 'question',
+            'contents': '<span class="compare-removed">why</span>'
+                        '<span class="compare-added">how</span>'
+                        '<span class="compare-unchanged">?</span>',
+        })
+        with patch('simple_history.admin.generate_diff') as generate_diff:
+            cached = self.app.get(url + query)
+        self.assertFalse(generate_diff.called)
+        self.assertEqual(cached.json, response.json)
+        self.app.get(url + query.replace('question', 'nonsense'), status=404)
+
+    def test_compare_field_view_max_length(self):
+        self.login()
+        poll = Poll.objects.create(question="why?", pub_date=today)
+        poll.question = "how?"
+        poll.save()
+        first, second = poll.history.order_by('history_id')
+        url = reverse('admin:tests_poll_simple_compare_field',
+                      args=[quote(poll.pk)])
+        query = '?from=%s&to=%s&field=question' % (first.history_id,
+                                                   second.history_id)
+        cache.clear()
+        with patch.object(SimpleHistoryAdmin, 'compare_cache_max_length', 10):
+            self.app.get(url + query)
+        with patch('simple_history.admin.generate_diff',
+                   return_value='') as generate_diff:
+            self.app.get(url + query)
+        self.assertTrue(generate_diff.called)
+
+    def test_compare_permission(self):
+        self.login(self.user)
+        person = Person.objects.create(name='Sandra Hale')
+        person.name = 'Sandra'
+        person.save()
+        first, second = person.history.order_by('history_id')
+        query = '?from=%s&to=%s' % (first.history_id, second.history_id)
+        self.app.get(reverse('admin:tests_person_simple_compare',
+                             args=[quote(person.pk)]) + query, status=403)
+        self.app.get(reverse('admin:tests_person_simple_compare_field',
+                             args=[quote(person.pk)]) + query +
+                     '&field=name', status=403)
+
+    def test_compare_view_missing_record(self):
+        self.login()
+        poll = Poll.objects.create(question="why?", pub_date=today)
+        other = Poll.objects.create(question="how?", pub_date=today)
+        url = reverse('admin:tests_poll_simple_compare',
+                      args=[quote(poll.pk)])
+        query = '?from=%s&to=%s' % (poll.history.get().history_id,
+                                    other.history.get().history_id)
+        self.app.get(url + query, status=404)
+        self.app.get(url + '?from=1&to=nonsense', status=404)
+
+    def test_recent_changes(self):
+        self.login()
+        poll = Poll(question="why?", pub_date=today)
+        poll._history_user = self.user
+        poll.save()
+        Book.objects.create(isbn='1')
+        Person.objects.create(name='Sandra Hale')
+        response = self.app.get(
+            reverse('simple_history_recent_changes_by_one'))
+        older = response.click("Older")
+        self.assertIn("Book object", response.unicode_normal_body)
+        self.assertIn(get_history_url(poll), older.unicode_normal_body)
+        # People can't be changed by anyone in this admin
+        self.assertNotIn("Person", response.unicode_normal_body)
+        self.assertNotIn("Person", older.unicode_normal_body)
+
+        url = reverse('simple_history_recent_changes')
+        response = self.app.get(url + '?user=%s' % self.user.pk)
+        self.assertIn("Poll object", response.unicode_normal_body)
+        self.assertNotIn("Book object", response.unicode_normal_body)
+        response = self.app.get(url + '?type=-')
+        self.assertIn("No changes were recorded.",
+                      response.unicode_normal_body)
+
+    def test_revert_to_date_action(self):
+        self.login()
+        poll = Poll(question="why?", pub_date=today)
+        poll._history_date = today
+        poll.save()
+        poll.question = "how?"
+        poll._history_date = tomorrow
+        poll.save()
+        changelist = self.app.get(reverse('admin:tests_poll_changelist'))
+        form = changelist.forms['changelist-form']
+        form['action'] = 'revert_to_date'
+        form['_selected_action'] = [str(poll.pk)]
+        confirmation = form.submit()
+        self.assertIn("Restore the selected object",
+                      confirmation.unicode_normal_body)
+        form = confirmation.form
+        form['revert_date'] = 'nonsense'
+        self.assertIn("Enter a valid date/time.",
+                      form.submit().unicode_normal_body)
+        form['revert_date'] = (today + timedelta(hours=1)).strftime(
+            '%Y-%m-%d %H:%M:%S')
+        with patch.object(SimpleHistoryAdmin, 'message_user') as message:
+            form.submit().follow()
+        self.assertIn("Reverted 1 polls", message.call_args[0][1])
+        self.assertEqual(Poll.objects.get(pk=poll.pk).question, "why?")
+        self.assertEqual(poll.history.all()[0].history_user, self.user)
+
+    def test_revert_to_date_action_opt_in(self):
+        self.login()
+        changelist = self.app.get(reverse('admin:tests_book_changelist'))
+        self.assertNotIn('revert_to_date', changelist.unicode_normal_body)
+
     def test_history_form_permission(self):
         self.login(self.user)
         person = Person.objects.create(name='Sandra Hale')
@@ -211,6 +449,24 @@ class AdminSiteTest(AdminTest):
             self.app.get(reverse('admin:tests_book_add'))
             self.assertFalse(hasattr(HistoricalRecords.thread, 'request'))
 
+    def test_buffer_middleware_saves_user(self):
+        overridden_settings = {
+            'MIDDLEWARE_CLASSES':
+                settings.MIDDLEWARE_CLASSES +
+                ['simple_history.middleware.HistoryBufferMiddleware'],
+        }
+        with override_settings(**overridden_settings):
+            self.login()
+            form = self.app.get(reverse('admin:tests_book_add')).form
+            form["isbn"] = "9780147_513731"
+            form.submit()
+            self.assertEqual(
+                [(record.history_type, record.history_user)
+                 for record in Book.history.all()],
+                [('+', self.user)])
+            self.assertFalse(hasattr(HistoricalRecords.thread,
+                                     'history_buffer'))
+
     def test_rolled_back_user_does_not_lead_to_foreign_key_error(self):
         # This test simulates the rollback of a user after a request (which
         # happens, e.g. in test cases), and verifies that subsequently
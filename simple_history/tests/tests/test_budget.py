@@ -0,0 +1,240 @@
+from __future__ import unicode_literals
+
+import copy
+from datetime import datetime, timedelta
+
+from six.moves import cStringIO as StringIO
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core import management
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from simple_history.feed import recent_changes
+from ..models import Article, Book, Poll, Tag
+from .query_budget import QueryBudgetMixin
+
+User = get_user_model()
+today = datetime(2021, 1, 1, 10, 0)
+
+
+def create_polls(count):
+    return [Poll.objects.create(question="Poll %s" % index, pub_date=today)
+            for index in range(count)]
+
+
+def create_history(obj, depth, history_user=None):
+    """Record `depth` more changes of `obj`, an hour apart."""
+    changes = []
+    for index in range(depth):
+        change = copy.copy(obj)
+        change._history_date = today + timedelta(hours=index + 1)
+        changes.append(change)
+    type(obj).history.bulk_history_create(changes,
+                                          history_user=history_user)
+
+
+def create_article(tags):
+    article = Article.objects.create(title="Colours")
+    article.tags.add(*[Tag.objects.create(name="Tag %s" % index)
+                       for index in range(tags)])
+    return article
+
+
+class CaptureQueryBudgetTest(QueryBudgetMixin, TestCase):
+
+    def test_save(self):
+        def prepare(depth):
+            poll, = create_polls(1)
+            create_history(poll, depth)
+            return poll.save
+        # UPDATE and INSERT of the historical record
+        self.assertQueryBudget(2, prepare)
+
+    def test_delete(self):
+        def prepare(depth):
+            poll, = create_polls(1)
+            create_history(poll, depth)
+            return poll.delete
+        # The choices to delete, the deletion and its historical record
+        self.assertQueryBudget(4, prepare)
+
+    def test_m2m_add(self):
+        def prepare(count):
+            article = Article.objects.create(title="Colours")
+            tags = [Tag.objects.create(name="Tag %s" % index)
+                    for index in range(count)]
+            return lambda: article.tags.add(*tags)
+        self.assertQueryBudget(4, prepare)
+
+    def test_m2m_remove(self):
+        def prepare(count):
+            article = create_article(count)
+            return lambda: article.tags.remove(*article.tags.all())
+        self.assertQueryBudget(5, prepare)
+
+    def test_m2m_clear(self):
+        def prepare(count):
+            article = create_article(count)
+            return article.tags.clear
+        self.assertQueryBudget(4, prepare)
+
+    def test_m2m_clear_and_add(self):
+        def prepare(count):
+            article = create_article(count)
+            tags = list(article.tags.all())
+
+            def clear_and_add():
+                article.tags.clear()
+                article.tags.add(*tags[:1])
+            return clear_and_add
+        # The targets of the cleared rows are loaded along with them
+        self.assertQueryBudget(8, prepare)
+
+    def test_delete_with_m2m(self):
+        def prepare(count):
+            return create_article(count).delete
+        self.assertQueryBudget(8, prepare)
+
+    def test_bulk_history_create(self):
+        def prepare(count):
+            polls = create_polls(count)
+            return lambda: Poll.history.bulk_history_create(polls)
+        self.assertQueryBudget(1, prepare)
+
+    def test_populate_history(self):
+        def prepare(count):
+            create_polls(count)
+            Poll.history.all().delete()
+            return lambda: management.call_command(
+                'populate_history', 'tests.poll', stdout=StringIO(),
+                stderr=StringIO())
+        # Checks for existing history, reads and copies a page, then finds
+        # the next page empty
+        self.assertQueryBudget(4, prepare)
+
+
+class ReadQueryBudgetTest(QueryBudgetMixin, TestCase):
+
+    def test_as_of(self):
+        def prepare(depth):
+            poll, = create_polls(1)
+            create_history(poll, depth)
+            return lambda: poll.history.as_of(today + timedelta(hours=1))
+        self.assertQueryBudget(1, prepare)
+
+    def test_as_of_set(self):
+        def prepare(count):
+            for poll in create_polls(count):
+                create_history(poll, 2)
+            return lambda: list(Poll.history.as_of(today + timedelta(hours=1)))
+        self.assertQueryBudget(1, prepare)
+
+    def test_most_recent(self):
+        def prepare(depth):
+            poll, = create_polls(1)
+            create_history(poll, depth)
+            return poll.history.most_recent
+        self.assertQueryBudget(1, prepare)
+
+    def test_prefetch_neighbours(self):
+        def prepare(depth):
+            poll, = create_polls(1)
+            create_history(poll, depth)
+
+            def neighbours():
+                records = poll.history.with_neighbours()
+                for record in poll.history.prefetch_neighbours(records):
+                    record.next_record
+                    record.prev_record
+            return neighbours
+        self.assertQueryBudget(2, prepare)
+
+    def test_revert_to(self):
+        def prepare(count):
+            for poll in create_polls(count):
+                create_history(poll, 2)
+            return lambda: Poll.history.revert_to(today + timedelta(hours=1))
+        self.assertQueryBudget(4, prepare)
+
+    def test_undelete(self):
+        def prepare(count):
+            article = create_article(count)
+            article.delete()
+            return Article.history.undelete
+        self.assertQueryBudget(8, prepare)
+
+    def test_recent_changes(self):
+        def prepare(count):
+            create_polls(count)
+            Book.objects.create(isbn="1")
+            history_models = [Poll.history.model, Book.history.model]
+            return lambda: list(recent_changes(history_models))
+        self.assertQueryBudget(2, prepare)
+
+
+class AdminQueryBudgetTest(QueryBudgetMixin, TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('user_login',
+                                                  'u@example.com', 'pass')
+        self.client.login(username='user_login', password='pass')
+
+    def get(self, url):
+        # Content types are cached after the first lookup
+        ContentType.objects.clear_cache()
+
+        def get():
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+        return get
+
+    def create_poll(self, depth):
+        poll, = create_polls(1)
+        create_history(poll, depth, self.user)
+        return poll, poll.history.order_by('history_id')
+
+    def test_history_view(self):
+        def prepare(depth):
+            poll, records = self.create_poll(depth)
+            return self.get(reverse('admin:tests_poll_history',
+                                    args=[poll.pk]))
+        self.assertQueryBudget(5, prepare)
+
+    def test_history_form_view(self):
+        def prepare(depth):
+            poll, records = self.create_poll(depth)
+            return self.get(reverse('admin:tests_poll_simple_history',
+                                    args=[poll.pk, records[0].history_id]))
+        self.assertQueryBudget(4, prepare)
+
+    def test_compare_view(self):
+        def prepare(depth):
+            poll, records = self.create_poll(depth)
+            return self.get('%s?from=%s&to=%s' % (
+                reverse('admin:tests_poll_simple_compare', args=[poll.pk]),
+                records.first().history_id, records.last().history_id))
+        self.assertQueryBudget(4, prepare)
+
+    def test_compare_field_view(self):
+        def prepare(depth):
+            poll, records = self.create_poll(depth)
+            cache.clear()
+            return self.get('%s?from=%s&to=%s&field=question' % (
+                reverse('admin:tests_poll_simple_compare_field',
+                        args=[poll.pk]),
+                records.first().history_id, records.last().history_id))
+        self.assertQueryBudget(4, prepare)
+
+    def test_history_stats_view(self):
+        def prepare(count):
+            create_polls(count)
+            return self.get(reverse('admin:tests_poll_simple_history_stats'))
+        self.assertQueryBudget(7, prepare)
+
+    def test_recent_changes_view(self):
+        def prepare(count):
+            create_polls(count)
+            return self.get(reverse('simple_history_recent_changes'))
+        self.assertQueryBudget(9, prepare)
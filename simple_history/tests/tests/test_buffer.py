@@ -0,0 +1,101 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from django.db import transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase
+
+from simple_history.buffer import on_commit
+from simple_history.middleware import HistoryBufferMiddleware
+from simple_history.models import HistoricalRecords
+from ..models import Choice, Label, Poll
+from .test_models import today
+
+
+class HistoryBufferTestMixin(object):
+
+    def setUp(self):
+        self.middleware = HistoryBufferMiddleware()
+        self.request = RequestFactory().get('/')
+        self.middleware.process_request(self.request)
+
+    def tearDown(self):
+        self.middleware.process_response(self.request, HttpResponse())
+
+    def create_polls(self):
+        for index in range(3):
+            poll = Poll.objects.create(question="Poll %s" % index,
+                                       pub_date=today)
+            Choice.objects.create(poll=poll, choice="Yes", votes=0)
+
+
+class HistoryBufferTest(HistoryBufferTestMixin, TestCase):
+
+    def test_one_insert_per_model(self):
+        self.create_polls()
+        self.assertEqual(Poll.history.count(), 0)
+        with self.assertNumQueries(2):
+            self.middleware.process_response(self.request, HttpResponse())
+        self.assertEqual(Poll.history.count(), 3)
+        self.assertEqual(Choice.history.count(), 3)
+        self.assertFalse(hasattr(HistoricalRecords.thread, 'history_buffer'))
+        self.assertFalse(hasattr(HistoricalRecords.thread, 'request'))
+
+    def test_overridden_save(self):
+        Label.objects.create(name="red")
+        self.middleware.process_response(self.request, HttpResponse())
+        self.assertEqual(Label.history.get().history_note, "saved")
+
+    def test_flush_on_exception(self):
+        self.create_polls()
+        self.middleware.process_exception(self.request, ValueError())
+        self.assertEqual(Poll.history.count(), 3)
+
+    @unittest.skipIf(on_commit is None, "Requires transaction.on_commit")
+    def test_rolled_back_records(self):
+        Poll.objects.create(question="Kept", pub_date=today)
+        try:
+            with transaction.atomic():
+                Poll.objects.create(question="Rolled back", pub_date=today)
+                raise ValueError
+        except ValueError:
+            pass
+        self.middleware.process_response(self.request, HttpResponse())
+        self.assertEqual(
+            list(Poll.history.values_list('question', flat=True)), ["Kept"])
+
+
+@unittest.skipIf(on_commit is None, "Requires transaction.on_commit")
+class HistoryBufferTransactionTest(HistoryBufferTestMixin,
+                                   TransactionTestCase):
+
+    def test_autocommit(self):
+        self.create_polls()
+        self.assertEqual(Poll.history.count(), 0)
+        self.middleware.process_response(self.request, HttpResponse())
+        self.assertEqual(Poll.history.count(), 3)
+        self.assertEqual(Choice.history.count(), 3)
+
+    def test_buffered_on_commit(self):
+        with transaction.atomic():
+            self.create_polls()
+        try:
+            with transaction.atomic():
+                Poll.objects.create(question="Rolled back", pub_date=today)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(Poll.history.count(), 0)
+        # BEGIN and the inserts of the historical polls and choices
+        with self.assertNumQueries(3):
+            self.middleware.process_response(self.request, HttpResponse())
+        self.assertEqual(Poll.history.count(), 3)
+
+    def test_committed_after_the_request(self):
+        with transaction.atomic():
+            self.create_polls()
+            self.middleware.process_response(self.request, HttpResponse())
+            self.assertEqual(Poll.history.count(), 3)
+            Poll.objects.create(question="After", pub_date=today)
+        self.assertEqual(Poll.history.count(), 4)
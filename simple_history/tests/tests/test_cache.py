@@ -0,0 +1,152 @@
+from datetime import datetime, timedelta
+
+from mock import patch
+from six.moves import cStringIO as StringIO
+from django.core import management
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from simple_history.cache import (
+    DjangoHistoryCache, LocalHistoryCache, get_date_bucket, get_history_cache)
+
+from ..models import Poll, HistoricalPoll
+
+LOCAL_CACHE = {'MAX_SIZE': 10, 'TIMEOUT': 60}
+SHARED_CACHE = {'BACKEND': 'history'}
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'history': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'history',
+    },
+}
+
+
+class LocalHistoryCacheTest(TestCase):
+
+    def test_lru_eviction(self):
+        cache = LocalHistoryCache(max_size=2)
+        cache.set(('t', 1, 'a'), 'a')
+        cache.set(('t', 1, 'b'), 'b')
+        cache.get(('t', 1, 'a'))
+        cache.set(('t', 2, 'c'), 'c')
+        self.assertEqual(cache.get(('t', 1, 'a')), 'a')
+        self.assertRaises(KeyError, cache.get, ('t', 1, 'b'))
+        self.assertEqual(cache.stats(), {
+            'hits': 2, 'misses': 1, 'size': 2, 'max_size': 2})
+
+    def test_timeout(self):
+        cache = LocalHistoryCache(timeout=10)
+        with patch('simple_history.cache.time.time', return_value=100):
+            cache.set(('t', 1, 'a'), 'a')
+        with patch('simple_history.cache.time.time', return_value=111):
+            self.assertRaises(KeyError, cache.get, ('t', 1, 'a'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_invalidate(self):
+        cache = LocalHistoryCache()
+        cache.set(cache.make_key(HistoricalPoll, 1, 'a'), 'a')
+        cache.set(cache.make_key(HistoricalPoll, 1, 'b'), 'b')
+        cache.set(cache.make_key(HistoricalPoll, 2, 'a'), 'c')
+        cache.invalidate(HistoricalPoll, 1)
+        self.assertEqual(cache.stats()['size'], 1)
+        self.assertEqual(cache.get(cache.make_key(HistoricalPoll, 2, 'a')),
+                         'c')
+
+    def test_invalidate_model(self):
+        cache = LocalHistoryCache()
+        cache.set(cache.make_key(HistoricalPoll, 1, 'a'), 'a')
+        cache.set(cache.make_key(HistoricalPoll, 2, 'a'), 'b')
+        cache.set(('other', 1, 'a'), 'c')
+        cache.invalidate_model(HistoricalPoll)
+        self.assertEqual(cache.stats()['size'], 1)
+        self.assertEqual(cache.get(('other', 1, 'a')), 'c')
+
+
+@override_settings(SIMPLE_HISTORY_CACHE=LOCAL_CACHE)
+class CachedHistoryManagerTest(TestCase):
+
+    def setUp(self):
+        self.poll = Poll.objects.create(question="what's up?",
+                                        pub_date=datetime.now())
+        self.cache = get_history_cache()
+        self.cache.clear()
+
+    def test_most_recent_is_cached(self):
+        self.assertEqual(self.poll.history.most_recent().question,
+                         "what's up?")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.poll.history.most_recent().question,
+                             "what's up?")
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_save_invalidates(self):
+        self.poll.history.most_recent()
+        self.poll.question = "ask questions?"
+        self.poll.save()
+        self.assertEqual(self.poll.history.most_recent().question,
+                         "ask questions?")
+
+    def test_as_of_is_cached(self):
+        date = datetime.now()
+        self.assertEqual(self.poll.history.as_of(date).question,
+                         "what's up?")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.poll.history.as_of(date).question,
+                             "what's up?")
+
+    def test_missing_is_cached(self):
+        date = datetime.now() - timedelta(days=1)
+        self.assertRaises(Poll.DoesNotExist, self.poll.history.as_of, date)
+        with self.assertNumQueries(0):
+            self.assertRaises(Poll.DoesNotExist,
+                              self.poll.history.as_of, date)
+
+    def test_delete_invalidates(self):
+        pk = self.poll.pk
+        self.poll.history.most_recent()
+        self.poll.delete()
+        self.poll.pk = pk
+        self.assertEqual(self.poll.history.most_recent().pk, pk)
+        self.assertEqual(self.cache.stats()['hits'], 0)
+
+    def test_populate_invalidates(self):
+        for options in ({}, {'fast': True}):
+            self.poll.history.all().delete()
+            self.cache.clear()
+            self.assertRaises(Poll.DoesNotExist,
+                              self.poll.history.most_recent)
+            management.call_command('populate_history', 'tests.poll',
+                                    stdout=StringIO(), stderr=StringIO(),
+                                    **options)
+            self.assertEqual(self.poll.history.most_recent().question,
+                             "what's up?")
+
+    @override_settings(SIMPLE_HISTORY_CACHE=dict(LOCAL_CACHE, DATE_BUCKET=60))
+    def test_date_bucket(self):
+        date = datetime(2021, 1, 1, 10, 0, 59)
+        self.assertEqual(get_date_bucket(date), datetime(2021, 1, 1, 10, 0))
+
+
+@override_settings(SIMPLE_HISTORY_CACHE=SHARED_CACHE, CACHES=CACHES)
+class SharedCacheTest(TestCase):
+
+    def test_shared_cache(self):
+        cache = get_history_cache()
+        self.assertIsInstance(cache, DjangoHistoryCache)
+        poll = Poll.objects.create(question="what's up?",
+                                   pub_date=datetime.now())
+        poll.history.most_recent()
+        with self.assertNumQueries(0):
+            poll.history.most_recent()
+        poll.question = "ask questions?"
+        poll.save()
+        self.assertEqual(poll.history.most_recent().question,
+                         "ask questions?")
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2})
+        HistoricalPoll.objects.update(question="what's new?")
+        cache.invalidate_model(HistoricalPoll)
+        self.assertEqual(poll.history.most_recent().question,
+                         "what's new?")
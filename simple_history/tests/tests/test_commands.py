@@ -1,12 +1,26 @@
+import csv
+import gzip
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import datetime, timedelta
 
+from mock import call, patch
 from six.moves import cStringIO as StringIO
 from django.test import TestCase
 from django.core import management
 
 from simple_history import models as sh_models
-from simple_history.management.commands import populate_history
+from simple_history.management.commands import _populate_utils as utils
+from simple_history.management.commands import (
+    build_history_checkpoint, export_history, populate_history,
+    undelete_history)
 
 from .. import models
 
@@ -62,6 +76,311 @@ class TestPopulateHistory(TestCase):
                                 stdout=StringIO(), stderr=StringIO())
         self.assertEqual(models.Poll.history.all().count(), 1)
 
+    def test_populate_in_pages(self):
+        for index in range(5):
+            models.Poll.objects.create(question="Poll %s" % index,
+                                       pub_date=datetime.now())
+        models.Poll.history.all().delete()
+        # existing history check, 3 pages and an empty one, 1 insert per page
+        with self.assertNumQueries(1 + 4 + 3):
+            management.call_command(self.command_name, "tests.poll",
+                                    batchsize=2,
+                                    stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(
+            sorted(models.Poll.history.values_list('question', flat=True)),
+            ["Poll %s" % index for index in range(5)])
+
+    def test_populate_with_workers(self):
+        for index in range(5):
+            models.Poll.objects.create(question="Poll %s" % index,
+                                       pub_date=datetime.now())
+        models.Poll.history.all().delete()
+        models.Book.objects.create(isbn="9780007117116")
+        models.Book.history.all().delete()
+        out = StringIO()
+        management.call_command(self.command_name, "tests.poll", "tests.book",
+                                workers=2, stdout=out, stderr=StringIO())
+        self.assertEqual(models.Poll.history.count(), 5)
+        self.assertEqual(models.Book.history.count(), 1)
+        self.assertIn("saved 6 historical records", out.getvalue())
+        self.assertIn(populate_history.Command.DONE_SAVING_FOR_MODEL.format(
+            model=models.Poll), out.getvalue())
+
+    def test_populate_in_worker_pool(self):
+        for index in range(5):
+            models.Poll.objects.create(question="Poll %s" % index,
+                                       pub_date=datetime.now())
+        models.Poll.history.all().delete()
+        # The pool runs the ranges in this process, which holds the
+        # in-memory test database
+        with patch.object(utils, 'supports_parallel_writes',
+                          return_value=True), \
+                patch.object(utils.multiprocessing, 'Pool') as pool:
+            pool.return_value.imap_unordered.side_effect = (
+                lambda function, tasks: [function(task) for task in tasks])
+            out = StringIO()
+            management.call_command(self.command_name, "tests.poll",
+                                    workers=2, stdout=out, stderr=StringIO())
+        pool.assert_called_once_with(2, initializer=utils._setup_worker)
+        self.assertEqual(
+            len(pool.return_value.imap_unordered.call_args[0][1]), 2)
+        pool.return_value.close.assert_called_once_with()
+        pool.return_value.join.assert_called_once_with()
+        self.assertEqual(models.Poll.history.count(), 5)
+        self.assertIn(populate_history.Command.DONE_SAVING_FOR_MODEL.format(
+            model=models.Poll), out.getvalue())
+
+    @unittest.skipIf(sys.platform == 'win32', "Requires forked workers")
+    def test_populate_in_real_worker_pool(self):
+        for index in range(5):
+            models.Poll.objects.create(question="Poll %s" % index,
+                                       pub_date=datetime.now())
+        models.Poll.history.all().delete()
+        # Forked workers can't reach the in-memory test database, so they
+        # only report the ranges they were given
+        with patch.object(utils, 'supports_parallel_writes',
+                          return_value=True), \
+                patch.object(utils, 'populate_range', _report_range):
+            out = StringIO()
+            management.call_command(self.command_name, "tests.poll",
+                                    workers=2, stdout=out, stderr=StringIO())
+        self.assertIn(populate_history.Command.DONE_SAVING_FOR_MODEL.format(
+            model=models.Poll), out.getvalue())
+        workers = re.findall(r'Worker (\S+) saved (\d+) historical records',
+                             out.getvalue())
+        self.assertTrue(workers)
+        self.assertNotIn(multiprocessing.current_process().name,
+                         [worker for worker, count in workers])
+        self.assertEqual(sum(int(count) for worker, count in workers), 2)
+
+    def test_populate_range_transaction(self):
+        models.Poll.objects.create(question="Poll", pub_date=datetime.now())
+        models.Poll.history.all().delete()
+        with patch.object(utils.router, 'db_for_write',
+                          return_value='default') as db_for_write, \
+                patch.object(utils.transaction, 'atomic',
+                             wraps=utils.transaction.atomic) as atomic:
+            utils.populate_range(('tests.poll', 10, None, None, False, False))
+        db_for_write.assert_any_call(models.Poll.history.model)
+        # The first transaction is the range's, bulk_create opens its own
+        self.assertEqual(atomic.call_args_list[0], call(using='default'))
+        self.assertEqual(models.Poll.history.count(), 1)
+
+    def test_checkpoint_file_with_workers(self):
+        self.assertRaises(self.command_error, management.call_command,
+                          self.command_name, "tests.poll", workers=2,
+                          checkpoint_file='checkpoint.json',
+                          stdout=StringIO(), stderr=StringIO())
+
+    def test_pk_ranges(self):
+        self.assertEqual(utils.get_pk_ranges(models.Poll, 2), [(None, None)])
+        polls = [models.Poll.objects.create(question="Poll %s" % index,
+                                            pub_date=datetime.now())
+                 for index in range(5)]
+        low = polls[0].pk
+        self.assertEqual(utils.get_pk_ranges(models.Poll, 2),
+                         [(low, low + 3), (low + 3, low + 6)])
+        self.assertEqual(utils.get_pk_ranges(models.Poll, 1), [(None, None)])
+        models.Book.objects.create(isbn="9780007117116")
+        self.assertEqual(utils.get_pk_ranges(models.Book, 2), [(None, None)])
+
+    def test_populate_missing_only(self):
+        polls = [models.Poll.objects.create(question="Poll %s" % index,
+                                            pub_date=datetime.now())
+                 for index in range(3)]
+        models.Poll.history.filter(id=polls[1].pk).delete()
+        out = StringIO()
+        management.call_command(self.command_name, "tests.poll",
+                                missing_only=True, stdout=out,
+                                stderr=StringIO())
+        self.assertEqual(models.Poll.history.count(), 3)
+        self.assertEqual(models.Poll.history.filter(id=polls[1].pk).count(), 1)
+        self.assertIn(populate_history.Command.DONE_SAVING_FOR_MODEL.format(
+            model=models.Poll), out.getvalue())
+
+    def test_populate_resume(self):
+        polls = [models.Poll.objects.create(question="Poll %s" % index,
+                                            pub_date=datetime.now())
+                 for index in range(4)]
+        models.Poll.history.all().delete()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        checkpoint_file = os.path.join(directory, 'checkpoint.json')
+        with open(checkpoint_file, 'w') as f:
+            json.dump({'tests.poll': {'last_pk': polls[1].pk,
+                                      'done': False}}, f)
+        management.call_command(self.command_name, "tests.poll",
+                                resume=True, checkpoint_file=checkpoint_file,
+                                batchsize=1, stdout=StringIO(),
+                                stderr=StringIO())
+        self.assertEqual(
+            sorted(models.Poll.history.values_list('id', flat=True)),
+            [polls[2].pk, polls[3].pk])
+        with open(checkpoint_file) as f:
+            self.assertEqual(json.load(f), {
+                'tests.poll': {'last_pk': polls[3].pk, 'done': True}})
+
+        err = StringIO()
+        management.call_command(self.command_name, "tests.poll",
+                                resume=True, checkpoint_file=checkpoint_file,
+                                stdout=StringIO(), stderr=err)
+        self.assertIn(populate_history.Command.ALREADY_POPULATED,
+                      err.getvalue())
+        self.assertEqual(models.Poll.history.count(), 2)
+
+    def test_resume_after_unrecorded_batch(self):
+        polls = [models.Poll.objects.create(question="Poll %s" % index,
+                                            pub_date=datetime.now())
+                 for index in range(3)]
+        models.Poll.history.exclude(id=polls[1].pk).delete()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        checkpoint_file = os.path.join(directory, 'checkpoint.json')
+        with open(checkpoint_file, 'w') as f:
+            json.dump({'tests.poll': {'last_pk': polls[0].pk,
+                                      'done': False}}, f)
+        management.call_command(self.command_name, "tests.poll",
+                                resume=True, checkpoint_file=checkpoint_file,
+                                stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(
+            sorted(models.Poll.history.values_list('id', flat=True)),
+            [polls[1].pk, polls[2].pk])
+
+    def test_interrupted_checkpoint_write(self):
+        models.Poll.objects.create(question="Poll", pub_date=datetime.now())
+        models.Poll.history.all().delete()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        checkpoint_file = os.path.join(directory, 'checkpoint.json')
+        with open(checkpoint_file, 'w') as f:
+            json.dump({}, f)
+        with patch.object(populate_history, 'replace_file',
+                          side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, management.call_command,
+                              self.command_name, "tests.poll",
+                              resume=True, checkpoint_file=checkpoint_file,
+                              stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(os.listdir(directory), ['checkpoint.json'])
+        with open(checkpoint_file) as f:
+            self.assertEqual(json.load(f), {})
+
+    def test_resume_needs_checkpoint_file(self):
+        self.assertRaises(self.command_error, management.call_command,
+                          self.command_name, "tests.poll", resume=True,
+                          stdout=StringIO(), stderr=StringIO())
+
+    def test_populate_fast(self):
+        poll = models.Poll.objects.create(question="Fast?",
+                                          pub_date=datetime.now())
+        choices = [models.Choice.objects.create(poll=poll, votes=index,
+                                                choice="Choice %s" % index)
+                   for index in range(3)]
+        models.Choice.history.all().delete()
+        out = StringIO()
+        management.call_command(self.command_name, "tests.choice", fast=True,
+                                stdout=out, stderr=StringIO())
+        self.assertIn("Saved 3 historical records of %s with insert_select"
+                      % models.Choice, out.getvalue())
+        self.assertEqual(
+            sorted(models.Choice.history.values_list(
+                'id', 'poll_id', 'choice', 'votes', 'history_user_id')),
+            [(choice.pk, poll.pk, choice.choice, choice.votes, None)
+             for choice in choices])
+
+    def test_fast_history_create_in_batches(self):
+        poll = models.Poll.objects.create(question="Fast?",
+                                          pub_date=datetime.now())
+        choices = [models.Choice.objects.create(poll=poll, votes=index,
+                                                choice="Choice %s" % index)
+                   for index in range(3)]
+        models.Choice.history.filter(id=choices[1].pk).delete()
+        batches = []
+        with self.assertNumQueries(2):
+            count = utils.fast_history_create(
+                models.Choice, models.Choice.history.model, 2,
+                missing_only=True, strategy='executemany',
+                on_batch=lambda last_pk, count: batches.append(count))
+        self.assertEqual((count, batches), (1, [1]))
+        record = models.Choice.history.get(id=choices[1].pk,
+                                           history_type='')
+        self.assertEqual((record.poll_id, record.choice, record.votes),
+                         (poll.pk, "Choice 1", 1))
+        models.Choice.history.all().delete()
+        with self.assertNumQueries(4):
+            count = utils.fast_history_create(
+                models.Choice, models.Choice.history.model, 2,
+                strategy='executemany')
+        self.assertEqual(count, 3)
+        self.assertEqual(models.Choice.history.count(), 3)
+
+    def test_insert_select_in_batches(self):
+        poll = models.Poll.objects.create(question="Fast?",
+                                          pub_date=datetime.now())
+        choices = [models.Choice.objects.create(poll=poll, votes=index,
+                                                choice="Choice %s" % index)
+                   for index in range(3)]
+        models.Choice.history.all().delete()
+        batches = []
+        # The last pk and the INSERT ... SELECT of each batch, and the
+        # highest pk of the last one
+        with self.assertNumQueries(5):
+            count = utils.fast_history_create(
+                models.Choice, models.Choice.history.model, 2,
+                strategy='insert_select',
+                on_batch=lambda last_pk, count: batches.append(
+                    (last_pk, count)))
+        self.assertEqual(count, 3)
+        self.assertEqual(batches, [(choices[1].pk, 2), (choices[2].pk, 3)])
+        self.assertEqual(
+            sorted(models.Choice.history.values_list('id', 'votes')),
+            [(choice.pk, choice.votes) for choice in choices])
+
+    def test_copy_value(self):
+        self.assertEqual(
+            [utils._copy_value(value) for value in (
+                None, True, 3, bytearray(b'\x01\xff'), {'a': 1},
+                'tab\there\\')],
+            ['\\N', 't', '3', '\\\\x01ff', '{"a": 1}', 'tab\\there\\\\'])
+
+    def test_populate_progress(self):
+        for index in range(3):
+            models.Poll.objects.create(question="Poll %s" % index,
+                                       pub_date=datetime.now())
+        models.Poll.history.all().delete()
+        out = StringIO()
+        with patch.object(populate_history.Command, 'PROGRESS_INTERVAL', 0):
+            management.call_command(self.command_name, "tests.poll",
+                                    batchsize=2, stdout=out,
+                                    stderr=StringIO())
+        self.assertIn("Saved 2 of about 3 historical records of %s"
+                      % models.Poll, out.getvalue())
+        self.assertIn("Saved 3 of about 3 historical records of %s"
+                      % models.Poll, out.getvalue())
+        self.assertIn("0s left", out.getvalue())
+
+    def test_populate_dry_run(self):
+        for index in range(4):
+            models.Poll.objects.create(question="Poll %s" % index,
+                                       pub_date=datetime.now())
+        models.Poll.history.all().delete()
+        models.Book.objects.create(isbn="9780007117116")
+        out = StringIO()
+        management.call_command(self.command_name, "tests.poll", "tests.book",
+                                dry_run=True, stdout=out, stderr=StringIO())
+        self.assertIn("%s: about 4 historical records" % models.Poll,
+                      out.getvalue())
+        self.assertIn(populate_history.Command.NO_ESTIMATE.format(
+            model=models.Book), out.getvalue())
+        self.assertEqual(models.Poll.history.count(), 0)
+        self.assertEqual(models.Book.history.count(), 1)
+
+    def test_estimate_row_width(self):
+        width = utils.estimate_row_width(models.Poll,
+                                         models.Poll.history.model)
+        # id, question, pub_date and history_id, history_date,
+        # history_user and history_type
+        self.assertEqual(width, 4 + 100 + 8 + 4 + 8 + 4 + 1)
+
     def test_specific_populate(self):
         models.Poll.objects.create(question="Will this populate?",
                                    pub_date=datetime.now())
@@ -111,3 +430,155 @@ class TestPopulateHistory(TestCase):
                                     stdout=out)
         self.assertIn(populate_history.Command.NO_REGISTERED_MODELS,
                       out.getvalue())
+
+
+class TestBuildHistoryCheckpoint(TestCase):
+    command_name = 'build_history_checkpoint'
+
+    def test_build_checkpoint(self):
+        models.Ledger.objects.create(name="Will this checkpoint?")
+        out = StringIO()
+        management.call_command(self.command_name, 'tests.ledger',
+                                stdout=out, stderr=StringIO())
+        self.assertIn("Stored checkpoint of 1 objects", out.getvalue())
+        checkpoint_model = models.Ledger.history.model.checkpoint_model
+        self.assertEqual(checkpoint_model.objects.count(), 1)
+
+    def test_no_checkpoint_table(self):
+        out = StringIO()
+        management.call_command(self.command_name, 'tests.poll',
+                                stdout=StringIO(), stderr=out)
+        self.assertIn(build_history_checkpoint.Command.NO_CHECKPOINT_TABLE,
+                      out.getvalue())
+
+    def test_invalid_date(self):
+        self.assertRaises(management.CommandError, management.call_command,
+                          self.command_name, 'tests.ledger', date='never',
+                          stdout=StringIO(), stderr=StringIO())
+
+
+class TestUndeleteHistory(TestCase):
+    command_name = 'undelete_history'
+
+    def setUp(self):
+        self.polls = [
+            models.Poll.objects.create(question=question,
+                                       pub_date=datetime.now())
+            for question in ("why?", "how?")]
+        self.pks = [poll.pk for poll in self.polls]
+        models.Poll.objects.all().delete()
+
+    def test_undelete(self):
+        out = StringIO()
+        management.call_command(self.command_name, 'tests.poll',
+                                stdout=out, stderr=StringIO())
+        self.assertIn("Restored 2 objects", out.getvalue())
+        self.assertEqual(models.Poll.objects.count(), 2)
+
+    def test_pk_filter(self):
+        management.call_command(self.command_name, 'tests.poll',
+                                pks=[str(self.pks[1])],
+                                stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(
+            list(models.Poll.objects.values_list('question', flat=True)),
+            ["how?"])
+
+    def test_date_filter(self):
+        start = (datetime.now() + timedelta(days=1)).isoformat()
+        management.call_command(self.command_name, 'tests.poll', start=start,
+                                stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(models.Poll.objects.count(), 0)
+
+    def test_invalid_date(self):
+        self.assertRaises(management.CommandError, management.call_command,
+                          self.command_name, 'tests.poll', end='never',
+                          stdout=StringIO(), stderr=StringIO())
+
+
+class TestExportHistory(TestCase):
+    command_name = 'export_history'
+
+    def setUp(self):
+        self.poll = models.Poll.objects.create(question="Will this export?",
+                                               pub_date=datetime.now())
+        self.poll.question = "Will this export again?"
+        self.poll.save()
+        self.other = models.Poll.objects.create(question="Other",
+                                                pub_date=datetime.now())
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def export(self, *args, **kwargs):
+        out = StringIO()
+        management.call_command(self.command_name, *args,
+                                stdout=out, stderr=StringIO(), **kwargs)
+        return out.getvalue()
+
+    def test_jsonl(self):
+        lines = self.export('tests.poll', batchsize=2).splitlines()
+        records = [json.loads(line) for line in lines]
+        self.assertEqual(
+            [record['pk'] for record in records],
+            sorted(models.Poll.history.values_list('history_id', flat=True)))
+        self.assertEqual(records[0]['model'], 'tests.historicalpoll')
+        self.assertEqual(records[0]['fields']['question'],
+                         "Will this export?")
+
+    def test_pk_filter(self):
+        lines = self.export('tests.poll', pks=[str(self.other.pk)])
+        records = [json.loads(line) for line in lines.splitlines()]
+        self.assertEqual([record['fields']['question'] for record in records],
+                         ["Other"])
+
+    def test_date_filter(self):
+        models.Poll.history.filter(question="Other").update(
+            history_date=datetime.now() - timedelta(days=2))
+        start = (datetime.now() - timedelta(days=1)).isoformat()
+        lines = self.export('tests.poll', start=start).splitlines()
+        self.assertEqual(len(lines), 2)
+        lines = self.export('tests.poll', end=start).splitlines()
+        self.assertEqual(len(lines), 1)
+
+    def test_csv_file(self):
+        path = os.path.join(self.tempdir, 'polls.csv')
+        self.export('tests.poll', format='csv', output=path)
+        with open(path) as output:
+            rows = list(csv.reader(output))
+        self.assertEqual(rows[0][:3], ['model', 'id', 'question'])
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1][2], "Will this export?")
+
+    def test_gzip(self):
+        path = os.path.join(self.tempdir, 'polls.jsonl.gz')
+        self.export('tests.poll', output=path, gzip=True)
+        with gzip.open(path) as output:
+            self.assertEqual(len(output.read().splitlines()), 3)
+
+    def test_gzip_needs_output(self):
+        self.assertRaises(management.CommandError, management.call_command,
+                          self.command_name, 'tests.poll', gzip=True,
+                          stdout=StringIO(), stderr=StringIO())
+
+    def test_progress(self):
+        err = StringIO()
+        management.call_command(self.command_name, 'tests.poll',
+                                stdout=StringIO(), stderr=err)
+        self.assertIn("Exported 3 records of HistoricalPoll", err.getvalue())
+
+    def test_options(self):
+        # Only populate_history honours the options of populating
+        for module in (build_history_checkpoint, export_history,
+                       undelete_history):
+            usage = module.Command().create_parser(
+                'manage.py', module.__name__).format_help()
+            self.assertIn('--batchsize', usage)
+            for option in ('--workers', '--fast', '--missing-only',
+                           '--dry-run', '--resume', '--checkpoint-file'):
+                self.assertNotIn(option, usage)
+
+
+def _report_range(task):
+    """Stand-in for `populate_range` counting one record per range."""
+    return multiprocessing.current_process().name, task[0], 1, 0.0
@@ -0,0 +1,123 @@
+from __future__ import unicode_literals
+
+import threading
+import unittest
+
+from django.contrib.auth import BACKEND_SESSION_KEY, SESSION_KEY, get_user
+from django.contrib.sessions.backends.cache import SessionStore
+from django.test import RequestFactory, TestCase
+from django.test.utils import override_settings
+from django.utils.functional import SimpleLazyObject
+
+from simple_history import context
+from simple_history.models import HistoricalRecords, get_request_user_id
+from ..models import Poll
+from .test_models import User, today
+
+try:
+    from django.contrib.auth import HASH_SESSION_KEY
+except ImportError:  # Django < 1.7
+    HASH_SESSION_KEY = None
+
+MODEL_BACKEND = 'django.contrib.auth.backends.ModelBackend'
+
+
+class ContextLocalTest(unittest.TestCase):
+
+    def test_attributes(self):
+        local = context.context_local('test')
+        self.assertFalse(hasattr(local, 'request'))
+        local.request = 'request'
+        self.assertEqual(local.request, 'request')
+        del local.request
+        self.assertFalse(hasattr(local, 'request'))
+        with self.assertRaises(AttributeError):
+            del local.request
+
+    def test_not_shared_by_threads(self):
+        local = context.context_local('test')
+        local.request = 'first'
+        seen = []
+        thread = threading.Thread(
+            target=lambda: seen.append(getattr(local, 'request', None)))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [None])
+
+    @unittest.skipIf(context.ContextVar is None, "Requires contextvars")
+    def test_copied_context(self):
+        import contextvars
+
+        local = context.context_local('test')
+        local.request = 'first'
+        copy = contextvars.copy_context()
+        local.request = 'second'
+        self.assertEqual(copy.run(lambda: local.request), 'first')
+        copy.run(setattr, local, 'request', 'third')
+        self.assertEqual(local.request, 'second')
+
+
+class HistoryUserIdTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.request = RequestFactory().get('/')
+        self.request.session = SessionStore()
+        self.request.session.update({SESSION_KEY: str(self.user.pk),
+                                     BACKEND_SESSION_KEY: MODEL_BACKEND})
+        if HASH_SESSION_KEY is not None:
+            self.request.session[HASH_SESSION_KEY] = (
+                self.user.get_session_auth_hash())
+        self.request.user = SimpleLazyObject(
+            lambda: get_user(self.request))
+        HistoricalRecords.thread.request = self.request
+
+    def tearDown(self):
+        del HistoricalRecords.thread.request
+
+    def test_user_id_from_session(self):
+        def save_poll():
+            poll = Poll.objects.create(question="what's up?", pub_date=today)
+            poll.question = "what's down?"
+            poll.save()
+            return poll
+
+        # The user, the poll and record inserts, the poll update and record
+        # insert
+        with self.assertNumQueries(5):
+            save_poll()
+        self.request.user = SimpleLazyObject(_unloaded_user)
+        with override_settings(SIMPLE_HISTORY_USER_ID_ONLY=True):
+            with self.assertNumQueries(4):
+                poll = save_poll()
+        self.assertEqual(
+            [record.history_user_id for record in poll.history.all()],
+            [self.user.pk, self.user.pk])
+
+    def test_loaded_user(self):
+        self.request.user = self.user
+        self.assertEqual(get_request_user_id(self.request), self.user.pk)
+        self.request.session = {}
+        self.assertEqual(get_request_user_id(self.request), self.user.pk)
+
+    def test_without_user_attribute(self):
+        del self.request.user
+        self.assertEqual(get_request_user_id(self.request), self.user.pk)
+
+    def test_unknown_backend(self):
+        self.request.session[BACKEND_SESSION_KEY] = 'unknown.Backend'
+        self.assertIsNone(get_request_user_id(self.request))
+
+    def test_anonymous(self):
+        self.request.session = {}
+        self.request.user = SimpleLazyObject(_unloaded_user)
+        self.assertIsNone(get_request_user_id(self.request))
+
+    def test_session_not_verified(self):
+        self.request.user = SimpleLazyObject(_unloaded_user)
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(get_request_user_id(self.request), self.user.pk)
+
+
+def _unloaded_user():
+    raise AssertionError("The user shouldn't be loaded")
@@ -0,0 +1,44 @@
+from django.test import TestCase
+
+from simple_history.diff import generate_diff
+
+
+class GenerateDiffTest(TestCase):
+
+    def test_unchanged(self):
+        self.assertEqual(generate_diff("why?", "why?"),
+                         '<span class="compare-unchanged">why?</span>')
+        self.assertEqual(generate_diff("", ""), '')
+        self.assertEqual(generate_diff(3, 3), '3')
+
+    def test_changed_word(self):
+        self.assertEqual(
+            generate_diff("what is it", "what was it"),
+            '<span class="compare-unchanged">what </span>'
+            '<span class="compare-removed">is</span>'
+            '<span class="compare-added">was</span>'
+            '<span class="compare-unchanged"> it</span>')
+
+    def test_not_strings(self):
+        self.assertEqual(
+            generate_diff(None, 3),
+            '<span class="compare-removed">None</span><br>'
+            '<span class="compare-added">3</span>')
+
+    def test_escapes_values(self):
+        diff = generate_diff("<b>old</b>", "<b>new</b>")
+        self.assertNotIn("<b>", diff)
+        self.assertIn('<span class="compare-removed">old</span>', diff)
+        self.assertIn('<span class="compare-added">new</span>', diff)
+
+    def test_max_tokens(self):
+        prev = "start " + " ".join(str(i) for i in range(10)) + " end"
+        curr = "start " + " ".join(str(i) for i in range(5, 15)) + " end"
+        self.assertEqual(
+            generate_diff(prev, curr, max_tokens=10),
+            '<span class="compare-unchanged">start </span>'
+            '<span class="compare-removed">0 1 2 3 4 5 6 7 8 9</span>'
+            '<span class="compare-added">5 6 7 8 9 10 11 12 13 14</span>'
+            '<span class="compare-unchanged"> end</span>')
+        self.assertIn('<span class="compare-unchanged">5 6 7 8 9</span>',
+                      generate_diff(prev, curr))
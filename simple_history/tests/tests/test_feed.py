@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+
+from django.test import TestCase
+
+from simple_history.feed import (
+    format_cursor, get_history_label, parse_cursor, recent_changes)
+from ..models import Book, Poll
+
+today = datetime(2021, 1, 1, 10, 0)
+
+
+class RecentChangesTest(TestCase):
+
+    def setUp(self):
+        self.history_models = [Poll.history.model, Book.history.model]
+        for index in range(3):
+            poll = Poll(question="why?", pub_date=today)
+            poll._history_date = today + timedelta(hours=index)
+            poll.save()
+            book = Book(isbn=str(index))
+            book._history_date = today + timedelta(hours=index)
+            book.save()
+
+    def labels(self, changes):
+        return [(key[0].hour, key[1]) for key, record in changes]
+
+    def test_merge_order(self):
+        changes = list(recent_changes(self.history_models, chunk_size=2))
+        self.assertEqual(self.labels(changes), [
+            (12, 'tests.historicalpoll'), (12, 'tests.historicalbook'),
+            (11, 'tests.historicalpoll'), (11, 'tests.historicalbook'),
+            (10, 'tests.historicalpoll'), (10, 'tests.historicalbook'),
+        ])
+        self.assertEqual(get_history_label(Book.history.model),
+                         'tests.historicalbook')
+
+    def test_after(self):
+        changes = list(recent_changes(self.history_models))
+        for index in range(len(changes)):
+            after = parse_cursor(format_cursor(changes[index][0]))
+            self.assertEqual(
+                list(recent_changes(self.history_models, after=after,
+                                    chunk_size=1)),
+                changes[index + 1:])
+
+    def test_filters(self):
+        Poll.objects.all().delete()
+        changes = list(recent_changes(self.history_models,
+                                      history_type='-'))
+        self.assertEqual(
+            [record.history_type for key, record in changes], ['-'] * 3)
+
+    def test_invalid_cursor(self):
+        self.assertIsNone(parse_cursor('nonsense'))
+        self.assertIsNone(parse_cursor('nonsense|tests.poll|1'))
+        self.assertIsNone(parse_cursor(None))
@@ -1,5 +1,10 @@
+import warnings
 from datetime import datetime, timedelta
+
+from mock import patch
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
 try:
     from django.contrib.auth import get_user_model
 except ImportError:
@@ -86,3 +91,362 @@ class AsOfAdditionalTestCase(TestCase):
         historical = models.Document.history.as_of(
             datetime.now() + timedelta(days=1))
         self.assertEqual(list(historical), [document1, document2])
+
+
+class CheckpointAsOfTest(TestCase):
+    model = models.Ledger
+
+    def setUp(self):
+        self.now = datetime.now()
+        self.first = self.model.objects.create(name="first")
+        self.second = self.model.objects.create(name="second")
+        self.set_dates(self.now - timedelta(days=3))
+        self.first.balance = 10
+        self.first.save()
+        self.second_pk = self.second.pk
+        self.second.delete()
+        self.third = self.model.objects.create(name="third")
+        self.set_dates(self.now - timedelta(days=1))
+
+    def set_dates(self, date):
+        self.model.history.filter(history_date__gt=date).update(
+            history_date=date)
+
+    def test_build_checkpoint(self):
+        count = self.model.history.build_checkpoint(
+            self.now - timedelta(days=2))
+        self.assertEqual(count, 2)
+        checkpoint_model = self.model.history.model.checkpoint_model
+        self.assertEqual(
+            sorted(checkpoint_model.objects.values_list('id', flat=True)),
+            [self.first.pk, self.second_pk])
+
+    def test_incremental_checkpoint(self):
+        self.model.history.build_checkpoint(self.now - timedelta(days=2))
+        count = self.model.history.build_checkpoint(self.now)
+        self.assertEqual(count, 2)
+        checkpoint_model = self.model.history.model.checkpoint_model
+        latest = checkpoint_model.objects.filter(checkpoint_date=self.now)
+        self.assertEqual(sorted(latest.values_list('id', flat=True)),
+                         [self.first.pk, self.third.pk])
+
+    def test_as_of_matches_without_checkpoint(self):
+        dates = [self.now - timedelta(days=days) for days in range(5)]
+        expected = [
+            [(obj.pk, obj.balance) for obj in self.model.history.as_of(date)]
+            for date in dates
+        ]
+        self.model.history.build_checkpoint(self.now - timedelta(days=2))
+        self.assertEqual(expected, [
+            [(obj.pk, obj.balance) for obj in self.model.history.as_of(date)]
+            for date in dates
+        ])
+
+    def test_checkpoint_in_chunks(self):
+        for i in range(5):
+            self.model.objects.create(name="fourth %d" % i)
+        self.first.delete()
+        dates = [self.now - timedelta(days=2), self.now + timedelta(days=1)]
+        expected = [
+            [(obj.pk, obj.balance) for obj in self.model.history.as_of(date)]
+            for date in dates
+        ]
+        with patch('simple_history.manager.CHUNK_SIZE', 2):
+            self.assertEqual(self.model.history.build_checkpoint(dates[0]), 2)
+            self.assertEqual(self.model.history.build_checkpoint(dates[1]), 6)
+            self.assertEqual(expected, [
+                [(obj.pk, obj.balance)
+                 for obj in self.model.history.as_of(date)]
+                for date in dates
+            ])
+
+    def test_without_checkpoint_table(self):
+        self.assertRaises(TypeError, models.Poll.history.build_checkpoint)
+
+
+class HistoryAggregationTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("tester", "tester@example.com")
+        self.poll1 = models.Poll.objects.create(question="why?",
+                                                pub_date=datetime.now())
+        self.poll2 = models.Poll(question="how?", pub_date=datetime.now())
+        self.poll2._history_user = self.user
+        self.poll2.save()
+        self.poll2.question = "how come?"
+        self.poll2.save()
+
+    def test_count_by_object(self):
+        self.assertEqual(list(models.Poll.history.count_by_object()), [
+            {'id': self.poll2.pk, 'count': 2},
+            {'id': self.poll1.pk, 'count': 1},
+        ])
+
+    def test_count_by_user(self):
+        self.assertEqual(list(models.Poll.history.count_by_user()), [
+            {'history_user': self.user.pk, 'count': 2},
+            {'history_user': None, 'count': 1},
+        ])
+
+    def test_count_by_type(self):
+        self.assertEqual(list(models.Poll.history.count_by_type()), [
+            {'history_type': '+', 'count': 2},
+            {'history_type': '~', 'count': 1},
+        ])
+
+    def test_count_by_date(self):
+        models.Poll.history.filter(question="why?").update(
+            history_date=datetime.now() - timedelta(days=2))
+        counts = models.Poll.history.count_by_date('day')
+        self.assertEqual([row['count'] for row in counts], [1, 2])
+        counts = models.Poll.history.count_by_date(
+            'day', start=datetime.now() - timedelta(days=1))
+        self.assertEqual([row['count'] for row in counts], [2])
+
+    def test_count_by_date_and_user(self):
+        counts = models.Poll.history.count_by_date(
+            'month', fields=('history_user',))
+        self.assertEqual(
+            dict((row['history_user'], row['count']) for row in counts),
+            {None: 1, self.user.pk: 2})
+
+    def test_count_by_invalid_period(self):
+        self.assertRaises(ValueError, models.Poll.history.count_by_date,
+                          'fortnight')
+
+    def test_count_on_instance(self):
+        self.assertEqual(
+            list(self.poll2.history.count_by_type()),
+            [{'history_type': '+', 'count': 1},
+             {'history_type': '~', 'count': 1}])
+
+
+class RecordNavigationTest(TestCase):
+
+    def setUp(self):
+        self.poll = models.Poll.objects.create(question="why?",
+                                               pub_date=datetime.now())
+        for question in ("how?", "when?"):
+            self.poll.question = question
+            self.poll.save()
+        models.Poll.objects.create(question="other?", pub_date=datetime.now())
+        self.first, self.second, self.third = (
+            self.poll.history.order_by('history_date', 'history_id'))
+
+    def test_next_record(self):
+        self.assertEqual(self.first.next_record, self.second)
+        self.assertEqual(self.second.next_record, self.third)
+        self.assertIsNone(self.third.next_record)
+
+    def test_prev_record(self):
+        self.assertEqual(self.third.prev_record, self.second)
+        self.assertEqual(self.second.prev_record, self.first)
+        self.assertIsNone(self.first.prev_record)
+
+    def test_same_history_date(self):
+        self.poll.history.update(history_date=self.first.history_date)
+        first, second, third = self.poll.history.order_by('history_id')
+        self.assertEqual(first.next_record, second)
+        self.assertEqual(third.prev_record, second)
+
+    def test_neighbour_is_cached(self):
+        self.first.next_record
+        self.third.next_record
+        with self.assertNumQueries(0):
+            self.assertEqual(self.first.next_record, self.second)
+            self.assertIsNone(self.third.next_record)
+
+    def test_with_neighbours(self):
+        with self.assertNumQueries(1):
+            records = list(self.poll.history.with_neighbours())
+        self.assertEqual(
+            [(r.prev_history_id, r.next_history_id) for r in records],
+            [(self.second.pk, None),
+             (self.first.pk, self.third.pk),
+             (None, self.second.pk)])
+        with self.assertNumQueries(1):
+            self.assertEqual(records[1].next_record, self.third)
+
+    def test_prefetch_neighbours(self):
+        records = self.poll.history.prefetch_neighbours(
+            self.poll.history.with_neighbours())
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [(r.prev_record, r.next_record) for r in records],
+                [(self.second, None),
+                 (self.first, self.third),
+                 (None, self.second)])
+
+
+class RevertToTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("tester", "tester@example.com")
+        self.past = datetime.now() - timedelta(days=1)
+        self.polls = []
+        for question in ("why?", "how?", "when?"):
+            poll = models.Poll(question=question, pub_date=self.past)
+            poll._history_date = self.past - timedelta(hours=1)
+            poll.save()
+            poll.question = question.upper()
+            poll.pub_date = datetime.now()
+            del poll._history_date
+            poll.save()
+            self.polls.append(poll)
+        self.newer = models.Poll.objects.create(question="where?",
+                                                pub_date=self.past)
+
+    def test_latest_as_of(self):
+        with self.assertNumQueries(1):
+            records = list(models.Poll.history.latest_as_of(self.past))
+        self.assertEqual(sorted(record.question for record in records),
+                         ["how?", "when?", "why?"])
+        records = models.Poll.history.latest_as_of(datetime.now())
+        self.assertEqual(sorted(record.question for record in records),
+                         ["HOW?", "WHEN?", "WHY?", "where?"])
+
+    @override_settings(USE_TZ=True, TIME_ZONE='Asia/Tokyo')
+    def test_latest_as_of_naive_date(self):
+        poll = models.Poll.objects.create(question="why?",
+                                          pub_date=self.past)
+        first, second = [
+            models.Poll.history.create(
+                id=poll.pk, question=question, pub_date=self.past,
+                history_type='~', history_date=datetime(
+                    2021, 1, 1, hour, 0, tzinfo=timezone.utc))
+            for question, hour in (("first", 10), ("second", 12))]
+        # 20:00 in Tokyo is 11:00 UTC, between the two records
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            records = list(poll.history.latest_as_of(
+                datetime(2021, 1, 1, 20, 0)))
+        self.assertEqual(records, [first])
+
+    def test_revert_to(self):
+        reverted = models.Poll.history.revert_to(
+            self.past, history_user=self.user)
+        self.assertEqual(len(reverted), 3)
+        self.assertEqual(
+            sorted(models.Poll.objects.values_list('question', flat=True)),
+            ["how?", "when?", "where?", "why?"])
+        self.assertEqual(
+            list(models.Poll.objects.filter(pk=self.polls[0].pk).values_list(
+                'pub_date', flat=True)), [self.past])
+        record = self.polls[0].history.all()[0]
+        self.assertEqual(record.history_type, '~')
+        self.assertEqual(record.history_user, self.user)
+        self.assertEqual(record.question, "why?")
+        self.assertEqual(self.newer.history.count(), 1)
+
+    def test_revert_to_queryset(self):
+        queryset = models.Poll.objects.filter(pk=self.polls[1].pk)
+        with self.assertNumQueries(4):
+            models.Poll.history.revert_to(self.past, queryset)
+        self.assertEqual(
+            sorted(models.Poll.objects.values_list('question', flat=True)),
+            ["WHEN?", "WHY?", "how?", "where?"])
+
+    def test_revert_to_batches(self):
+        models.Poll.history.revert_to(self.past, batch_size=2)
+        self.assertEqual(
+            sorted(models.Poll.objects.values_list('question', flat=True)),
+            ["how?", "when?", "where?", "why?"])
+
+    def test_revert_to_deleted_state(self):
+        poll, pk = self.polls[2], self.polls[2].pk
+        poll._history_date = self.past
+        poll.delete()
+        models.Poll.objects.create(pk=pk, question="again?",
+                                   pub_date=self.past)
+        models.Poll.history.revert_to(self.past)
+        self.assertEqual(models.Poll.objects.get(pk=pk).question, "again?")
+
+    def test_revert_to_with_instance(self):
+        self.assertRaises(TypeError, self.polls[0].history.revert_to,
+                          self.past)
+
+
+class UndeleteTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("tester", "tester@example.com")
+        self.tags = [models.Tag.objects.create(name=name)
+                     for name in ("red", "green", "blue")]
+        self.article = models.Article.objects.create(title="Colours")
+        self.article.tags.add(*self.tags[:2])
+        self.article.title = "Two colours"
+        self.article.save()
+        self.article_pk = self.article.pk
+        self.before = datetime.now()
+        self.polls = [
+            models.Poll.objects.create(question=question,
+                                       pub_date=datetime.now())
+            for question in ("why?", "how?", "when?")]
+        self.poll_pks = [poll.pk for poll in self.polls]
+
+    def test_undelete(self):
+        models.Poll.objects.all().delete()
+        restored = models.Poll.history.undelete(history_user=self.user)
+        self.assertEqual(len(restored), 3)
+        self.assertEqual(
+            sorted(models.Poll.objects.values_list('pk', 'question')),
+            sorted(zip(self.poll_pks, ("why?", "how?", "when?"))))
+        record = models.Poll.history.filter(id=self.poll_pks[0])[0]
+        self.assertEqual(record.history_type, '+')
+        self.assertEqual(record.history_user, self.user)
+        self.assertEqual(models.Poll.history.undelete(), [])
+
+    def test_undelete_unrecorded_change(self):
+        poll = self.polls[0]
+        poll.question = "who?"
+        poll.save_without_historical_record()
+        poll.delete()
+        models.Poll.history.undelete()
+        self.assertEqual(
+            models.Poll.objects.get(pk=self.poll_pks[0]).question, "who?")
+
+    def test_undelete_filters(self):
+        self.polls[0].delete()
+        later = datetime.now()
+        self.polls[1].delete()
+        self.polls[2]._history_user = self.user
+        self.polls[2].delete()
+        models.Poll.history.undelete(end=later)
+        models.Poll.history.undelete(history_user_id=self.user.pk)
+        self.assertEqual(
+            sorted(models.Poll.objects.values_list('question', flat=True)),
+            ["when?", "why?"])
+
+    def test_undelete_skips_existing(self):
+        self.polls[0].delete()
+        models.Poll.objects.create(pk=self.poll_pks[0], question="again?",
+                                   pub_date=datetime.now())
+        self.assertEqual(models.Poll.history.undelete(), [])
+        self.assertEqual(models.Poll.objects.get(pk=self.poll_pks[0]).question,
+                         "again?")
+
+    def test_undelete_batches(self):
+        models.Poll.objects.all().delete()
+        models.Poll.history.undelete(batch_size=2)
+        self.assertEqual(models.Poll.objects.count(), 3)
+
+    def test_undelete_restores_m2m(self):
+        self.article.delete()
+        self.tags[0].delete()
+        restored = models.Article.history.undelete(start=self.before)
+        self.assertEqual(restored[0].pk, self.article_pk)
+        article = models.Article.objects.get()
+        self.assertEqual(article.title, "Two colours")
+        self.assertEqual([tag.name for tag in article.tags.all()], ["green"])
+        through_history = article.tags.through.history.order_by('history_id')
+        self.assertEqual(
+            [record.history_type for record in through_history],
+            ['+', '+', '-', '-', '+'])
+
+    def test_undelete_keeps_removed_m2m_rows(self):
+        self.article.tags.remove(self.tags[0])
+        self.article.delete()
+        models.Article.history.undelete()
+        self.assertEqual(
+            [tag.name for tag in models.Article.objects.get().tags.all()],
+            ["green"])
@@ -19,7 +19,7 @@ from ..models import (
     ExternalModel1, ExternalModel3, UnicodeVerboseName, HistoricalChoice,
     HistoricalState, HistoricalCustomFKError, Series, SeriesWork, PollInfo,
     Employee, Country, Province,
-    City, Contact, ContactRegister,
+    City, Contact, ContactRegister, Label, Labelled, Ledger,
 )
 from ..external.models import ExternalModel2, ExternalModel4
 
@@ -300,6 +300,22 @@ class HistoricalRecordsTest(TestCase):
         self.assertEqual('historical quiet please',
                          l.history.get()._meta.verbose_name)
 
+    def test_index_together(self):
+        self.assertEqual(HistoricalPoll._meta.index_together,
+                         (('id', 'history_date'),))
+        self.assertEqual(Ledger.history.model._meta.index_together, (
+            ('id', 'history_date'), ('history_user', 'history_date'),
+            ('history_type', 'history_date')))
+
+    def test_bulk_records_with_overridden_save(self):
+        labelled = Labelled.objects.create()
+        labelled.labels.add(Label.objects.create(name="red"))
+        labelled.delete()
+        # The change records of the labels left are saved by their bases
+        self.assertEqual(
+            [record.history_note for record in Label.history.all()],
+            ["saved", "saved"])
+
     def test_foreignkey_primarykey(self):
         """Test saving a tracked model with a `ForeignKey` primary key."""
         poll = Poll(pub_date=today)
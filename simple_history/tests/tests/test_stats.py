@@ -0,0 +1,212 @@
+from __future__ import unicode_literals
+
+from mock import patch
+from six.moves import cStringIO as StringIO
+from django.core import management
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+from django.test.utils import override_settings
+
+from simple_history.middleware import (
+    HistoryBufferMiddleware, HistoryDebugMiddleware)
+from simple_history.signals import (
+    post_create_historical_record, pre_create_historical_record)
+from simple_history.stats import (
+    get_history_report, get_history_stats, get_record_size,
+    reset_history_stats)
+from ..models import Article, Poll, Tag
+from .test_models import today
+
+
+class CreateHistoricalRecordSignalTest(TestCase):
+
+    def setUp(self):
+        self.sent = []
+        pre_create_historical_record.connect(self.receiver)
+        post_create_historical_record.connect(self.receiver)
+
+    def tearDown(self):
+        pre_create_historical_record.disconnect(self.receiver)
+        post_create_historical_record.disconnect(self.receiver)
+
+    def receiver(self, signal, sender, instance, history_instance, using,
+                 **kwargs):
+        self.sent.append((signal, sender, instance, history_instance.pk,
+                          using))
+
+    def test_signals(self):
+        poll = Poll.objects.create(question="what's up?", pub_date=today)
+        record = Poll.history.get()
+        self.assertEqual(self.sent, [
+            (pre_create_historical_record, Poll, poll, None, 'default'),
+            (post_create_historical_record, Poll, poll, record.pk,
+             'default'),
+        ])
+
+    def test_change_record(self):
+        def set_question(history_instance, **kwargs):
+            history_instance.question = "changed"
+        pre_create_historical_record.connect(set_question, sender=Poll)
+        try:
+            Poll.objects.create(question="what's up?", pub_date=today)
+        finally:
+            pre_create_historical_record.disconnect(set_question, sender=Poll)
+        self.assertEqual(Poll.history.get().question, "changed")
+
+    def test_buffered_record(self):
+        middleware = HistoryBufferMiddleware()
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        poll = Poll.objects.create(question="what's up?", pub_date=today)
+        self.assertEqual(len(self.sent), 1)
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual(self.sent[1][:3],
+                         (post_create_historical_record, Poll, poll))
+
+
+@override_settings(SIMPLE_HISTORY_STATS=True)
+class HistoryStatsTest(TestCase):
+
+    def setUp(self):
+        reset_history_stats()
+
+    def tearDown(self):
+        reset_history_stats()
+
+    def test_create_historical_record(self):
+        poll = Poll.objects.create(question="what's up?", pub_date=today)
+        poll.question = "what's new?"
+        poll.save()
+        stats = get_history_stats()['tests.poll']
+        self.assertEqual(stats['records'], 2)
+        self.assertEqual(stats['flushes'], 2)
+        self.assertEqual(stats['rows_per_flush'], 1.0)
+        self.assertEqual(stats['bytes'], sum(
+            get_record_size(record) for record in Poll.history.all()))
+        self.assertGreater(stats['time'], 0)
+        self.assertEqual(
+            stats['operations']['create_historical_record']['calls'], 2)
+
+    def test_m2m_changed_and_pre_delete(self):
+        article = Article.objects.create(title="Colours")
+        tags = [Tag.objects.create(name=name) for name in ("red", "blue")]
+        article.tags.add(*tags)
+        article.tags.clear()
+        article.tags.add(tags[0])
+        article.delete()
+        stats = get_history_stats()
+        operations = stats['tests.article_tags']['operations']
+        self.assertEqual(operations['m2m_changed']['calls'], 6)
+        self.assertEqual(stats['tests.article_tags']['records'], 6)
+        self.assertEqual(
+            stats['tests.article']['operations']['pre_delete']['calls'], 1)
+
+    def test_buffered_flush(self):
+        middleware = HistoryBufferMiddleware()
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        for index in range(3):
+            Poll.objects.create(question="Poll %s" % index, pub_date=today)
+        middleware.process_response(request, HttpResponse())
+        stats = get_history_stats()['tests.poll']
+        self.assertEqual(stats['records'], 3)
+        self.assertEqual(stats['flushes'], 1)
+        self.assertEqual(stats['max_rows_per_flush'], 3)
+
+    def test_bulk_history_create(self):
+        polls = [Poll.objects.create(question="Poll %s" % index,
+                                     pub_date=today) for index in range(3)]
+        reset_history_stats()
+        Poll.history.bulk_history_create(polls)
+        Poll.history.all().delete()
+        management.call_command('populate_history', 'tests.poll',
+                                stdout=StringIO(), stderr=StringIO())
+        stats = get_history_stats()['tests.poll']
+        self.assertEqual(stats['records'], 6)
+        self.assertEqual(stats['flushes'], 2)
+        self.assertEqual(stats['rows_per_flush'], 3.0)
+        self.assertEqual(
+            stats['operations']['bulk_history_create']['calls'], 2)
+        self.assertNotIn('create_historical_record', stats['operations'])
+
+    def test_fast_history_create(self):
+        for index in range(3):
+            Poll.objects.create(question="Poll %s" % index, pub_date=today)
+        Poll.history.all().delete()
+        reset_history_stats()
+        management.call_command('populate_history', 'tests.poll',
+                                fast=True, stdout=StringIO(),
+                                stderr=StringIO())
+        stats = get_history_stats()['tests.poll']
+        self.assertEqual(Poll.history.count(), 3)
+        self.assertEqual(
+            stats['operations']['fast_history_create']['calls'], 1)
+
+    def test_reset(self):
+        Poll.objects.create(question="what's up?", pub_date=today)
+        get_history_stats()['tests.poll']['records'] = 10
+        self.assertEqual(get_history_stats()['tests.poll']['records'], 1)
+        reset_history_stats()
+        self.assertEqual(get_history_stats(), {})
+
+    @override_settings(SIMPLE_HISTORY_STATS=False)
+    def test_disabled(self):
+        Poll.objects.create(question="what's up?", pub_date=today)
+        self.assertEqual(get_history_stats(), {})
+
+
+class HistoryDebugMiddlewareTest(TestCase):
+
+    def setUp(self):
+        self.middleware = HistoryDebugMiddleware()
+        self.request = RequestFactory().post('/polls/')
+
+    def test_headers(self):
+        self.middleware.process_request(self.request)
+        Poll.objects.create(question="what's up?", pub_date=today)
+        article = Article.objects.create(title="Colours")
+        article.tags.add(Tag.objects.create(name="red"))
+        with patch('simple_history.middleware.logger') as logger:
+            response = self.middleware.process_response(self.request,
+                                                        HttpResponse())
+        self.assertIsNone(get_history_report())
+        # One INSERT per record, the m2m change also reads the through rows
+        self.assertEqual(response['X-History-Queries'], '5')
+        self.assertGreater(float(response['X-History-Time']), 0)
+        message = logger.info.call_args[0][0] % logger.info.call_args[0][1:]
+        self.assertIn("POST /polls/", message)
+        self.assertIn("tests.poll: 1 calls", message)
+        self.assertIn("tests.article: 1 calls", message)
+        self.assertIn("tests.tag: 1 calls", message)
+        # The receiver is called for both pre_add and post_add
+        self.assertIn("tests.article_tags: 2 calls", message)
+
+    def test_buffered_records(self):
+        buffer_middleware = HistoryBufferMiddleware()
+        self.middleware.process_request(self.request)
+        buffer_middleware.process_request(self.request)
+        for index in range(3):
+            Poll.objects.create(question="Poll %s" % index, pub_date=today)
+        response = buffer_middleware.process_response(self.request,
+                                                      HttpResponse())
+        response = self.middleware.process_response(self.request, response)
+        self.assertEqual(response['X-History-Queries'], '1')
+
+    def test_bulk_history_create(self):
+        polls = [Poll.objects.create(question="Poll %s" % index,
+                                     pub_date=today) for index in range(3)]
+        self.middleware.process_request(self.request)
+        Poll.history.bulk_history_create(polls)
+        with patch('simple_history.middleware.logger') as logger:
+            response = self.middleware.process_response(self.request,
+                                                        HttpResponse())
+        self.assertEqual(response['X-History-Queries'], '1')
+        message = logger.info.call_args[0][0] % logger.info.call_args[0][1:]
+        self.assertIn("tests.poll: 1 calls", message)
+
+    def test_no_history(self):
+        self.middleware.process_request(self.request)
+        response = self.middleware.process_response(self.request,
+                                                    HttpResponse())
+        self.assertEqual(response['X-History-Queries'], '0')
+        self.assertEqual(response['X-History-Time'], '0.000')
@@ -2,11 +2,17 @@ from __future__ import unicode_literals
 
 from django.conf.urls import include, url
 from django.contrib import admin
+from simple_history.admin import recent_changes_view
 from . import other_admin
 
 admin.autodiscover()
 
 urlpatterns = [
+    url(r'^admin/recent-changes/$', admin.site.admin_view(recent_changes_view),
+        name='simple_history_recent_changes'),
+    url(r'^admin/recent-changes/by-one/$',
+        admin.site.admin_view(recent_changes_view), {'per_page': 1},
+        name='simple_history_recent_changes_by_one'),
     url(r'^admin/', include(admin.site.urls)),
     url(r'^other-admin/', include(other_admin.site.urls)),
 ]